@@ -0,0 +1,182 @@
+import random
+import re
+from typing import Optional
+
+from python_modules.a1 import column_index, parse_range
+
+ROW_RANGE = re.compile(r'^([1-9][0-9]*):([1-9][0-9]*)$')
+
+
+def trim(values: list) -> list:
+    """
+    Удаление пустых ячеек в конце строк и пустых строк в конце диапазона, как это делает Sheets API
+    """
+    rows = [list(row) for row in values]
+    for row in rows:
+        while row and row[-1] == '':
+            row.pop()
+    while rows and not rows[-1]:
+        rows.pop()
+    return rows
+
+
+def value_range(text: str, values: list) -> dict:
+    """
+    Диапазон ответа values:batchGet. Для пустого диапазона Sheets API не возвращает поле values
+    """
+    response = {'range': text, 'majorDimension': 'ROWS'}
+    if values:
+        response['values'] = values
+    return response
+
+
+class FakeSpreadsheet:
+    """
+    Google таблица в памяти с интерфейсом gspread.Spreadsheet, достаточным для функций опроса
+    """
+    def __init__(self, spreadsheet_id: str = 'benchmark', title: str = 'Benchmark'):
+        self.id = spreadsheet_id
+        self.title = title
+        self.worksheets: list['FakeWorksheet'] = []
+        self.calls = 0
+
+    def add_worksheet(self, values: list, title: Optional[str] = None, rows: int = 0) -> 'FakeWorksheet':
+        sheets = FakeWorksheet(self, len(self.worksheets), title or f'Sheet{len(self.worksheets) + 1}', values, rows)
+        self.worksheets.append(sheets)
+        return sheets
+
+    def get_worksheet(self, index: int) -> Optional['FakeWorksheet']:
+        return self.worksheets[index] if index < len(self.worksheets) else None
+
+    def read_range(self, text: str) -> list:
+        """
+        Значения диапазона в формате 'Лист'!A1:B2, 'Лист'!1:5000 или 'Лист' (весь лист)
+        """
+        title, _, cells = text.partition('!')
+        if title.startswith("'"):
+            title = title[1:-1].replace("''", "'")
+        sheets = next(sheets for sheets in self.worksheets if sheets.title == title)
+        return sheets.read(cells or None)
+
+    def values_batch_get(self, ranges: list[str]) -> dict:
+        self.calls += 1
+        return {'valueRanges': [value_range(text, self.read_range(text)) for text in ranges]}
+
+
+class FakeWorksheet:
+    """
+    Лист Google таблицы в памяти с интерфейсом gspread.Worksheet: get_all_values, get по диапазону A1:B2
+    или по номерам строк 1:5000. Значения возвращаются без пустых ячеек и строк в конце, как в Sheets API,
+    а пустой диапазон get возвращает [[]], как gspread
+
+    rows: количество строк сетки листа, если оно больше количества строк с данными
+    """
+    def __init__(self, spreadsheet: FakeSpreadsheet, sheet_id: int, title: str, values: list, rows: int = 0):
+        self.spreadsheet = spreadsheet
+        self.id = sheet_id
+        self.title = title
+        self.values = values
+        self.rows = rows
+        self.calls = 0
+
+    @property
+    def row_count(self) -> int:
+        return max(self.rows, len(self.values))
+
+    @property
+    def col_count(self) -> int:
+        return max((len(row) for row in self.values), default=0)
+
+    def read(self, cells: Optional[str]) -> list:
+        if cells is None:
+            return trim(self.values)
+        match = ROW_RANGE.match(cells)
+        if match is not None:
+            return trim(self.values[int(match.group(1)) - 1:int(match.group(2))])
+        coordinates = parse_range(cells)
+        left, right = column_index(coordinates['leftcol']) - 1, column_index(coordinates['rightcol'])
+        return trim(row[left:right] for row in self.values[coordinates['leftrow'] - 1:coordinates['rightrow']])
+
+    def get_all_values(self) -> list:
+        self.calls += 1
+        width = self.col_count
+        return [list(row) + [''] * (width - len(row)) for row in trim(self.values)]
+
+    def get(self, cells: str) -> list:
+        self.calls += 1
+        return self.read(cells) or [[]]
+
+
+def generate_values(rows: int, cols: int, seed: int = 0) -> list:
+    """
+    Синтетический лист rows x cols: числа, короткие строки и пустые ячейки в разных пропорциях
+    """
+    rng = random.Random(seed)
+    values = []
+    for row in range(rows):
+        line = []
+        for col in range(cols):
+            kind = rng.random()
+            if kind < 0.1:
+                line.append('')
+            elif kind < 0.6:
+                line.append(str(rng.randint(0, 100000)))
+            else:
+                line.append(f'item-{row}-{col}')
+        values.append(line)
+    return values
+
+
+def sparse_edit(values: list, rng: random.Random, edits: int = 10) -> list:
+    """
+    Изменение нескольких случайных ячеек
+    """
+    values = [row[:] for row in values]
+    for _ in range(edits):
+        row = rng.randrange(len(values))
+        col = rng.randrange(len(values[row]))
+        values[row][col] = f'edited-{rng.random():.6f}'
+    return values
+
+
+def bulk_paste(values: list, rng: random.Random, fraction: float = 0.1) -> list:
+    """
+    Вставка прямоугольного блока, занимающего fraction строк и половину столбцов листа
+    """
+    values = [row[:] for row in values]
+    height = max(1, int(len(values) * fraction))
+    width = max(1, len(values[0]) // 2)
+    top = rng.randrange(len(values) - height + 1)
+    for row in range(top, top + height):
+        for col in range(width):
+            values[row][col] = f'pasted-{row}-{col}'
+    return values
+
+
+def row_insert(values: list, rng: random.Random, count: int = 5) -> list:
+    """
+    Вставка строк в середину листа: все строки ниже сдвигаются
+    """
+    values = [row[:] for row in values]
+    position = len(values) // 2
+    for index in range(count):
+        values.insert(position, [f'inserted-{index}-{col}' for col in range(len(values[0]))])
+    return values
+
+
+def resize(values: list, rng: random.Random, rows: int = 100, cols: int = 2) -> list:
+    """
+    Увеличение заполненного диапазона на rows строк и cols столбцов
+    """
+    width = len(values[0]) + cols
+    values = [row + [f'new-{index}-{col}' for col in range(cols)] for index, row in enumerate(values)]
+    values += [[f'new-{row}-{col}' for col in range(width)] for row in range(rows)]
+    return values
+
+
+EDIT_PATTERNS = {
+    'sparse': sparse_edit,
+    'bulk_paste': bulk_paste,
+    'row_insert': row_insert,
+    'resize': resize,
+}
@@ -0,0 +1,217 @@
+"""
+Офлайн-бенчмарки горячих путей опроса таблиц: поиск диапазона, сравнение снимков и потоковое сравнение.
+Обращения к Google API заменяются листом в памяти из benchmarks.fake_sheets, результаты выводятся в JSON.
+
+Запуск из корня проекта:
+    python -m benchmarks.run_benchmarks --rows 1000 10000 --cols 20 --output bench.json
+"""
+import argparse
+import asyncio
+import json
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from typing import Awaitable, Callable
+
+import numpy as np
+
+from benchmarks.fake_sheets import EDIT_PATTERNS, FakeSpreadsheet, generate_values
+from python_modules.a1 import format_range
+from python_modules.diff_engine import BlockDiffer, Snapshot
+from python_modules.diff_pool import configure_diff_pool
+from python_modules.functions import batch_search_ranges, compare_of_ranges, compare_of_values, fetch_row_block, search_ranges
+from python_modules.governor import governor
+
+
+async def measure(func: Callable[[], Awaitable], repeat: int) -> dict:
+    """
+    Время выполнения func (медиана, минимум и максимум по repeat запускам в секундах),
+    затем пиковая память и количество блоков памяти, оставшихся после отдельного запуска под tracemalloc
+    """
+    await func() # прогрев: кэши lru_cache, пул потоков
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        await func()
+        timings.append(time.perf_counter() - started)
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    result = await func()
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    retained = after.compare_to(before, 'filename')
+
+    return {'median_s': statistics.median(timings), 'min_s': min(timings), 'max_s': max(timings),
+            'peak_bytes': peak, 'retained_blocks': sum(stat.count_diff for stat in retained),
+            'result': result}
+
+
+def make_sheet(values: list, rows: int = 0):
+    spreadsheet = FakeSpreadsheet()
+    return spreadsheet, spreadsheet.add_worksheet(values, rows=rows)
+
+
+async def bench_diff(old: list, new: list, repeat: int) -> dict:
+    """
+    Сравнение двух снимков: compare_of_ranges и compare_of_values, как при опросе подписки
+    """
+    old_snapshot, new_snapshot = Snapshot(old), Snapshot(new)
+
+    async def run():
+        await compare_of_ranges([old_snapshot, new_snapshot])
+        _, lines = await compare_of_values([old_snapshot, new_snapshot])
+        return len(lines)
+
+    stats = await measure(run, repeat)
+    cells = max(old_snapshot.shape[0], new_snapshot.shape[0]) * max(old_snapshot.shape[1], new_snapshot.shape[1])
+    stats['cells_per_s'] = cells / stats['median_s'] if stats['median_s'] else None
+    return stats
+
+
+async def bench_poll(old: list, new: list, repeat: int, user_range: str) -> dict:
+    """
+    Полный опрос одной подписки: search_ranges по листу в памяти, построение снимка и сравнение с предыдущим
+    """
+    _, sheets = make_sheet(new)
+    start_coords = None if user_range == 'dynamic' else user_range
+    old_snapshot = Snapshot((await search_ranges(make_sheet(old)[1], start_coords))[1])
+
+    async def run():
+        coordinates, values = await search_ranges(sheets, start_coords)
+        snapshot = Snapshot(values)
+        await compare_of_ranges([old_snapshot, snapshot])
+        _, lines = await compare_of_values([old_snapshot, snapshot])
+        return len(lines)
+
+    return await measure(run, repeat)
+
+
+async def bench_batch(old: list, new: list, repeat: int, subscriptions: int) -> dict:
+    """
+    Опрос нескольких подписок на листы одной таблицы одним вызовом batch_search_ranges
+    """
+    spreadsheet = FakeSpreadsheet()
+    for _ in range(subscriptions):
+        spreadsheet.add_worksheet(new)
+    old_snapshot = Snapshot(old)
+    requests = [(sheets, 'dynamic') for sheets in spreadsheet.worksheets]
+
+    async def run():
+        changes = 0
+        for coordinates, values in await batch_search_ranges(spreadsheet, requests):
+            _, lines = await compare_of_values([old_snapshot, Snapshot(values)])
+            changes += len(lines)
+        return changes
+
+    return await measure(run, repeat)
+
+
+async def bench_stream(old: list, new: list, repeat: int, block_rows: int, empty_rows: int) -> dict:
+    """
+    Потоковый опрос большого листа блоками по block_rows строк с поблочным сравнением.
+    Сетка листа на empty_rows строк больше данных, поэтому последние блоки могут быть пустыми
+    """
+    _, old_sheets = make_sheet(old, len(old) + empty_rows)
+    _, sheets = make_sheet(new, len(new) + empty_rows)
+
+    async def stream(sheets, snapshot):
+        differ = BlockDiffer(snapshot, block_rows)
+        changes = 0
+        for first_row in range(1, sheets.row_count + 1, block_rows):
+            changes += len(differ.feed(await fetch_row_block(sheets, first_row, first_row + block_rows - 1)))
+        differ.finish()
+        return differ.new, changes
+
+    old_snapshot, _ = await stream(old_sheets, None)
+
+    async def run():
+        return (await stream(sheets, old_snapshot))[1]
+
+    return await measure(run, repeat)
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ''
+
+
+async def run_benchmarks(args: argparse.Namespace) -> dict:
+    governor.configure(rate_per_minute=10 ** 9, burst=10 ** 9) # лист в памяти не ограничен квотой API
+    if args.diff_processes: # сравнение снимков любого размера в пуле процессов
+        configure_diff_pool(args.diff_processes, 0)
+    results = []
+    for rows in args.rows:
+        old = generate_values(rows, args.cols, args.seed)
+        for pattern in args.patterns:
+            new = EDIT_PATTERNS[pattern](old, random.Random(args.seed))
+            fixed_range = format_range({'leftcol': 'A', 'leftrow': 1, 'rightcol': 'B', 'rightrow': rows})
+            cases = {
+                'diff': bench_diff(old, new, args.repeat),
+                'poll_dynamic': bench_poll(old, new, args.repeat, 'dynamic'),
+                'poll_fixed': bench_poll(old, new, args.repeat, fixed_range),
+                'poll_batch': bench_batch(old, new, args.repeat, args.subscriptions),
+                'poll_stream': bench_stream(old, new, args.repeat, args.block_rows, args.empty_rows),
+            }
+            for name, case in cases.items():
+                if args.only and name not in args.only:
+                    case.close()
+                    continue
+                stats = await case
+                stats['changes'] = stats.pop('result')
+                results.append({'benchmark': name, 'pattern': pattern, 'rows': rows, 'cols': args.cols, **stats})
+                print(f"{name:>13} {pattern:>10} {rows:>8} rows: {stats['median_s'] * 1000:9.2f} ms, "
+                      f"peak {stats['peak_bytes'] / 2 ** 20:8.2f} MiB", file=sys.stderr)
+
+    return {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'args': vars(args),
+        },
+        'results': results,
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Offline benchmarks for sheet polling and diffing')
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000], help='sheet sizes in rows')
+    parser.add_argument('--cols', type=int, default=20, help='sheet width in columns')
+    parser.add_argument('--patterns', nargs='+', choices=sorted(EDIT_PATTERNS), default=sorted(EDIT_PATTERNS),
+                        help='edit patterns applied between polls')
+    parser.add_argument('--only', nargs='+', help='run only the named benchmarks')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per benchmark')
+    parser.add_argument('--subscriptions', type=int, default=5, help='worksheets polled by poll_batch')
+    parser.add_argument('--block-rows', type=int, default=5000, help='block size of poll_stream')
+    parser.add_argument('--empty-rows', type=int, default=5000,
+                        help='empty grid rows below the data in poll_stream')
+    parser.add_argument('--diff-processes', type=int, default=0, help='diff snapshots in a process pool of this size')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='JSON file for results, stdout if omitted')
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    report = asyncio.run(run_benchmarks(args))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
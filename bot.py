@@ -2,7 +2,12 @@ import datetime
 import json
 
 import asyncio
+import signal
+import time
+from typing import Optional
+
 from aiogram import Bot, Dispatcher, types
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
 from aiogram.utils import executor
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup
 from aiogram.dispatcher import FSMContext
@@ -10,16 +15,60 @@ from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 
 from python_modules.functions import speardsheets_connection_check, search_ranges, compare_of_values, compare_of_ranges
-from python_modules.mysql_db_init import db_connection_check, setup_db
-from python_modules.db_functions import user_id_tables, tg_user_id_list, insert_new_users, insert_new_sheets_info
-from python_modules.db_functions import extraction_query, tracked_tables, delete_spreadsheets
+from python_modules.functions import batch_search_ranges, spreadsheet_version, fetch_row_block, dynamic_coordinates
+from python_modules.mysql_db_init import setup_db
+from python_modules.db_functions import insert_new_users, insert_new_sheets_info, cached_user_number, cached_tracked_tables
+from python_modules.db_functions import delete_spreadsheets, save_snapshot, load_snapshot
+from python_modules.db_functions import shard_tracked_tables
+from python_modules.db_functions import all_tracked_tables, create_db_pool, close_db_pool, acquire_connection, pool_stats
+from python_modules.scheduler import Scheduler, TrackingJob
+from python_modules.diff_engine import Snapshot, SnapshotDiff, BlockSnapshot, BlockDiffer, format_diff, snapshot_from_bytes
+from python_modules.diff_engine import snapshot_nbytes, to_block_snapshot, to_plain_snapshot
+from python_modules.diff_pool import block_diff_lines, configure_diff_pool, shutdown_diff_pool
+from python_modules.shared_snapshots import SnapshotRegistry, subscription_key
+from python_modules.a1 import format_range, parse_range, range_origin
+from python_modules.notifications import Notifier, RateLimiter
+from python_modules.delivery import Outbox
+from python_modules.sharding import LeaseManager
+from python_modules.webhook import BoundedWebhookHandler, update_limiter
+from python_modules.sheets_client import handle_cache, configure_executor, configure_api_base
+from python_modules.governor import governor, BACKGROUND
+from python_modules.metrics import Counter, Gauge, instrument, start_metrics_server
 from config.config import SERVICE_ACCOUNT_FILE, SCOPES, tg_token, host, port, user, db_name, password
-from logs.logger import log_error
+from config.config import DB_POOL_MINSIZE, DB_POOL_MAXSIZE, DB_ACQUIRE_TIMEOUT, DB_POOL_RECYCLE
+from config.config import NOTIFY_GLOBAL_RATE, NOTIFY_CHAT_RATE, NOTIFY_CHAT_BURST, NOTIFY_DEBOUNCE, OUTBOX_WORKERS, OUTBOX_MAX_ATTEMPTS
+from config.config import SHEETS_QUOTA_PER_MINUTE, SHEETS_QUOTA_BURST
+from config.config import TELEGRAM_API_URL, GOOGLE_API_URL, METRICS_HOST, METRICS_PORT, METRICS_PORT_SPAN
+from config.config import LOG_LEVEL, LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_ROTATE_WHEN, LOG_JSON, LOG_SAMPLE_INTERVAL, LOG_SAMPLE_BURST
+from config.config import BOT_ROLE, WORKER_ID, SHARD_COUNT, LEASE_TTL, LEASE_RENEW_INTERVAL
+from config.config import DIFF_PROCESSES, DIFF_PROCESS_THRESHOLD
+from config.config import WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_SECRET, WEBHOOK_MAX_CONNECTIONS
+from config.config import WEBHOOK_MAX_IN_FLIGHT, WEBHOOK_DRAIN_TIMEOUT
+from config.config import ADAPTIVE_FACTOR, ADAPTIVE_MAX_INTERVAL, STREAM_BLOCK_ROWS, STREAM_THRESHOLD_ROWS
+from config.config import POLL_CONCURRENCY, MIN_INTERVAL, BATCH_WINDOW, WARMUP_WINDOW, SHEETS_CACHE_SIZE, SHEETS_CACHE_TTL, SHEETS_WORKERS, SHEETS_TIMEOUT
+from logs.logger import log_debug, log_error, configure_logging
 
 with open('python_modules/messages.json', 'r') as file:
     messages_dict = json.load(file) # двуязычный словарь с сообщениями от бота 
 
-bot = Bot(token=tg_token)
+configure_logging(LOG_LEVEL, LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_ROTATE_WHEN, LOG_JSON, LOG_SAMPLE_INTERVAL, LOG_SAMPLE_BURST)
+handle_cache.configure(SHEETS_CACHE_SIZE, SHEETS_CACHE_TTL)
+configure_executor(SHEETS_WORKERS, SHEETS_TIMEOUT)
+governor.configure(SHEETS_QUOTA_PER_MINUTE, SHEETS_QUOTA_BURST)
+configure_diff_pool(DIFF_PROCESSES, DIFF_PROCESS_THRESHOLD)
+update_limiter.configure(WEBHOOK_MAX_IN_FLIGHT, WEBHOOK_SECRET)
+if GOOGLE_API_URL: # локальная замена Google API для нагрузочного тестирования
+    configure_api_base(GOOGLE_API_URL)
+
+class InstrumentedBot(Bot):
+    """
+    Бот, отправка сообщений которого учитывается в метриках: и ответы обработчиков, и уведомления
+    """
+    @instrument('send_message')
+    async def send_message(self, *args, **kwargs) -> types.Message:
+        return await super().send_message(*args, **kwargs)
+
+bot = InstrumentedBot(token=tg_token, server=TelegramAPIServer.from_base(TELEGRAM_API_URL) if TELEGRAM_API_URL else TELEGRAM_PRODUCTION)
 storage = MemoryStorage()
 dp = Dispatcher(bot, storage=storage)
 
@@ -68,11 +117,10 @@ async def general_instruction(callback_query: types.CallbackQuery):
     try:
         now = datetime.datetime.now()
         user_id = callback_query.message.chat.id
-        connection = await db_connection_check(host, port, user, password, user_id) # возвращает соединение с базой 
-        users_telegram_id = [value[0] for value in await tg_user_id_list(connection)] # список подключенных к боту пользователей
+        async with acquire_connection() as connection: # соединение с базой из общего пула
+            new_user = await insert_new_users(connection, user_id, now) # добавление пользователя в бд, True если он подключился впервые
 
-        if user_id not in users_telegram_id: # проверка на то, подключался ли ранее пользователь к боту
-            await insert_new_users(connection, user_id, now) # добавление нового пользователя в бд, если user_id не найден в users_telegram_id
+        if new_user:
             text_1 = await bot_messages("fisrt_instruction", language)
             text_2 = await bot_messages("add_account_bottom", language)
 
@@ -216,9 +264,7 @@ async def range_input(callback_query: types.CallbackQuery, state: FSMContext):
                 SERVICE_ACCOUNT_FILE, SCOPES, table_name, sheet_number) # установка соединения с Google таблицей
             all_data = await search_ranges(conn[1])  # поиск заполненного диапазона и возврат его кооридинат
 
-            left = all_data[0]['leftcol'] + str(all_data[0]['leftrow'])
-            right = all_data[0]['rightcol'] + str(all_data[0]['rightrow'])
-            start_range = left + ":" + right
+            start_range = format_range(all_data[0])
 
             async with state.proxy() as data:
                 data['range'] = 'dynamic'
@@ -306,33 +352,247 @@ async def sheets_manage(user_id: int):
     except Exception as ex:
         log_error(f"Respone from search_comparisons_init: {ex}")
 
-async def loop(table_name: str, sheet_number: int, user_range: str, user_id: str , state: FSMContext) -> None: 
+async def send_notification(chat_id: int, text: str) -> None:
+    await bot.send_message(chat_id=chat_id, text=text)
+
+# уведомления накапливаются в notifier, записываются в очередь outbox в базе и доставляются ее обработчиками
+outbox = Outbox(send_notification, RateLimiter(NOTIFY_GLOBAL_RATE, NOTIFY_CHAT_RATE, NOTIFY_CHAT_BURST), OUTBOX_WORKERS,
+                OUTBOX_MAX_ATTEMPTS)
+notifier = Notifier(outbox.put, debounce=NOTIFY_DEBOUNCE)
+snapshots = SnapshotRegistry() # общие снимки подписок разных пользователей на одни и те же ячейки
+
+background_tasks = set() # ссылки на фоновые задачи, чтобы их не удалил сборщик мусора
+pending_saves: dict[int, asyncio.Task] = {} # последнее запущенное сохранение снимка каждой подписки
+
+def run_in_background(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+def snapshot_bytes(snapshot) -> asyncio.Future:
     """
-    Функция поиска изменений с заданной периодичностью interval в google таблице.
-    Вызывается в функции search_comparisons_init
+    Сжатие снимка для сохранения в базу в отдельном потоке, вне цикла событий. Пока сжатие выполняется,
+    его задача хранится в снимке, и сохранения подписок, ссылающихся на тот же объект снимка, ждут ее результата,
+    а не сжимают снимок заново. После сжатия ссылка удаляется, чтобы не хранить сжатую копию вместе со снимком
     """
-    cell_values_list = []
-    while True: 
-        conn = await speardsheets_connection_check(SERVICE_ACCOUNT_FILE, SCOPES, table_name, sheet_number) # возвращает соединение с google таблицей
-        cell_values = await search_ranges(conn[1], user_range) # возвращает массив значений в ячейках в зависимости от заданного user_range (dynamic или  fix)
-        cell_values_list.append(cell_values[1]) 
+    future = getattr(snapshot, '_bytes', None)
+    if future is None:
+        future = snapshot._bytes = asyncio.ensure_future(asyncio.to_thread(snapshot.to_bytes))
+        future.add_done_callback(lambda _: delattr(snapshot, '_bytes'))
+    return future
 
-        # Форматирование кооридинат из cell_values[0] = {'leftcol': 'A', 'leftrow': 1, 'rightcol': 'A', 'rightrow': 3} в формат A1:A3
-        current_range = f"{cell_values[0]['leftcol']}{cell_values[0]['leftrow']}:{cell_values[0]['rightcol']}{cell_values[0]['rightrow']}"
+def schedule_store(job: TrackingJob, payload: asyncio.Future, file_version: str) -> None:
+    """
+    Запуск сохранения снимка подписки в фоне. Сохранения одной подписки выполняются по очереди,
+    чтобы более старый снимок, который дольше сжимался или записывался, не перезаписал более новый
+    """
+    previous = pending_saves.get(job.job_id)
+    pending_saves[job.job_id] = run_in_background(store_snapshot(job.job_id, payload, file_version, previous))
 
-        if len(cell_values_list) == 2: # если в cell_values_list находятся значения ячеек за 2 промежутка времени одного и того же диапазона
-            # то начинается поиск различий между cell_values_list[0] и cell_values_list[1] 
-            range_changes = await compare_of_ranges(cell_values_list) # сравнение размеров массивов google таблицы за 2 промежутка времени
-            value_comparison_result = await compare_of_values(cell_values_list) # сравнение значений массивов google таблицы за 2 промежутка времени
+async def store_snapshot(job_id: int, payload: asyncio.Future, file_version: str,
+                         previous: Optional[asyncio.Task] = None) -> None:
+    """
+    Сохранение снимка подписки в базу. Выполняется в фоне после успешного опроса,
+    чтобы после перезапуска бота не терять базу для сравнения.
+    payload: сжатый снимок из snapshot_bytes, previous: предыдущее сохранение снимка этой подписки
+    """
+    try:
+        if previous is not None:
+            await asyncio.wait({previous})
+        snapshot_data = await asyncio.shield(payload) # сжатие общее для всех подписок со снимком
+        async with acquire_connection() as connection:
+            await save_snapshot(connection, job_id, snapshot_data, file_version)
+    except Exception as ex:
+        log_error(f"Respone from store_snapshot: {ex}")
+    finally:
+        if pending_saves.get(job_id) is asyncio.current_task():
+            del pending_saves[job_id]
 
-            if range_changes is False: # если размер массива (диапазон отслеживания) изменился, то пользователю направляется инфо о новном диапазоне
-                await bot.send_message(chat_id=user_id, text=f"New Range {current_range}")
-            
-            if value_comparison_result[0] is not True: # если различия в массивах есть, то пользователю направляются ссылки на ячейки, изменившие свои значения
-                for i in value_comparison_result[1]:
-                    await bot.send_message(chat_id=user_id, text=f"Table: {table_name}, sheet: {sheet_number}, сell: {i}")
+async def restore_snapshot(job: TrackingJob, key: tuple) -> None:
+    """
+    Загрузка сохраненного снимка подписки при первом опросе после запуска бота.
+    Изменения, сделанные в таблице во время простоя, будут найдены при сравнении с ним.
+    Если такой же снимок уже загружен для другой подписки с тем же ключом, используется он
+    """
+    job.snapshot_loaded = True
+    try:
+        async with acquire_connection() as connection:
+            result = await load_snapshot(connection, job.job_id)
+        if result and job.snapshot is None:
+            snapshot = await asyncio.to_thread(snapshot_from_bytes, result[0])
+            job.snapshot = snapshots.intern(key, result[1], snapshot)
+            job.file_version = result[1]
+    except Exception as ex:
+        log_error(f"Respone from restore_snapshot: {ex}")
+
+def snapshot_coordinates(user_range: str, snapshot: Snapshot) -> dict:
+    """
+    Координаты диапазона, к которому относится снимок: заданный пользователем или весь заполненный диапазон листа
+    """
+    if user_range == 'dynamic':
+        return dynamic_coordinates(snapshot.values)
+    return parse_range(user_range)
+
+async def snapshot_changes(old, new, coordinates: Optional[dict]) -> list[str]:
+    """
+    Описание изменений между снимками old и new для пользователя.
+    Если лист динамической подписки перешел через порог потокового опроса, предыдущий снимок
+    переводится в формат нового, чтобы изменения этого опроса тоже были найдены
+    """
+    if isinstance(new, BlockSnapshot):
+        if not isinstance(old, BlockSnapshot) or old.block_rows != new.block_rows:
+            log_debug(f'Previous snapshot of {new.shape[0]} rows is converted to blocks of {new.block_rows} rows')
+            old = await asyncio.to_thread(to_block_snapshot, old, new.block_rows)
+        return await block_diff_lines(old, new)
+    if isinstance(old, BlockSnapshot):
+        log_debug(f'Previous block snapshot of {old.shape[0]} rows is converted to a plain snapshot')
+        old = await asyncio.to_thread(to_plain_snapshot, old)
+
+    # Форматирование кооридинат из coordinates = {'leftcol': 'A', 'leftrow': 1, 'rightcol': 'A', 'rightrow': 3} в формат A1:A3
+    current_range = format_range(coordinates)
+    cell_values_list = [old, new]
+    range_changes = await compare_of_ranges(cell_values_list) # сравнение размеров массивов google таблицы за 2 промежутка времени
+    value_comparison_result = await compare_of_values(cell_values_list, *range_origin(coordinates)) # сравнение значений массивов google таблицы за 2 промежутка времени
+
+    lines = []
+    if value_comparison_result is None: # ошибка сравнения уже записана в лог
+        return lines
+    if range_changes is False: # если размер массива (диапазон отслеживания) изменился, то пользователю направляется инфо о новном диапазоне
+        lines.append(f"New Range {current_range}")
+
+    if value_comparison_result[0] is not True: # если различия в массивах есть, то пользователю направляются ссылки на ячейки, изменившие свои значения
+        lines.extend(value_comparison_result[1])
+    return lines
+
+async def deliver_snapshot(jobs: list[TrackingJob], snapshot, file_version: Optional[str],
+                           coordinates: Optional[dict], notified: list[TrackingJob] = ()) -> None:
+    """
+    Рассылка изменений нового снимка snapshot всем подпискам jobs с одинаковым ключом.
+    Изменения вычисляются один раз для каждого различного предыдущего снимка: подписки, опрошенные
+    в одно время, ссылаются на один объект снимка и получают одинаковый список изменений.
+    notified: подписки, которым изменения уже отправлены при потоковом опросе
+    """
+    changes: dict[int, tuple] = {} # предыдущий снимок хранится в значении, чтобы его id не переиспользовался
+    payload = None # снимок сжимается для сохранения один раз для всех подписок
+    for job in jobs:
+        old = job.snapshot
+        if old is not None and old is not snapshot and all(job is not other for other in notified):
+            if id(old) not in changes:
+                changes[id(old)] = (old, await snapshot_changes(old, snapshot, coordinates))
+            # все изменения опроса объединяются в несколько сообщений и отправляются с учетом лимитов Telegram
+            notifier.notify(job.user_id, f"Table: {job.table_name}, sheet: {job.sheet_number}", changes[id(old)][1])
+
+        job.changed = old is not None and old != snapshot # используется планировщиком в адаптивном режиме
+        if old is None or old != snapshot:
+            if payload is None:
+                payload = snapshot_bytes(snapshot)
+            schedule_store(job, payload, file_version)
+        job.file_version = file_version
+        job.snapshot = snapshot # текущие значения становятся базой для следующего опроса
+
+async def stream_and_notify(jobs: list[TrackingJob], sheets) -> Optional[BlockSnapshot]:
+    """
+    Потоковый опрос большого листа в динамическом режиме. Лист запрашивается блоками по STREAM_BLOCK_ROWS строк,
+    каждый блок сравнивается с соответствующим блоком предыдущего снимка сразу после получения,
+    и изменения отправляются подписчикам jobs (с общим предыдущим снимком), не дожидаясь конца листа.
+    В памяти одновременно находится только один блок, снимок хранится сжатыми блоками.
+    Возвращает новый снимок или None при ошибке API
+    """
+    old = jobs[0].snapshot
+    if old is not None and (not isinstance(old, BlockSnapshot) or old.block_rows != STREAM_BLOCK_ROWS):
+        # лист перешел через порог потокового опроса или изменился размер блока
+        log_debug(f'Previous snapshot of {old.shape[0]} rows is converted to blocks of {STREAM_BLOCK_ROWS} rows')
+        old = await asyncio.to_thread(to_block_snapshot, old, STREAM_BLOCK_ROWS)
+    differ = BlockDiffer(old, STREAM_BLOCK_ROWS)
+    compare = differ.old is not None # без предыдущего снимка изменения не ищутся
+
+    def notify(lines: list[str]) -> None:
+        for job in jobs:
+            notifier.notify(job.user_id, f"Table: {job.table_name}, sheet: {job.sheet_number}", lines)
+
+    first_row = 1
+    while first_row <= sheets.row_count:
+        values = await fetch_row_block(sheets, first_row, first_row + STREAM_BLOCK_ROWS - 1)
+        if values is None: # ошибка API, снимок остается прежним до следующего опроса
+            return None
+        cells = await asyncio.to_thread(differ.feed, values)
+        if compare and cells:
+            notify(format_diff(SnapshotDiff(cells, range(0), range(0), range(0), range(0))))
+        first_row += STREAM_BLOCK_ROWS
+
+    diff = await asyncio.to_thread(differ.finish)
+    if compare: # изменение размера заполненного диапазона и ячейки удаленных в конце листа строк
+        notify(format_diff(diff))
+    return differ.new
+
+async def poll_tables(jobs: list[TrackingJob]) -> None:
+    """
+    Опрос подписок на одну google таблицу. Подписки с одинаковым ключом (файл, лист, диапазон)
+    опрашиваются один раз, значения всех различных листов и диапазонов запрашиваются одним
+    вызовом batch_search_ranges, изменения рассылаются всем подписчикам.
+    Если файл таблицы не менялся с предыдущего опроса, значения не запрашиваются, а если снимок этой версии файла
+    уже получен при опросе другой подписки, используется он.
+    Вызывается планировщиком scheduler с периодичностью job.interval_value
+    """
+    requests = []
+    for job in jobs:
+        conn = await speardsheets_connection_check(SERVICE_ACCOUNT_FILE, SCOPES, job.table_name, job.sheet_number, BACKGROUND) # возвращает соединение с листом google таблицы
+        if conn[0]:
+            requests.append((job, conn[1]))
+    if not requests:
+        return
+
+    for job, sheets in requests:
+        if not job.snapshot_loaded: # ленивая загрузка снимка, сохраненного до перезапуска
+            await restore_snapshot(job, subscription_key(sheets, job.user_range))
+
+    spreadsheet = requests[0][1].spreadsheet
+    file_version = await spreadsheet_version(SERVICE_ACCOUNT_FILE, SCOPES, spreadsheet) # дешевая проверка версии файла через Drive API
+    if file_version is not None: # подписки, снимок которых сделан с той же версии файла, не опрашиваются
+        requests = [(job, sheets) for job, sheets in requests if job.snapshot is None or job.file_version != file_version]
+        if not requests:
+            return
+
+    groups: dict[tuple, tuple[list[TrackingJob], object]] = {} # подписки, сгруппированные по каноническому ключу
+    for job, sheets in requests:
+        groups.setdefault(subscription_key(sheets, job.user_range), ([], sheets))[0].append(job)
+
+    fetch = []
+    for key, (group, sheets) in groups.items():
+        try:
+            shared = snapshots.get(key, file_version)
+            if shared is not None: # снимок этой версии файла уже получен при опросе подписки другого пользователя
+                coordinates = None if isinstance(shared, BlockSnapshot) else snapshot_coordinates(group[0].user_range, shared)
+                await deliver_snapshot(group, shared, file_version, coordinates)
+
+            elif group[0].user_range == 'dynamic' and sheets.row_count > STREAM_THRESHOLD_ROWS:
+                # динамические подписки на большие листы опрашиваются блоками
+                notified = [job for job in group if job.snapshot is group[0].snapshot]
+                snapshot = await stream_and_notify(notified, sheets)
+                if snapshot is not None:
+                    snapshots.set(key, file_version, snapshot)
+                    await deliver_snapshot(group, snapshot, file_version, None, notified)
+            else:
+                fetch.append((key, group, sheets))
+        except Exception as ex:
+            log_error(f"Respone from poll_tables, jobs {[job.job_id for job in group]}: {ex}")
+    if not fetch:
+        return
+
+    results = await batch_search_ranges(spreadsheet, [(sheets, group[0].user_range) for _, group, sheets in fetch])
+
+    for (key, group, _), cell_values in zip(fetch, results):
+        if not cell_values[0]: # диапазон задан некорректно или API вернул ошибку
+            continue
+        try:
+            snapshot = Snapshot(cell_values[1]) # значения ячеек вместе с хэшами строк
+            snapshots.set(key, file_version, snapshot)
+            await deliver_snapshot(group, snapshot, file_version, cell_values[0])
+        except Exception as ex:
+            log_error(f"Respone from poll_tables, jobs {[job.job_id for job in group]}: {ex}")
 
-            cell_values_list.pop(0) # удаление первого по времени добавления массива значений ячеек из google таблицы
+scheduler = Scheduler(poll_tables, POLL_CONCURRENCY, MIN_INTERVAL, BATCH_WINDOW, ADAPTIVE_FACTOR, ADAPTIVE_MAX_INTERVAL)
 
 @dp.callback_query_handler(lambda callback_query: callback_query.data == "starting")
 async def search_comparisons_init(callback_query: types.CallbackQuery, state: FSMContext):
@@ -342,8 +602,6 @@ async def search_comparisons_init(callback_query: types.CallbackQuery, state: FS
     Также пользователю направляется меню с 2 кнопками ['Add table', 'Delete table'] для управления своими таблицами 
     """
     user_id = callback_query.message.chat.id
-    connection = await db_connection_check(host, port, user, password, user_id)
-    user_number = await extraction_query(connection, user_id) # извлечение номера пользователя в бд
 
     async with state.proxy() as data: 
         table_name = data['table_name']
@@ -351,13 +609,14 @@ async def search_comparisons_init(callback_query: types.CallbackQuery, state: FS
         user_range = data['range']
         interval_value = data['interval_value']
 
-    await insert_new_sheets_info(connection, user_number, table_name, sheet_number, user_range, interval_value, user_id) 
+    user_number = await cached_user_number(user_id) # извлечение номера пользователя в бд
+    async with acquire_connection() as connection:
+        table_id = await insert_new_sheets_info(connection, user_number, table_name, sheet_number, user_range, interval_value, user_id) 
     try:
         user_id = callback_query.message.chat.id
         await sheets_manage(user_id) 
-        await loop(table_name, sheet_number, user_range, user_id, state)
-        await asyncio.sleep(interval_value)
-        asyncio.create_task(loop())
+        if table_id is not None and BOT_ROLE == 'all': # регистрация подписки в планировщике, первый опрос выполняется сразу
+            scheduler.add_job(TrackingJob(table_id, user_id, table_name, sheet_number, user_range, interval_value))
     
     except Exception as ex:
         log_error(f"Respone from search_comparisons_init: {ex}")
@@ -369,9 +628,6 @@ async def command_handler(message: types.Message):
     """
     try:
         user_id = message.chat.id
-        connection = await db_connection_check(host, port, user, password, user_id)
-        user_number = await extraction_query(connection, user_id) # номер пользователя в базе
-        user_tables = await tracked_tables(connection, user_number) # кол-во отслеживаемых пользователем таблиц 
 
         if message.text in ['Add table', 'Добавить таблицу']:
             text_1 = await bot_messages("spreadsheet_name", language)
@@ -379,7 +635,9 @@ async def command_handler(message: types.Message):
             await bot.send_message(chat_id=message.chat.id, text=text_1) # Принимает на ввод название таблицы и возвращает к функции enter_table_name
 
         elif message.text in ['Delete table', 'Удалить таблицу']:
-            user_tables_id = [value[0] for value in await user_id_tables(connection, user_number)] # возвращает список отслеживаемых таблиц
+            user_number = await cached_user_number(user_id) # номер пользователя в базе
+            user_tables = await cached_tracked_tables(user_number) # отслеживаемые пользователем таблицы
+            user_tables_id = [value[0] for value in user_tables] # список номеров отслеживаемых таблиц
 
             if len(user_tables_id) == 0: # если пользователь не отслеживает ни одной таблицы 
                 text_2 = await bot_messages("empty_table_list", language)
@@ -403,15 +661,17 @@ async def manage_table(message: types.Message, state: FSMContext):
     удаления таблицы из базы данных
     """
     user_id = message.chat.id
-    connection = await db_connection_check(host, port, user, password, user_id)
-    user_number = await extraction_query(connection, user_id) # номер пользователя в базе
-    user_tables_id = [value[0] for value in await user_id_tables(connection, user_number)] # кол-во отслеживаемых пользователем таблиц
+    user_number = await cached_user_number(user_id) # номер пользователя в базе
+    user_tables_id = [value[0] for value in await cached_tracked_tables(user_number)] # номера отслеживаемых пользователем таблиц
     try:
         table_id = int(message.text)
         if table_id in user_tables_id: # если пользователь ввел номер таблицы и она присутствует в перечне, то функция delete_spreadsheets удаляет ее из бд
             text_1 = await bot_messages("succes_delete", language)
 
-            await delete_spreadsheets(connection, table_id, user_number)
+            async with acquire_connection() as connection:
+                await delete_spreadsheets(connection, table_id, user_number)
+            if BOT_ROLE == 'all': # процессы опроса сами снимают удаленные подписки при следующей синхронизации
+                scheduler.remove_job(table_id) # отмена опроса удаленной таблицы
             await bot.send_message(chat_id=message.chat.id, text=text_1)
             await state.finish()
 
@@ -422,7 +682,7 @@ async def manage_table(message: types.Message, state: FSMContext):
             await bot.send_message(chat_id=message.chat.id, text=text_2)
             await state.finish()
 
-        elif len(user_tables_id) == 0: # если user_id_tables возвращает пустой список, пользователю направляется сообщение о том, что его список таблиц пуст
+        elif len(user_tables_id) == 0: # если у пользователя нет отслеживаемых таблиц, пользователю направляется сообщение о том, что его список таблиц пуст
             text_3 = await bot_messages("empty_table_list", language)
 
             await bot.send_message(chat_id=message.chat.id, text=text_3)
@@ -432,6 +692,161 @@ async def manage_table(message: types.Message, state: FSMContext):
         text_4 = await bot_messages("input_check", language)
         await bot.send_message(chat_id=message.chat.id, text=text_4)
 
+async def restore_jobs() -> None:
+    """
+    Регистрация в планировщике всех отслеживаемых таблиц из базы после запуска бота.
+    Первые опросы равномерно распределяются по окну WARMUP_WINDOW, чтобы не обращаться к сотням таблиц одновременно.
+    Таблицы отсортированы по названию, поэтому подписки на одну таблицу получают близкие задержки
+    и опрашиваются одним запросом
+    """
+    try:
+        async with acquire_connection() as connection:
+            rows = await all_tracked_tables(connection) or []
+
+        for index, (table_id, user_id, table_name, sheet_number, user_range, interval_value) in enumerate(rows):
+            delay = WARMUP_WINDOW * index / len(rows)
+            scheduler.add_job(TrackingJob(table_id, user_id, table_name, sheet_number, user_range, interval_value), delay)
+        log_debug(f'{len(rows)} tracked tables have restored')
+
+    except Exception as ex:
+        log_error(f"Respone from restore_jobs: {ex}")
+
+async def sync_jobs(shards: set[int]) -> None:
+    """
+    Приведение подписок в планировщике процесса опроса к его шардам: новые подписки и подписки из полученных шардов
+    добавляются с задержками, распределенными по окну WARMUP_WINDOW, подписки из переданных другим процессам шардов
+    и удаленные пользователями подписки снимаются. Подписки, у которых в базе изменились таблица, лист, диапазон
+    или пользователь (например, номер переиспользован), регистрируются заново, при изменении интервала опрос переносится.
+    Остальные подписки сохраняют свои снимки и расписание
+    """
+    try:
+        async with acquire_connection() as connection:
+            rows = await shard_tracked_tables(connection, SHARD_COUNT, sorted(shards))
+        if rows is None: # база недоступна, подписки не меняются до следующей синхронизации
+            return
+
+        current = {row[0] for row in rows}
+        for job in scheduler.jobs():
+            if job.job_id not in current:
+                scheduler.remove_job(job.job_id)
+
+        new_rows = []
+        for row in rows:
+            table_id, user_id, table_name, sheet_number, user_range, interval_value = row
+            job = scheduler.get_job(table_id)
+            if job is None or (job.user_id, job.table_name, job.sheet_number, job.user_range) != (user_id, table_name, sheet_number, user_range):
+                new_rows.append(row) # add_job заменяет подписку с тем же номером вместе со снимком
+            elif job.interval_value != interval_value:
+                if job.running: # новый интервал применится при постановке в очередь после опроса
+                    job.interval_value = job.current_interval = interval_value
+                else:
+                    remaining = max(job.next_run - time.monotonic(), 0)
+                    scheduler.reschedule(table_id, interval_value, min(remaining, interval_value))
+        for index, (table_id, user_id, table_name, sheet_number, user_range, interval_value) in enumerate(new_rows):
+            delay = WARMUP_WINDOW * index / len(new_rows)
+            scheduler.add_job(TrackingJob(table_id, user_id, table_name, sheet_number, user_range, interval_value), delay)
+        if new_rows:
+            log_debug(f'{len(new_rows)} tracked tables have added from {len(shards)} shards')
+
+    except Exception as ex:
+        log_error(f"Respone from sync_jobs: {ex}")
+
+# шарды подписок, которые опрашивает этот процесс (только в режиме BOT_ROLE = 'poller')
+leases = LeaseManager(WORKER_ID, SHARD_COUNT, LEASE_TTL, LEASE_RENEW_INTERVAL, sync_jobs)
+
+def tracked_snapshots_nbytes() -> int:
+    """
+    Память, занятая снимками всех подписок. Общие снимки подписок с одинаковым ключом учитываются один раз
+    """
+    snapshots_by_id = {id(job.snapshot): job.snapshot for job in scheduler.jobs() if job.snapshot is not None}
+    return sum(snapshot_nbytes(snapshot) for snapshot in snapshots_by_id.values())
+
+# метрики, значения которых вычисляются при каждом запросе к /metrics
+Gauge('sheets_bot_subscriptions', 'Subscriptions registered in the scheduler').set_function(lambda: len(scheduler))
+Gauge('sheets_bot_scheduler_lag_seconds', 'Delay of the last dispatched poll behind its due time').set_function(lambda: scheduler.stats['lag'])
+Gauge('sheets_bot_scheduler_overdue_jobs', 'Subscriptions past their due time and not yet polled').set_function(scheduler.overdue)
+Counter('sheets_bot_scheduler_polls_total', 'Poll groups dispatched by the scheduler').set_function(lambda: scheduler.stats['dispatched'])
+Gauge('sheets_bot_google_api_waiting', 'Google API requests waiting for quota').set_function(lambda: governor.stats['waiting'])
+Counter('sheets_bot_google_api_calls_total', 'Google API requests sent').set_function(lambda: governor.stats['calls'])
+Counter('sheets_bot_google_api_quota_errors_total', 'Google API quota errors (429 / RESOURCE_EXHAUSTED)').set_function(lambda: governor.stats['quota_errors'])
+Gauge('sheets_bot_notifier_pending_lines', 'Change lines waiting for the debounce window').set_function(lambda: notifier.pending)
+Gauge('sheets_bot_outbox_depth', 'Notifications loaded from the outbox and waiting for delivery').set_function(lambda: outbox.depth)
+Gauge('sheets_bot_db_pool_used', 'Database connections in use').set_function(lambda: pool_stats().get('used', 0))
+Gauge('sheets_bot_db_pool_waiting', 'Handlers waiting for a database connection').set_function(lambda: pool_stats().get('waiting', 0))
+Gauge('sheets_bot_snapshot_bytes', 'Approximate memory held by subscription snapshots').set_function(tracked_snapshots_nbytes)
+Gauge('sheets_bot_background_tasks', 'Background tasks such as snapshot saves').set_function(lambda: len(background_tasks))
+Gauge('sheets_bot_webhook_updates_in_flight', 'Webhook updates being processed').set_function(lambda: update_limiter.in_flight)
+Gauge('sheets_bot_owned_shards', 'Subscription shards leased by this poller').set_function(lambda: len(leases.shards))
+
+metrics_runner = None
+
+async def on_startup(dispatcher: Dispatcher) -> None:
+    """
+    Запуск сервера метрик и компонентов процесса в зависимости от BOT_ROLE:
+    all - обработчики, планировщик со всеми подписками из базы и доставка уведомлений в одном процессе;
+    frontend - обработчики и доставка уведомлений из очереди в базе, без опроса таблиц;
+    poller - опрос таблиц из арендованных шардов, уведомления только записываются в очередь
+    """
+    global metrics_runner
+    if METRICS_PORT: # метрики в формате Prometheus на http://METRICS_HOST:METRICS_PORT/metrics
+        metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT, METRICS_PORT_SPAN)
+    await create_db_pool(host, port, user, password, DB_POOL_MINSIZE, DB_POOL_MAXSIZE, DB_ACQUIRE_TIMEOUT, DB_POOL_RECYCLE)
+    if BOT_ROLE == 'all':
+        await restore_jobs()
+    if BOT_ROLE in ('all', 'poller'):
+        scheduler.start()
+    if BOT_ROLE == 'poller':
+        leases.start()
+    if BOT_ROLE in ('all', 'frontend'):
+        outbox.start()
+
+async def on_shutdown(dispatcher: Dispatcher) -> None:
+    await scheduler.stop()
+    if BOT_ROLE == 'poller': # шарды освобождаются после остановки опросов, чтобы их сразу забрали другие процессы
+        await leases.stop()
+    await notifier.close()
+    await outbox.stop()
+    await close_db_pool()
+    shutdown_diff_pool()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+
+async def on_startup_webhook(dispatcher: Dispatcher) -> None:
+    """
+    Регистрация вебхука. Обновления, накопившиеся у Telegram за время перезапуска, не отбрасываются
+    """
+    await on_startup(dispatcher)
+    await bot.set_webhook(WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, max_connections=WEBHOOK_MAX_CONNECTIONS,
+                          drop_pending_updates=False, secret_token=WEBHOOK_SECRET)
+    log_debug(f'Webhook has set, listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}')
+
+async def on_shutdown_webhook(dispatcher: Dispatcher) -> None:
+    """
+    Остановка после обработки уже принятых обновлений. Вебхук не удаляется,
+    чтобы Telegram копил новые обновления до запуска следующего процесса
+    """
+    await update_limiter.drain(WEBHOOK_DRAIN_TIMEOUT)
+    await on_shutdown(dispatcher)
+
+async def wait_for_signal() -> None:
+    """
+    Процесс опроса не получает обновления Telegram и работает до SIGTERM или SIGINT
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+    await stop.wait()
+
 if __name__ == '__main__':
     setup_db(host, port, user, password, db_name)
-    executor.start_polling(dp, skip_updates=True)
+    if BOT_ROLE == 'poller':
+        executor.start(dp, wait_for_signal(), on_startup=on_startup, on_shutdown=on_shutdown)
+    elif WEBHOOK_URL: # обновления от Telegram принимает встроенный сервер aiohttp
+        webhook_executor = executor.Executor(dp)
+        webhook_executor.on_startup(on_startup_webhook)
+        webhook_executor.on_shutdown(on_shutdown_webhook)
+        webhook_executor.start_webhook(WEBHOOK_PATH, request_handler=BoundedWebhookHandler,
+                                       host=WEBHOOK_HOST, port=WEBHOOK_PORT)
+    else:
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
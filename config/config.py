@@ -1,10 +1,11 @@
 import os
+import socket
 
 from dotenv import load_dotenv
 
 load_dotenv()
 
-path = '../run/secrets/token'
+path = os.getenv('TOKEN_FILE', '../run/secrets/token')
 with open(path, "r") as file:
     tg_token = file.read()
 
@@ -14,5 +15,56 @@ host = os.getenv('MYSQL_HOST')
 port = int(os.getenv('MYSQL_PORT'))
 password = os.getenv('MYSQL_ROOT_PASSWORD')
 user = os.getenv('MYSQL_USER')
-SERVICE_ACCOUNT_FILE = 'credentials/credentials.json'
+SERVICE_ACCOUNT_FILE = os.getenv('SERVICE_ACCOUNT_FILE', 'credentials/credentials.json')
 SCOPES = ['https://www.googleapis.com/auth/drive.readonly']
+POLL_CONCURRENCY = int(os.getenv('POLL_CONCURRENCY', 10)) # максимальное количество одновременных опросов таблиц
+MIN_INTERVAL = int(os.getenv('MIN_INTERVAL', 60)) # минимальный интервал опроса таблицы в секундах
+SHEETS_CACHE_SIZE = int(os.getenv('SHEETS_CACHE_SIZE', 512)) # количество сохраняемых объектов таблиц и листов
+SHEETS_CACHE_TTL = int(os.getenv('SHEETS_CACHE_TTL', 900)) # время жизни объекта таблицы в кэше в секундах
+SHEETS_WORKERS = int(os.getenv('SHEETS_WORKERS', 16)) # количество потоков для обращений к Google API
+SHEETS_TIMEOUT = float(os.getenv('SHEETS_TIMEOUT', 30)) # ограничение времени одного обращения к Google API в секундах
+BATCH_WINDOW = float(os.getenv('BATCH_WINDOW', 5)) # окно в секундах, в котором опросы одной таблицы объединяются в один запрос
+WARMUP_WINDOW = int(os.getenv('WARMUP_WINDOW', 300)) # окно в секундах, по которому распределяются первые опросы после запуска
+DB_POOL_MINSIZE = int(os.getenv('DB_POOL_MINSIZE', 1)) # минимальное количество соединений в пуле mysql
+DB_POOL_MAXSIZE = int(os.getenv('DB_POOL_MAXSIZE', 10)) # максимальное количество соединений в пуле mysql
+DB_ACQUIRE_TIMEOUT = float(os.getenv('DB_ACQUIRE_TIMEOUT', 10)) # время ожидания свободного соединения в секундах
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 3600)) # время жизни соединения в пуле в секундах
+NOTIFY_GLOBAL_RATE = float(os.getenv('NOTIFY_GLOBAL_RATE', 30)) # сообщений в секунду на весь бот (лимит Telegram)
+NOTIFY_CHAT_RATE = float(os.getenv('NOTIFY_CHAT_RATE', 1)) # сообщений в секунду в один чат (лимит Telegram)
+NOTIFY_CHAT_BURST = float(os.getenv('NOTIFY_CHAT_BURST', 3)) # допустимый всплеск сообщений в один чат
+NOTIFY_DEBOUNCE = float(os.getenv('NOTIFY_DEBOUNCE', 2)) # окно накопления изменений перед отправкой в секундах
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS', 4)) # количество обработчиков очереди уведомлений
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 8)) # количество попыток отправки уведомления
+SHEETS_QUOTA_PER_MINUTE = float(os.getenv('SHEETS_QUOTA_PER_MINUTE', 60)) # квота запросов к Google API в минуту
+SHEETS_QUOTA_BURST = float(os.getenv('SHEETS_QUOTA_BURST', 10)) # допустимый всплеск запросов к Google API
+ADAPTIVE_FACTOR = float(os.getenv('ADAPTIVE_FACTOR', 1)) # во сколько раз увеличивается интервал опроса неизменившейся таблицы, 1 - адаптивный режим выключен
+ADAPTIVE_MAX_INTERVAL = int(os.getenv('ADAPTIVE_MAX_INTERVAL', 3600)) # максимальный интервал опроса в адаптивном режиме в секундах
+STREAM_BLOCK_ROWS = int(os.getenv('STREAM_BLOCK_ROWS', 5000)) # количество строк в блоке при потоковом опросе больших листов
+STREAM_THRESHOLD_ROWS = int(os.getenv('STREAM_THRESHOLD_ROWS', 20000)) # размер листа в строках, начиная с которого динамическая подписка опрашивается потоково
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL') # адрес сервера Bot API, если не задан - api.telegram.org
+GOOGLE_API_URL = os.getenv('GOOGLE_API_URL') # адрес сервера Google API, если не задан - googleapis.com
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1') # адрес сервера метрик Prometheus
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9108)) # порт сервера метрик Prometheus, 0 - сервер не запускается
+METRICS_PORT_SPAN = int(os.getenv('METRICS_PORT_SPAN', 16)) # количество портов начиная с METRICS_PORT, которые пробуют процессы на одном хосте
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'DEBUG') # минимальный уровень записей в логе
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', 10 * 2 ** 20)) # размер файла лога в байтах, после которого он ротируется
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', 5)) # количество хранимых старых файлов лога
+LOG_ROTATE_WHEN = os.getenv('LOG_ROTATE_WHEN') # ротация по времени ('midnight', 'H', 'D'), если не задана - по размеру
+LOG_JSON = os.getenv('LOG_JSON', '0') == '1' # записи лога в формате JSON
+LOG_SAMPLE_INTERVAL = float(os.getenv('LOG_SAMPLE_INTERVAL', 60)) # окно ограничения частоты отладочных сообщений в секундах, 0 - без ограничения
+LOG_SAMPLE_BURST = int(os.getenv('LOG_SAMPLE_BURST', 20)) # количество отладочных сообщений одного места вызова в окне
+BOT_ROLE = os.getenv('BOT_ROLE', 'all') # all - один процесс, frontend - только обработчики и доставка, poller - только опрос шардов подписок
+WORKER_ID = os.getenv('WORKER_ID', f'{socket.gethostname()}-{os.getpid()}') # уникальный идентификатор процесса опроса
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', 64)) # количество шардов подписок, одинаковое для всех процессов опроса
+LEASE_TTL = int(os.getenv('LEASE_TTL', 30)) # срок аренды шарда в секундах, после которого его забирают другие процессы
+LEASE_RENEW_INTERVAL = float(os.getenv('LEASE_RENEW_INTERVAL', 10)) # период продления аренды и синхронизации подписок в секундах
+DIFF_PROCESSES = int(os.getenv('DIFF_PROCESSES', 0)) # количество процессов для сравнения больших снимков, 0 - сравнение в процессе бота
+DIFF_PROCESS_THRESHOLD = int(os.getenv('DIFF_PROCESS_THRESHOLD', 50000)) # количество сравниваемых ячеек, начиная с которого сравнение передается в пул процессов
+WEBHOOK_URL = os.getenv('WEBHOOK_URL') # внешний адрес бота (https://bot.example.com), если не задан - обновления получаются через long polling
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook') # путь, по которому Telegram отправляет обновления
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0') # адрес встроенного сервера вебхука
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8080)) # порт встроенного сервера вебхука
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') # секретный токен, который Telegram передает в заголовке каждого запроса
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', 40)) # количество одновременных соединений Telegram с вебхуком
+WEBHOOK_MAX_IN_FLIGHT = int(os.getenv('WEBHOOK_MAX_IN_FLIGHT', 64)) # количество одновременно обрабатываемых обновлений
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv('WEBHOOK_DRAIN_TIMEOUT', 30)) # время ожидания обработки принятых обновлений при остановке в секундах
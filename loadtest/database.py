@@ -0,0 +1,58 @@
+import shutil
+import socket
+import subprocess
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+import pymysql
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_mysql(host: str, port: int, user: str, password: str, timeout: float = 180) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            pymysql.connect(host=host, port=port, user=user, password=password).close()
+            return
+        except pymysql.err.OperationalError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(1)
+
+
+@contextmanager
+def disposable_mysql(image: str = 'mysql:8.0', password: str = 'loadtest',
+                     host: Optional[str] = None, port: Optional[int] = None) -> Iterator[dict]:
+    """
+    Одноразовый сервер MySQL для нагрузочного теста: контейнер docker, который удаляется после теста.
+    Бот работает с базой telegram_users под фиксированным именем, поэтому для каждого прогона нужен отдельный сервер.
+    Если передан host, используется уже запущенный сервер, его база telegram_users удаляется после теста
+
+    Возвращает переменные окружения MYSQL_*, которые читает config.config
+    """
+    container = None
+    if host is None:
+        if shutil.which('docker') is None:
+            raise RuntimeError('docker is required for a disposable database, or pass --mysql-host')
+        host, port = '127.0.0.1', free_port()
+        container = subprocess.run(['docker', 'run', '--rm', '-d', '-e', f'MYSQL_ROOT_PASSWORD={password}',
+                                    '-p', f'{host}:{port}:3306', image],
+                                   check=True, capture_output=True, text=True).stdout.strip()
+    port = port or 3306
+    try:
+        wait_for_mysql(host, port, 'root', password)
+        yield {'MYSQL_HOST': host, 'MYSQL_PORT': str(port), 'MYSQL_USER': 'root',
+               'MYSQL_ROOT_PASSWORD': password, 'MYSQL_DATABASE': 'telegram_users'}
+    finally:
+        if container is not None:
+            subprocess.run(['docker', 'rm', '-f', container], capture_output=True)
+        else:
+            with pymysql.connect(host=host, port=port, user='root', password=password) as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute('DROP DATABASE IF EXISTS telegram_users')
@@ -0,0 +1,142 @@
+import asyncio
+import json
+import random
+import re
+from collections import Counter
+from datetime import datetime, timezone
+
+from aiohttp import web
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from benchmarks.fake_sheets import FakeSpreadsheet, value_range
+
+DRIVE_NAME_QUERY = re.compile(r'name = "((?:[^"\\]|\\.)*)"')
+
+
+class FakeGoogle:
+    """
+    Локальная замена Sheets API v4 и Drive API v3 для нагрузочного тестирования. Таблицы хранятся в памяти
+    как FakeSpreadsheet, сценарий меняет ячейки через edit, и каждое изменение увеличивает версию файла в Drive.
+    Задержка ответа и доля ответов 429 задаются параметрами latency и error_rate, количество строк сетки
+    листов - параметром grid_rows (строки ниже данных пустые, для их диапазонов API не возвращает values)
+
+    Бот подключается к серверу через переменную окружения GOOGLE_API_URL и файл сервисного аккаунта,
+    созданный write_service_account
+    """
+    def __init__(self, latency: float = 0, error_rate: float = 0, retry_after: int = 1, seed: int = 0,
+                 grid_rows: int = 1000):
+        self.latency = latency
+        self.grid_rows = grid_rows
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.calls: Counter = Counter()
+        self.spreadsheets: dict[str, FakeSpreadsheet] = {} # таблицы по идентификатору
+        self._versions: Counter = Counter()
+        self._modified: dict[str, str] = {}
+        self._random = random.Random(seed)
+        self.app = web.Application(middlewares=[self._faults])
+        self.app.router.add_post('/token', self._token)
+        self.app.router.add_get('/drive/v3/files', self._drive_list)
+        self.app.router.add_get('/drive/v3/files/{id}', self._drive_get)
+        self.app.router.add_get('/v4/spreadsheets/{id}', self._metadata)
+        self.app.router.add_get('/v4/spreadsheets/{id}/values:batchGet', self._values_batch_get)
+        self.app.router.add_get('/v4/spreadsheets/{id}/values/{range:.+}', self._values_get)
+
+    def add_spreadsheet(self, title: str, values: list) -> FakeSpreadsheet:
+        spreadsheet = FakeSpreadsheet(f'fake-{len(self.spreadsheets) + 1}', title)
+        spreadsheet.add_worksheet(values, rows=self.grid_rows)
+        self.spreadsheets[spreadsheet.id] = spreadsheet
+        self._touch(spreadsheet.id)
+        return spreadsheet
+
+    def edit(self, spreadsheet: FakeSpreadsheet, row: int, col: int, value: str, sheet_index: int = 0) -> None:
+        """
+        Изменение ячейки (строка и столбец с нуля) с увеличением версии файла
+        """
+        values = spreadsheet.worksheets[sheet_index].values
+        while len(values) <= row:
+            values.append([])
+        line = values[row]
+        line.extend([''] * (col + 1 - len(line)))
+        line[col] = value
+        self._touch(spreadsheet.id)
+
+    def _touch(self, spreadsheet_id: str) -> None:
+        self._versions[spreadsheet_id] += 1
+        self._modified[spreadsheet_id] = datetime.now(timezone.utc).isoformat(timespec='milliseconds')
+
+    @web.middleware
+    async def _faults(self, request: web.Request, handler) -> web.StreamResponse:
+        if request.path != '/token':
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if self.error_rate and self._random.random() < self.error_rate:
+                self.calls['429'] += 1
+                return web.json_response(
+                    {'error': {'code': 429, 'message': 'Quota exceeded', 'status': 'RESOURCE_EXHAUSTED'}},
+                    status=429, headers={'Retry-After': str(self.retry_after)})
+        return await handler(request)
+
+    def _spreadsheet(self, request: web.Request) -> FakeSpreadsheet:
+        spreadsheet = self.spreadsheets.get(request.match_info['id'])
+        if spreadsheet is None:
+            raise web.HTTPNotFound(text=json.dumps({'error': {'code': 404, 'message': 'Requested entity was not found.',
+                                                              'status': 'NOT_FOUND'}}),
+                                   content_type='application/json')
+        return spreadsheet
+
+    async def _token(self, request: web.Request) -> web.Response:
+        self.calls['token'] += 1
+        return web.json_response({'access_token': 'loadtest', 'expires_in': 3600, 'token_type': 'Bearer'})
+
+    async def _drive_list(self, request: web.Request) -> web.Response:
+        self.calls['drive.files.list'] += 1
+        match = DRIVE_NAME_QUERY.search(request.query.get('q', ''))
+        title = match.group(1).replace('\\"', '"') if match else None
+        files = [{'id': spreadsheet.id, 'name': spreadsheet.title, 'createdTime': self._modified[spreadsheet.id],
+                  'modifiedTime': self._modified[spreadsheet.id]}
+                 for spreadsheet in self.spreadsheets.values() if title is None or spreadsheet.title == title]
+        return web.json_response({'kind': 'drive#fileList', 'files': files})
+
+    async def _drive_get(self, request: web.Request) -> web.Response:
+        self.calls['drive.files.get'] += 1
+        spreadsheet = self._spreadsheet(request)
+        return web.json_response({'version': str(self._versions[spreadsheet.id]),
+                                  'modifiedTime': self._modified[spreadsheet.id]})
+
+    async def _metadata(self, request: web.Request) -> web.Response:
+        self.calls['sheets.get'] += 1
+        spreadsheet = self._spreadsheet(request)
+        sheets = [{'properties': {'sheetId': sheets.id, 'title': sheets.title, 'index': index, 'sheetType': 'GRID',
+                                  'gridProperties': {'rowCount': sheets.row_count,
+                                                     'columnCount': max(sheets.col_count, 26)}}}
+                  for index, sheets in enumerate(spreadsheet.worksheets)]
+        return web.json_response({'spreadsheetId': spreadsheet.id, 'sheets': sheets,
+                                  'properties': {'title': spreadsheet.title, 'locale': 'en_US', 'timeZone': 'Etc/GMT'}})
+
+    async def _values_get(self, request: web.Request) -> web.Response:
+        self.calls['sheets.values.get'] += 1
+        spreadsheet = self._spreadsheet(request)
+        text = request.match_info['range']
+        return web.json_response(value_range(text, spreadsheet.read_range(text)))
+
+    async def _values_batch_get(self, request: web.Request) -> web.Response:
+        self.calls['sheets.values.batchGet'] += 1
+        spreadsheet = self._spreadsheet(request)
+        value_ranges = [value_range(text, spreadsheet.read_range(text)) for text in request.query.getall('ranges', [])]
+        return web.json_response({'spreadsheetId': spreadsheet.id, 'valueRanges': value_ranges})
+
+
+def write_service_account(path: str, token_uri: str) -> None:
+    """
+    Файл сервисного аккаунта с новым ключом RSA, токены которого выдает FakeGoogle по адресу token_uri
+    """
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    private_key = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                    serialization.NoEncryption()).decode()
+    account = {'type': 'service_account', 'project_id': 'loadtest', 'private_key_id': 'loadtest',
+               'private_key': private_key, 'client_email': 'loadtest@loadtest.iam.gserviceaccount.com',
+               'client_id': '1', 'token_uri': token_uri}
+    with open(path, 'w') as file:
+        json.dump(account, file)
@@ -0,0 +1,116 @@
+import asyncio
+import itertools
+import time
+from collections import Counter
+from typing import Optional
+
+from aiohttp import web
+
+
+class SentMessage:
+    """
+    Сообщение, отправленное ботом через sendMessage, и время его получения сервером
+    """
+    def __init__(self, chat_id: int, text: str, received: float):
+        self.chat_id = chat_id
+        self.text = text
+        self.received = received
+
+
+class FakeTelegram:
+    """
+    Локальная замена Telegram Bot API для нагрузочного тестирования. Бот получает обновления,
+    добавленные сценарием через inject_message и inject_callback, методом getUpdates,
+    а сообщения бота сохраняются и раздаются ожидающим их сценариям по чатам
+
+    Бот подключается к серверу через переменную окружения TELEGRAM_API_URL
+    """
+    def __init__(self, bot_id: int = 1):
+        self.bot_id = bot_id
+        self.calls: Counter = Counter()
+        self.sent: list[SentMessage] = []
+        self.ready = asyncio.Event() # устанавливается при первом запросе getUpdates
+        self._updates: list[dict] = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._new_updates = asyncio.Condition()
+        self._inboxes: dict[int, asyncio.Queue] = {}
+        self.app = web.Application()
+        self.app.router.add_post('/bot{token}/{method}', self._handle)
+        self.app.router.add_get('/bot{token}/{method}', self._handle)
+
+    def inbox(self, chat_id: int) -> asyncio.Queue:
+        return self._inboxes.setdefault(chat_id, asyncio.Queue())
+
+    async def inject_message(self, chat_id: int, text: str) -> None:
+        message = self._message(chat_id, text, self._user(chat_id))
+        if text.startswith('/'):
+            command = text.split()[0]
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+        await self._push({'message': message})
+
+    async def inject_callback(self, chat_id: int, data: str) -> None:
+        callback = {'id': str(next(self._message_ids)), 'from': self._user(chat_id), 'chat_instance': str(chat_id),
+                    'data': data, 'message': self._message(chat_id, '', {'id': self.bot_id, 'is_bot': True, 'first_name': 'bot'})}
+        await self._push({'callback_query': callback})
+
+    async def wait_messages(self, chat_id: int, count: int, timeout: float) -> list[SentMessage]:
+        """
+        Ожидание count сообщений бота в чат chat_id, не считая уведомлений об изменениях
+        """
+        inbox = self.inbox(chat_id)
+        return [await asyncio.wait_for(inbox.get(), timeout) for _ in range(count)]
+
+    def _user(self, chat_id: int) -> dict:
+        return {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}', 'language_code': 'en'}
+
+    def _message(self, chat_id: int, text: str, sender: dict) -> dict:
+        return {'message_id': next(self._message_ids), 'date': int(time.time()), 'text': text,
+                'chat': {'id': chat_id, 'type': 'private'}, 'from': sender}
+
+    async def _push(self, update: dict) -> None:
+        async with self._new_updates:
+            self._updates.append({'update_id': next(self._update_ids), **update})
+            self._new_updates.notify_all()
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        self.calls[method] += 1
+        params = dict(await request.post())
+        if not params and request.can_read_body and request.content_type == 'application/json':
+            params = await request.json()
+
+        handler = getattr(self, f'_method_{method}', None)
+        result = await handler(params) if handler is not None else True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def _method_getMe(self, params: dict) -> dict:
+        return {'id': self.bot_id, 'is_bot': True, 'first_name': 'loadtest', 'username': 'loadtest_bot'}
+
+    async def _method_getUpdates(self, params: dict) -> list:
+        self.ready.set()
+        offset = int(params.get('offset', 0))
+        timeout = float(params.get('timeout', 0))
+        async with self._new_updates:
+            if offset < 0: # пропуск накопившихся обновлений при запуске бота
+                self._updates.clear()
+                return []
+            self._updates = [update for update in self._updates if update['update_id'] >= offset]
+            if not self._updates and timeout:
+                try:
+                    await asyncio.wait_for(self._new_updates.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            return self._updates[:int(params.get('limit', 100))]
+
+    async def _method_sendMessage(self, params: dict) -> dict:
+        chat_id = int(params['chat_id'])
+        message = SentMessage(chat_id, params.get('text', ''), time.monotonic())
+        self.sent.append(message)
+        if not message.text.startswith('Table: '): # уведомления об изменениях учитываются отдельно
+            self.inbox(chat_id).put_nowait(message)
+        return self._message(chat_id, message.text, {'id': self.bot_id, 'is_bot': True, 'first_name': 'loadtest'})
+
+    def notifications(self, since: Optional[float] = None) -> list[SentMessage]:
+        return [message for message in self.sent
+                if message.text.startswith('Table: ') and (since is None or message.received >= since)]
@@ -0,0 +1,230 @@
+"""
+Сквозной нагрузочный тест бота с локальными заменами Telegram Bot API, Google Sheets/Drive API и MySQL.
+Бот запускается отдельным процессом (python bot.py) и подключается к заменам через переменные окружения,
+сценарий проводит N пользователей через /start -> добавление таблицы -> отслеживание, затем меняет ячейки
+таблиц и измеряет задержку уведомлений.
+
+Запуск из корня проекта (нужен docker для одноразового MySQL или --mysql-host):
+    python -m loadtest.run_scenario --users 200 --spreadsheets 20 --edits 50 --output load.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+from aiohttp import web
+
+from benchmarks.fake_sheets import generate_values
+from loadtest.database import disposable_mysql, free_port
+from loadtest.fake_google import FakeGoogle, write_service_account
+from loadtest.fake_telegram import FakeTelegram
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOKEN = '123456:loadtest-token'
+
+
+def percentiles(values: list[float]) -> dict:
+    """
+    Процентили по ближайшему рангу в миллисекундах
+    """
+    if not values:
+        return {'count': 0}
+    ordered = sorted(values)
+    rank = lambda q: ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered))) - 1))]
+    return {'count': len(ordered), 'p50_ms': rank(0.5) * 1000, 'p90_ms': rank(0.9) * 1000,
+            'p99_ms': rank(0.99) * 1000, 'max_ms': ordered[-1] * 1000}
+
+
+async def start_server(app: web.Application) -> tuple[web.AppRunner, str]:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    port = free_port()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    return runner, f'http://127.0.0.1:{port}'
+
+
+def user_steps(table_name: str, interval: int) -> list[tuple[str, str, str, int]]:
+    """
+    Шаги пользователя: (название шага, тип обновления, текст или данные кнопки, ожидаемое количество ответов бота)
+    """
+    return [
+        ('start', 'message', '/start', 1),
+        ('language', 'callback', 'English', 1),
+        ('account_added', 'callback', 'account_added', 1),
+        ('table_name', 'message', table_name, 1),
+        ('sheet_number', 'message', '1', 2),
+        ('dynamic', 'callback', 'dynamic', 1),
+        ('interval', 'message', str(interval), 1),
+        ('starting', 'callback', 'starting', 1),
+    ]
+
+
+async def onboard(telegram: FakeTelegram, chat_id: int, table_name: str, args: argparse.Namespace,
+                  latencies: dict, failures: list) -> bool:
+    """
+    Прохождение пользователем всех шагов подключения таблицы, задержка каждого шага - время от отправки
+    обновления до последнего ответа бота
+    """
+    for step, kind, payload, replies in user_steps(table_name, args.interval):
+        started = time.monotonic()
+        if kind == 'message':
+            await telegram.inject_message(chat_id, payload)
+        else:
+            await telegram.inject_callback(chat_id, payload)
+        try:
+            messages = await telegram.wait_messages(chat_id, replies, args.step_timeout)
+        except asyncio.TimeoutError:
+            failures.append({'chat_id': chat_id, 'step': step})
+            return False
+        latencies[step].append(messages[-1].received - started)
+    return True
+
+
+async def run_scenario(args: argparse.Namespace, database_env: dict, workdir: str) -> dict:
+    telegram = FakeTelegram()
+    google = FakeGoogle(latency=args.latency / 1000, error_rate=args.error_rate, seed=args.seed,
+                        grid_rows=args.grid_rows)
+    telegram_runner, telegram_url = await start_server(telegram.app)
+    google_runner, google_url = await start_server(google.app)
+
+    rng = random.Random(args.seed)
+    spreadsheets = [google.add_spreadsheet(f'loadtest-{index}', generate_values(args.rows, args.cols, args.seed + index))
+                    for index in range(args.spreadsheets)]
+
+    token_file = os.path.join(workdir, 'token')
+    with open(token_file, 'w') as file:
+        file.write(TOKEN)
+    account_file = os.path.join(workdir, 'credentials.json')
+    write_service_account(account_file, f'{google_url}/token')
+
+    env = {**os.environ, **database_env, 'TOKEN_FILE': token_file, 'SERVICE_ACCOUNT_FILE': account_file,
+           'TELEGRAM_API_URL': telegram_url, 'GOOGLE_API_URL': google_url,
+           'STREAM_THRESHOLD_ROWS': str(args.stream_threshold), 'STREAM_BLOCK_ROWS': str(args.stream_block_rows)}
+    with open(os.path.join(workdir, 'bot.log'), 'w') as bot_log:
+        process = await asyncio.create_subprocess_exec(sys.executable, 'bot.py', cwd=ROOT, env=env,
+                                                       stdout=bot_log, stderr=bot_log)
+    try:
+        await asyncio.wait_for(telegram.ready.wait(), args.startup_timeout)
+
+        # подключение пользователей, не больше args.concurrency одновременно
+        latencies = defaultdict(list)
+        failures = []
+        semaphore = asyncio.Semaphore(args.concurrency)
+        subscribers = defaultdict(list) # чаты, отслеживающие таблицу
+
+        async def user(index: int) -> None:
+            chat_id = 10 ** 6 + index
+            spreadsheet = spreadsheets[index % len(spreadsheets)]
+            async with semaphore:
+                if await onboard(telegram, chat_id, spreadsheet.title, args, latencies, failures):
+                    subscribers[spreadsheet.id].append(chat_id)
+
+        onboarding_started = time.monotonic()
+        await asyncio.gather(*(user(index) for index in range(args.users)))
+        onboarding_time = time.monotonic() - onboarding_started
+
+        # изменения ячеек после первого опроса всех подписок
+        await asyncio.sleep(args.settle)
+        edits = []
+        for number in range(args.edits):
+            spreadsheet = rng.choice(spreadsheets)
+            google.edit(spreadsheet, rng.randrange(args.rows), rng.randrange(args.cols), f'edit-{number}')
+            edits.append((number, spreadsheet.id, time.monotonic()))
+            await asyncio.sleep(args.edit_period)
+        await asyncio.sleep(args.drain if args.drain is not None else args.interval * 60 + 30)
+
+    finally:
+        if process.returncode is None: # остановка бота с отправкой накопленных уведомлений
+            process.send_signal(signal.SIGINT)
+            try:
+                await asyncio.wait_for(process.wait(), 60)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+        await telegram_runner.cleanup()
+        await google_runner.cleanup()
+
+    # задержка уведомления: от изменения ячейки до первого уведомления подписчику с новым значением
+    received = defaultdict(list)
+    for message in telegram.notifications():
+        for line in message.text.split('\n')[1:]:
+            value = line.rsplit(' -> ', 1)[-1]
+            if value.startswith('edit-'):
+                received[(message.chat_id, value)].append(message.received)
+
+    lags = []
+    expected = 0
+    for number, spreadsheet_id, edited in edits:
+        for chat_id in subscribers[spreadsheet_id]:
+            expected += 1
+            times = [moment for moment in received.get((chat_id, f'edit-{number}'), []) if moment >= edited]
+            if times:
+                lags.append(min(times) - edited)
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    return {
+        'args': vars(args),
+        'onboarding': {'users': args.users, 'completed': args.users - len(failures), 'seconds': onboarding_time,
+                       'failures': failures[:100]},
+        'handler_latency': {'all': percentiles(all_latencies),
+                            **{step: percentiles(values) for step, values in latencies.items()}},
+        'notification_lag': {**percentiles(lags), 'expected': expected, 'delivered': len(lags)},
+        'notifications_sent': len(telegram.notifications()),
+        'api_calls': {'telegram': dict(telegram.calls), 'google': dict(google.calls)},
+        'bot_exit_code': process.returncode,
+        'bot_log': os.path.join(workdir, 'bot.log'),
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='End-to-end load test of the bot against local fake services')
+    parser.add_argument('--users', type=int, default=100, help='simulated users, each tracks one spreadsheet')
+    parser.add_argument('--spreadsheets', type=int, default=10, help='distinct spreadsheets shared by the users')
+    parser.add_argument('--rows', type=int, default=200, help='rows per spreadsheet')
+    parser.add_argument('--cols', type=int, default=10, help='columns per spreadsheet')
+    parser.add_argument('--grid-rows', type=int, default=1000,
+                        help='grid rows per worksheet, rows below the data are empty')
+    parser.add_argument('--stream-threshold', type=int, default=500,
+                        help='grid rows above which the bot polls a sheet in blocks')
+    parser.add_argument('--stream-block-rows', type=int, default=100, help='block size of streamed polls')
+    parser.add_argument('--interval', type=int, default=1, help='tracking interval entered by users, minutes')
+    parser.add_argument('--concurrency', type=int, default=50, help='users going through onboarding at once')
+    parser.add_argument('--edits', type=int, default=20, help='scripted cell edits after onboarding')
+    parser.add_argument('--edit-period', type=float, default=1, help='seconds between edits')
+    parser.add_argument('--settle', type=float, default=10, help='seconds to wait for first polls before editing')
+    parser.add_argument('--drain', type=float, help='seconds to wait for notifications, interval + 30 s by default')
+    parser.add_argument('--latency', type=float, default=0, help='added Google API latency, ms')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of Google API requests answered with 429')
+    parser.add_argument('--step-timeout', type=float, default=30, help='seconds to wait for a bot reply')
+    parser.add_argument('--startup-timeout', type=float, default=120, help='seconds to wait for the bot to start polling')
+    parser.add_argument('--mysql-host', help='use a running throwaway MySQL server instead of a docker container')
+    parser.add_argument('--mysql-port', type=int, default=3306)
+    parser.add_argument('--mysql-password', default='loadtest')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='JSON file for the report, stdout if omitted')
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix='loadtest-')
+    with disposable_mysql(password=args.mysql_password, host=args.mysql_host,
+                          port=args.mysql_port if args.mysql_host else None) as database_env:
+        report = asyncio.run(run_scenario(args, database_env, workdir))
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
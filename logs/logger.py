@@ -1,23 +1,135 @@
+import atexit
+import json
 import logging
+import logging.handlers
+import queue
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Optional
+
+LOG_FILE = 'logs/logs.log'
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
 
-handler = logging.FileHandler('logs/logs.log')
-handler.setLevel(logging.DEBUG)
-
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
-
-logger.addHandler(handler)
-
 logger_list = ['aiogram', 'asyncio', 'urllib3', "google.auth", 'pymorphy2']
 
 for i in logger_list:
     logging.getLogger(i).setLevel('ERROR')
 
+
+class JsonFormatter(logging.Formatter):
+    """
+    Структурированный формат: одна JSON запись на строку с временем, уровнем, источником и текстом сообщения
+    """
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+                 'level': record.levelname, 'logger': record.name, 'site': f'{record.module}:{record.lineno}',
+                 'message': record.getMessage()}
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class CallSiteSampler:
+    """
+    Ограничение частоты сообщений отдельно для каждого места вызова: не более burst сообщений за interval секунд.
+    Количество пропущенных сообщений добавляется к следующему записанному сообщению того же места вызова,
+    поэтому частые сообщения опросов и подключений не растут вместе с количеством подписок
+
+    interval: окно в секундах, 0 - ограничение выключено
+    burst: количество сообщений одного места вызова в окне
+    """
+    def __init__(self, interval: float = 0, burst: int = 10):
+        self.interval = interval
+        self.burst = burst
+        self._sites: dict[tuple, list] = {} # место вызова -> [начало окна, записано в окне, пропущено]
+
+    def allow(self, site: tuple) -> tuple[bool, int]:
+        """
+        Можно ли записать сообщение из места вызова site, и сколько сообщений из него пропущено до этого
+        """
+        if self.interval <= 0:
+            return True, 0
+        now = time.monotonic()
+        state = self._sites.get(site)
+        if state is None or now - state[0] >= self.interval:
+            suppressed = state[2] if state is not None else 0
+            self._sites[site] = [now, 1, 0]
+            return True, suppressed
+        if state[1] < self.burst:
+            state[1] += 1
+            return True, 0
+        state[2] += 1
+        return False, 0
+
+
+_queue: queue.SimpleQueue = queue.SimpleQueue()
+_queue_handler = logging.handlers.QueueHandler(_queue)
+_listener: Optional[logging.handlers.QueueListener] = None
+_sampler = CallSiteSampler()
+
+logger.addHandler(_queue_handler)
+
+
+def configure_logging(level: str = 'DEBUG', max_bytes: int = 10 * 2 ** 20, backup_count: int = 5,
+                      rotate_when: Optional[str] = None, json_format: bool = False,
+                      sample_interval: float = 0, sample_burst: int = 10, filename: str = LOG_FILE) -> None:
+    """
+    Настройка логирования. Обработчики вызывают log_debug и log_error без обращения к диску:
+    записи складываются в очередь, а в файл их пишет отдельный поток QueueListener
+
+    level: минимальный уровень записей
+    max_bytes, backup_count: размер файла, после которого он ротируется, и количество хранимых старых файлов
+    rotate_when: ротация по времени вместо размера ('midnight', 'H', 'D' и т.д., как в TimedRotatingFileHandler)
+    json_format: писать записи в формате JSON
+    sample_interval, sample_burst: не более sample_burst отладочных сообщений одного места вызова за sample_interval секунд
+    """
+    global _listener, _sampler
+    if rotate_when:
+        handler = logging.handlers.TimedRotatingFileHandler(filename, when=rotate_when, backupCount=backup_count,
+                                                            encoding='utf-8')
+    else:
+        handler = logging.handlers.RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backup_count,
+                                                       encoding='utf-8')
+    handler.setFormatter(JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT))
+
+    if _listener is not None: # записи, уже стоящие в очереди, дописываются прежним обработчиком
+        _listener.stop()
+        for old_handler in _listener.handlers:
+            old_handler.close()
+    _listener = logging.handlers.QueueListener(_queue, handler, respect_handler_level=True)
+    _listener.start()
+
+    logger.setLevel(level)
+    _sampler = CallSiteSampler(sample_interval, sample_burst)
+
+
+def _stop_listener() -> None:
+    """
+    Запись оставшихся в очереди сообщений при завершении процесса
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+configure_logging()
+atexit.register(_stop_listener)
+
 def log_debug(msg: str):
-    logger.debug(msg, exc_info=False)
+    if not logger.isEnabledFor(logging.DEBUG): # отключенный уровень не стоит даже определения места вызова
+        return
+    frame = sys._getframe(1)
+    allowed, suppressed = _sampler.allow((frame.f_code.co_filename, frame.f_lineno))
+    if not allowed:
+        return
+    if suppressed:
+        msg = f'{msg} ({suppressed} similar messages suppressed)'
+    logger.debug(msg, exc_info=False, stacklevel=2)
 
 def log_error(msg: str):
-    logger.error(msg, exc_info=False)
+    logger.error(msg, exc_info=False, stacklevel=2)
@@ -0,0 +1,78 @@
+import re
+from functools import lru_cache
+from typing import Optional
+
+A1_RANGE = re.compile(r'^([A-Z]+)([1-9][0-9]*):([A-Z]+)([1-9][0-9]*)$')
+
+
+@lru_cache(maxsize=4096)
+def column_letter(index: int) -> str:
+    """
+    Буквенное название столбца по его номеру (с единицы): 1 -> A, 27 -> AA, 52 -> AZ, 703 -> AAA
+    """
+    if index < 1:
+        raise ValueError(f'Column index must be positive: {index}')
+    letters = ''
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+
+@lru_cache(maxsize=4096)
+def column_index(letters: str) -> int:
+    """
+    Номер столбца (с единицы) по его буквенному названию: A -> 1, AZ -> 52
+    """
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - ord('A') + 1
+    return index
+
+
+def cell_name(row: int, col: int) -> str:
+    """
+    Адрес ячейки в формате A1 по номерам строки и столбца (с единицы)
+    """
+    return f'{column_letter(col)}{row}'
+
+
+def parse_range(text: str) -> Optional[dict]:
+    """
+    Разбор диапазона формата A1:B1 в словарь координат
+    {'leftcol': 'A', 'leftrow': 1, 'rightcol': 'B', 'rightrow': 1}.
+    Возвращает None, если диапазон задан некорректно или левый верхний угол правее или ниже правого нижнего
+    """
+    match = A1_RANGE.match(text)
+    if match is None:
+        return None
+    leftcol, leftrow, rightcol, rightrow = match.groups()
+    coordinates = {'leftcol': leftcol, 'leftrow': int(leftrow),
+                   'rightcol': rightcol, 'rightrow': int(rightrow)}
+    if coordinates['leftrow'] > coordinates['rightrow'] or column_index(leftcol) > column_index(rightcol):
+        return None
+    return coordinates
+
+
+def format_range(coordinates: dict) -> str:
+    """
+    Форматирование словаря координат в диапазон формата A1:B1
+    """
+    return f"{coordinates['leftcol']}{coordinates['leftrow']}:{coordinates['rightcol']}{coordinates['rightrow']}"
+
+
+def range_shape(coordinates: dict) -> tuple[int, int]:
+    """
+    Количество строк и столбцов в диапазоне
+    """
+    rows = coordinates['rightrow'] - coordinates['leftrow'] + 1
+    cols = column_index(coordinates['rightcol']) - column_index(coordinates['leftcol']) + 1
+    return rows, cols
+
+
+def range_origin(coordinates: dict) -> tuple[int, int]:
+    """
+    Номера строки и столбца (с единицы) левого верхнего угла диапазона,
+    нужны для пересчета индексов массива значений в адреса ячеек листа
+    """
+    return coordinates['leftrow'], column_index(coordinates['leftcol'])
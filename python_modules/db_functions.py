@@ -1,13 +1,124 @@
-from typing import Optional
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Iterable, Optional
 from datetime import datetime
 
 import aiomysql
 
+from python_modules.metrics import instrument
 from logs.logger import log_debug, log_error
 
-async def insert_new_users(conn: aiomysql.Connection, user_id: int, time: datetime) -> None:
+_pool: Optional[aiomysql.Pool] = None
+_acquire_timeout = 10.0
+_pre_ping = True
+_pool_stats = {'acquired': 0, 'waiting': 0, 'timeouts': 0, 'reconnects': 0}
+
+async def create_db_pool(host: str, port: int, user: str, password: str, minsize: int = 1, maxsize: int = 10,
+                         acquire_timeout: float = 10.0, pool_recycle: int = 3600, pre_ping: bool = True) -> aiomysql.Pool:
+    """
+    Создание общего для всех обработчиков пула соединений с сервером mysql
+
+    minsize, maxsize: минимальное и максимальное количество соединений в пуле
+    acquire_timeout: максимальное время ожидания свободного соединения в секундах
+    pool_recycle: время в секундах, после которого соединение пересоздается
+    pre_ping: проверка соединения перед выдачей из пула
     """
-    Добавление нового пользователя в базу данных в таблицу telegram_connections
+    global _pool, _acquire_timeout, _pre_ping
+    _acquire_timeout = acquire_timeout
+    _pre_ping = pre_ping
+    _pool = await aiomysql.create_pool(host=host, port=port, user=user, password=password,
+                                       minsize=minsize, maxsize=maxsize, pool_recycle=pool_recycle,
+                                       autocommit=True)
+    log_debug(f'Database pool has created: minsize={minsize}, maxsize={maxsize}')
+    return _pool
+
+async def close_db_pool() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.close()
+        await _pool.wait_closed()
+        _pool = None
+
+@asynccontextmanager
+async def acquire_connection() -> AsyncIterator[aiomysql.Connection]:
+    """
+    Получение соединения из пула на время блока async with. Если свободное соединение не появилось
+    за acquire_timeout секунд, возбуждается asyncio.TimeoutError
+    """
+    _pool_stats['waiting'] += 1
+    try:
+        conn = await asyncio.wait_for(_pool.acquire(), _acquire_timeout)
+    except asyncio.TimeoutError:
+        _pool_stats['timeouts'] += 1
+        log_error('Database pool acquire timed out')
+        raise
+    finally:
+        _pool_stats['waiting'] -= 1
+
+    _pool_stats['acquired'] += 1
+    try:
+        if _pre_ping:
+            try:
+                await conn.ping(reconnect=False)
+            except Exception:
+                _pool_stats['reconnects'] += 1
+                await conn.ping(reconnect=True) # соединение разорвано сервером, переподключение
+        yield conn
+    finally:
+        _pool.release(conn)
+
+def pool_stats() -> dict:
+    """
+    Состояние пула соединений: размер, свободные соединения, ожидающие соединения обработчики
+    и доля занятых соединений от максимального размера пула
+    """
+    if _pool is None:
+        return {}
+    used = _pool.size - _pool.freesize
+    return {'size': _pool.size, 'free': _pool.freesize, 'used': used,
+            'minsize': _pool.minsize, 'maxsize': _pool.maxsize,
+            'saturation': used / _pool.maxsize, **_pool_stats}
+
+_user_numbers: dict[int, int] = {} # кэш телеграм ID -> номер пользователя в базе
+_user_tables: dict[int, tuple] = {} # кэш номер пользователя -> отслеживаемые таблицы
+
+@instrument('db.cached_user_number')
+async def cached_user_number(user_id: int) -> Optional[int]:
+    """
+    Номер пользователя в базе по его телеграм ID. Номер не меняется, поэтому после первого запроса
+    берется из кэша
+    """
+    user_number = _user_numbers.get(user_id)
+    if user_number is None:
+        async with acquire_connection() as conn:
+            user_number = await extraction_query(conn, user_id)
+        if user_number is not None:
+            _user_numbers[user_id] = user_number
+    return user_number
+
+@instrument('db.cached_tracked_tables')
+async def cached_tracked_tables(user_number: int) -> tuple:
+    """
+    Отслеживаемые пользователем таблицы. Кэш сбрасывается при добавлении и удалении таблиц
+    в insert_new_sheets_info и delete_spreadsheets
+    """
+    user_tables = _user_tables.get(user_number)
+    if user_tables is None:
+        async with acquire_connection() as conn:
+            user_tables = await tracked_tables(conn, user_number)
+        if user_tables is None: # ошибка запроса не кэшируется
+            return ()
+        user_tables = tuple(user_tables)
+        _user_tables[user_number] = user_tables
+    return user_tables
+
+@instrument('db.insert_new_users')
+async def insert_new_users(conn: aiomysql.Connection, user_id: int, time: datetime) -> Optional[bool]:
+    """
+    Добавление нового пользователя в базу данных в таблицу telegram_connections одним запросом
+    по уникальному индексу user_id. Возвращает True, если пользователь подключился впервые,
+    и False, если он уже есть в базе. Игнорируется только совпадение ключа: в отличие от INSERT IGNORE,
+    ошибки выхода за диапазон столбца user_id не подавляются
 
     conn: соединение с базой данных
     user_id: телеграм ID пользователя
@@ -16,27 +127,32 @@ async def insert_new_users(conn: aiomysql.Connection, user_id: int, time: dateti
     try:
         async with conn.cursor() as cursor:
             insert_query = "INSERT INTO telegram_users.telegram_connections (user_id, connection_time)\
-                            VALUES (%s, %s)"
+                            VALUES (%s, %s) ON DUPLICATE KEY UPDATE id = id"
             val = (user_id, time)
               
             await cursor.execute(insert_query, val)
             await conn.commit()
+            if cursor.rowcount == 0: # пользователь с таким user_id уже есть
+                return False
+            _user_numbers[user_id] = cursor.lastrowid
         log_debug(f'User {user_id} has added successfully')
-        return None
+        return True
     
     except Exception as ex:
         log_debug(f"Response from insert_new_users def: {ex}")
         return None
 
+@instrument('db.insert_new_sheets_info')
 async def insert_new_sheets_info(conn: aiomysql.Connection,
                                   user_number: int,
                                   sheet_name: str,
                                   sheet_number: int,
                                   data_range: str,
                                   interval_value: int,
-                                  user_id: int) -> None:
+                                  user_id: int) -> Optional[int]:
     """
-    Добавление в базу данных информации о гугл таблице пользователя
+    Добавление в базу данных информации о гугл таблице пользователя.
+    Возвращает номер добавленной таблицы в spreadsheets_users_data
 
     conn: соединение с базой данных
     user_number: номер пользователя в базе (не путать с телеграм ID)
@@ -55,13 +171,16 @@ async def insert_new_sheets_info(conn: aiomysql.Connection,
 
             await cursor.execute(insert_query, val)
             await conn.commit()
+            table_id = cursor.lastrowid
+        _user_tables.pop(user_number, None)
         log_debug(f"User {user_id} has spreadsheet info added")
-        return None
+        return table_id
     
     except Exception as ex:
         log_error(f"Response from insert_new_sheets_info def: {ex}")
         return None
 
+@instrument('db.extraction_query')
 async def extraction_query(conn: aiomysql.Connection, user_id: int) -> None:
     """
     Извлечение номера пользователя в базе по его телеграм ID
@@ -83,6 +202,7 @@ async def extraction_query(conn: aiomysql.Connection, user_id: int) -> None:
             log_error(f"Response from extraction_query def: {ex}")
             return None
 
+@instrument('db.tracked_tables')
 async def tracked_tables(conn: aiomysql.Connection, user_number: int) -> Optional[list]:
     """
     Извлечение информации о таблицах, которые отслеживает пользователь
@@ -101,6 +221,7 @@ async def tracked_tables(conn: aiomysql.Connection, user_number: int) -> Optiona
             log_error(f"Response from tracked_tables def: {ex}")
             return None
         
+@instrument('db.delete_spreadsheets')
 async def delete_spreadsheets(conn: aiomysql.Connection, table_id: int, user_number: int) -> None:
     """
     Удаление пользовательской информации об отслеживаемой таблице. После удаления из базы
@@ -116,40 +237,327 @@ async def delete_spreadsheets(conn: aiomysql.Connection, table_id: int, user_num
                        WHERE id = %s and user_number = %s"""
             await cursor.execute(query, (table_id, user_number))
             await conn.commit()
+            _user_tables.pop(user_number, None)
             log_debug(f"User {user_number} has deleted a table")
 
         except Exception as ex:
             log_error(f"Response from delete_spreadsheets def: {ex}")
 
-async def user_id_tables(conn: aiomysql.Connection, user_number: int) -> Optional[list]:
+@instrument('db.save_snapshot')
+async def save_snapshot(conn: aiomysql.Connection, table_id: int, snapshot_data: bytes, file_version: Optional[str]) -> None:
     """
-    Получение номеров отслеживаемых пользователем таблиц
+    Сохранение последнего снимка значений ячеек отслеживаемой таблицы
 
     conn: соединение с базой данных
-    user_number: номер пользователя в базе
+    table_id: номер таблицы пользователя
+    snapshot_data: сжатый снимок значений ячеек
+    file_version: версия файла Google таблицы, с которой сделан снимок
     """
     async with conn.cursor() as cursor:
         try:
-            query = """SELECT id FROM telegram_users.spreadsheets_users_data WHERE user_number = %s"""
-            await cursor.execute(query, user_number)
-            result = await cursor.fetchall()
+            query = """INSERT INTO telegram_users.spreadsheets_snapshots
+                       (table_id, file_version, snapshot_data, updated_time)
+                       VALUES (%s, %s, %s, %s)
+                       ON DUPLICATE KEY UPDATE file_version = VALUES(file_version),
+                       snapshot_data = VALUES(snapshot_data), updated_time = VALUES(updated_time)"""
+            await cursor.execute(query, (table_id, file_version, snapshot_data, datetime.now()))
+            await conn.commit()
+            log_debug(f"Snapshot of table {table_id} has saved")
+
+        except Exception as ex:
+            log_error(f"Response from save_snapshot def: {ex}")
+
+@instrument('db.load_snapshot')
+async def load_snapshot(conn: aiomysql.Connection, table_id: int) -> Optional[tuple]:
+    """
+    Получение сохраненного снимка отслеживаемой таблицы. Возвращает (snapshot_data, file_version) или None
+
+    conn: соединение с базой данных
+    table_id: номер таблицы пользователя
+    """
+    async with conn.cursor() as cursor:
+        try:
+            query = """SELECT snapshot_data, file_version FROM telegram_users.spreadsheets_snapshots WHERE table_id = %s"""
+            await cursor.execute(query, table_id)
+            result = await cursor.fetchone()
             return result
-        
+
         except Exception as ex:
-            log_error(f"Response from user_id_tables def: {ex}")
+            log_error(f"Response from load_snapshot def: {ex}")
+            return None
 
-async def tg_user_id_list(conn: aiomysql.Connection) -> Optional[list]:
+@instrument('db.all_tracked_tables')
+async def all_tracked_tables(conn: aiomysql.Connection) -> Optional[list]:
     """
-    Получение списка подсоединенных к боту пользователей
+    Получение всех отслеживаемых таблиц вместе с телеграм ID их владельцев одним запросом.
+    Используется для восстановления опроса таблиц после перезапуска бота
 
     conn: соединение с базой данных
     """
     async with conn.cursor() as cursor:
         try:
-            query = """SELECT user_id FROM telegram_users.telegram_connections"""
+            query = """SELECT s.id, c.user_id, s.spreadsheets_name, s.sheet_number, s.data_range, s.interval_value
+                       FROM telegram_users.spreadsheets_users_data AS s
+                       JOIN telegram_users.telegram_connections AS c ON s.user_number = c.id
+                       ORDER BY s.spreadsheets_name"""
             await cursor.execute(query)
             result = await cursor.fetchall()
             return result
-        
+
+        except Exception as ex:
+            log_error(f"Response from all_tracked_tables def: {ex}")
+            return None
+
+@instrument('db.shard_tracked_tables')
+async def shard_tracked_tables(conn: aiomysql.Connection, shard_count: int, shard_ids: list[int]) -> Optional[list]:
+    """
+    Отслеживаемые таблицы, относящиеся к шардам shard_ids, в том же формате, что и all_tracked_tables.
+    Шард подписки - CRC32 названия таблицы по модулю shard_count, поэтому все подписки на одну таблицу
+    попадают в один процесс опроса и опрашиваются одним запросом
+
+    conn: соединение с базой данных
+    shard_count: количество шардов подписок
+    shard_ids: номера шардов
+    """
+    if not shard_ids:
+        return []
+    async with conn.cursor() as cursor:
+        try:
+            query = """SELECT s.id, c.user_id, s.spreadsheets_name, s.sheet_number, s.data_range, s.interval_value
+                       FROM telegram_users.spreadsheets_users_data AS s
+                       JOIN telegram_users.telegram_connections AS c ON s.user_number = c.id
+                       WHERE CRC32(s.spreadsheets_name) %% %s IN ({})
+                       ORDER BY s.spreadsheets_name""".format(', '.join(['%s'] * len(shard_ids)))
+            await cursor.execute(query, (shard_count, *shard_ids))
+            result = await cursor.fetchall()
+            return result
+
+        except Exception as ex:
+            log_error(f"Response from shard_tracked_tables def: {ex}")
+            return None
+
+@instrument('db.enqueue_notification')
+async def enqueue_notification(conn: aiomysql.Connection, chat_id: int, text: str) -> Optional[int]:
+    """
+    Добавление уведомления в очередь исходящих сообщений. Возвращает номер уведомления
+
+    conn: соединение с базой данных
+    chat_id: телеграм ID получателя
+    text: текст сообщения
+    """
+    async with conn.cursor() as cursor:
+        try:
+            now = datetime.now()
+            query = """INSERT INTO telegram_users.notifications_outbox
+                       (chat_id, message_text, attempts, next_attempt, created_time)
+                       VALUES (%s, %s, 0, %s, %s)"""
+            await cursor.execute(query, (chat_id, text, now, now))
+            await conn.commit()
+            return cursor.lastrowid
+
+        except Exception as ex:
+            log_error(f"Response from enqueue_notification def: {ex}")
+            return None
+
+@instrument('db.due_notifications')
+async def due_notifications(conn: aiomysql.Connection, limit: int, per_chat: int,
+                            exclude_chats: Iterable[int] = ()) -> Optional[list]:
+    """
+    Получение уведомлений, время отправки которых наступило: не больше per_chat первых уведомлений каждого чата,
+    сначала первые уведомления всех чатов, затем вторые и т.д., поэтому чат с большой очередью
+    не занимает всю выборку и не задерживает загрузку остальных чатов
+
+    conn: соединение с базой данных
+    limit: максимальное количество уведомлений
+    per_chat: максимальное количество уведомлений одного чата
+    exclude_chats: чаты, уведомления которых уже загружены или отложены
+    """
+    exclude_chats = list(exclude_chats)
+    exclude = 'AND chat_id NOT IN ({})'.format(', '.join(['%s'] * len(exclude_chats))) if exclude_chats else ''
+    async with conn.cursor() as cursor:
+        try:
+            query = f"""SELECT id, chat_id, message_text, attempts FROM (
+                            SELECT id, chat_id, message_text, attempts,
+                                   ROW_NUMBER() OVER (PARTITION BY chat_id ORDER BY id) AS position
+                            FROM telegram_users.notifications_outbox
+                            WHERE next_attempt <= %s {exclude}) AS due
+                        WHERE position <= %s ORDER BY position, id LIMIT %s"""
+            await cursor.execute(query, (datetime.now(), *exclude_chats, per_chat, limit))
+            result = await cursor.fetchall()
+            return result
+
+        except Exception as ex:
+            log_error(f"Response from due_notifications def: {ex}")
+            return None
+
+@instrument('db.delete_notification', failed=lambda result: result is None)
+async def delete_notification(conn: aiomysql.Connection, notification_id: int) -> Optional[bool]:
+    """
+    Удаление доставленного или отброшенного уведомления из очереди. Возвращает None, если удалить не удалось
+
+    conn: соединение с базой данных
+    notification_id: номер уведомления
+    """
+    async with conn.cursor() as cursor:
+        try:
+            query = """DELETE FROM telegram_users.notifications_outbox WHERE id = %s"""
+            await cursor.execute(query, notification_id)
+            await conn.commit()
+            return True
+
+        except Exception as ex:
+            log_error(f"Response from delete_notification def: {ex}")
+            return None
+
+@instrument('db.postpone_notification')
+async def postpone_notification(conn: aiomysql.Connection, notification_ids: list[int], attempts: int,
+                                next_attempt: datetime) -> None:
+    """
+    Перенос отправки уведомлений после неудачной попытки
+
+    conn: соединение с базой данных
+    notification_ids: номера уведомлений
+    attempts: количество сделанных попыток
+    next_attempt: время следующей попытки
+    """
+    if not notification_ids:
+        return
+    async with conn.cursor() as cursor:
+        try:
+            query = """UPDATE telegram_users.notifications_outbox SET attempts = GREATEST(attempts, %s), next_attempt = %s
+                       WHERE id IN ({})""".format(', '.join(['%s'] * len(notification_ids)))
+            await cursor.execute(query, (attempts, next_attempt, *notification_ids))
+            await conn.commit()
+
+        except Exception as ex:
+            log_error(f"Response from postpone_notification def: {ex}")
+
+@instrument('db.init_leases')
+async def init_leases(conn: aiomysql.Connection, shard_count: int) -> Optional[bool]:
+    """
+    Создание строк аренды для шардов с 0 по shard_count - 1, если их еще нет.
+    Возвращает True, если строки созданы, или None при ошибке
+
+    conn: соединение с базой данных
+    shard_count: количество шардов подписок
+    """
+    async with conn.cursor() as cursor:
+        try:
+            query = """INSERT IGNORE INTO telegram_users.poller_leases (shard_id, worker_id, expires_time)
+                       VALUES (%s, NULL, NOW())"""
+            await cursor.executemany(query, [(shard_id,) for shard_id in range(shard_count)])
+            await conn.commit()
+            return True
+
+        except Exception as ex:
+            log_error(f"Response from init_leases def: {ex}")
+
+@instrument('db.renew_leases')
+async def renew_leases(conn: aiomysql.Connection, worker_id: str, lease_ttl: int) -> Optional[list]:
+    """
+    Продление аренды всех шардов процесса worker_id и отметка о том, что процесс работает.
+    Время считается по часам сервера базы, чтобы расхождение часов процессов не влияло на аренду.
+    Возвращает номера шардов, которые остались за процессом
+
+    conn: соединение с базой данных
+    worker_id: идентификатор процесса опроса
+    lease_ttl: срок аренды в секундах
+    """
+    async with conn.cursor() as cursor:
+        try:
+            await cursor.execute("""INSERT INTO telegram_users.poller_workers (worker_id, heartbeat_time) VALUES (%s, NOW())
+                                    ON DUPLICATE KEY UPDATE heartbeat_time = NOW()""", worker_id)
+            await cursor.execute("""UPDATE telegram_users.poller_leases SET expires_time = NOW() + INTERVAL %s SECOND
+                                    WHERE worker_id = %s AND expires_time >= NOW()""", (lease_ttl, worker_id))
+            await cursor.execute("""SELECT shard_id FROM telegram_users.poller_leases
+                                    WHERE worker_id = %s AND expires_time >= NOW()""", worker_id)
+            result = await cursor.fetchall()
+            await conn.commit()
+            return [row[0] for row in result]
+
+        except Exception as ex:
+            log_error(f"Response from renew_leases def: {ex}")
+            return None
+
+@instrument('db.alive_workers')
+async def alive_workers(conn: aiomysql.Connection, lease_ttl: int) -> Optional[int]:
+    """
+    Количество процессов опроса, отметившихся за последние lease_ttl секунд.
+    Записи давно остановленных процессов удаляются
+
+    conn: соединение с базой данных
+    lease_ttl: срок аренды в секундах
+    """
+    async with conn.cursor() as cursor:
+        try:
+            await cursor.execute("""DELETE FROM telegram_users.poller_workers
+                                    WHERE heartbeat_time < NOW() - INTERVAL %s SECOND""", lease_ttl * 10)
+            await cursor.execute("""SELECT COUNT(*) FROM telegram_users.poller_workers
+                                    WHERE heartbeat_time >= NOW() - INTERVAL %s SECOND""", lease_ttl)
+            result = await cursor.fetchone()
+            await conn.commit()
+            return result[0]
+
+        except Exception as ex:
+            log_error(f"Response from alive_workers def: {ex}")
+            return None
+
+@instrument('db.claim_shards')
+async def claim_shards(conn: aiomysql.Connection, worker_id: str, count: int, lease_ttl: int) -> None:
+    """
+    Захват не более count свободных шардов или шардов с истекшей арендой. Условие на свободный шард
+    проверяется в том же запросе UPDATE, поэтому один шард не может достаться двум процессам
+
+    conn: соединение с базой данных
+    worker_id: идентификатор процесса опроса
+    count: количество шардов, которые нужно захватить
+    lease_ttl: срок аренды в секундах
+    """
+    if count <= 0:
+        return
+    async with conn.cursor() as cursor:
+        try:
+            query = """UPDATE telegram_users.poller_leases SET worker_id = %s, expires_time = NOW() + INTERVAL %s SECOND
+                       WHERE worker_id IS NULL OR expires_time < NOW() ORDER BY shard_id LIMIT %s"""
+            await cursor.execute(query, (worker_id, lease_ttl, count))
+            await conn.commit()
+
+        except Exception as ex:
+            log_error(f"Response from claim_shards def: {ex}")
+
+@instrument('db.release_shards')
+async def release_shards(conn: aiomysql.Connection, worker_id: str, shard_ids: list[int]) -> None:
+    """
+    Освобождение шардов процессом worker_id, например при перераспределении шардов или остановке процесса
+
+    conn: соединение с базой данных
+    worker_id: идентификатор процесса опроса
+    shard_ids: номера освобождаемых шардов
+    """
+    if not shard_ids:
+        return
+    async with conn.cursor() as cursor:
+        try:
+            query = """UPDATE telegram_users.poller_leases SET worker_id = NULL, expires_time = NOW()
+                       WHERE worker_id = %s AND shard_id IN ({})""".format(', '.join(['%s'] * len(shard_ids)))
+            await cursor.execute(query, (worker_id, *shard_ids))
+            await conn.commit()
+
+        except Exception as ex:
+            log_error(f"Response from release_shards def: {ex}")
+
+@instrument('db.remove_worker')
+async def remove_worker(conn: aiomysql.Connection, worker_id: str) -> None:
+    """
+    Удаление записи об остановленном процессе опроса
+
+    conn: соединение с базой данных
+    worker_id: идентификатор процесса опроса
+    """
+    async with conn.cursor() as cursor:
+        try:
+            await cursor.execute("""DELETE FROM telegram_users.poller_workers WHERE worker_id = %s""", worker_id)
+            await conn.commit()
+
         except Exception as ex:
-            log_error(f"Response from tg_user_id_list def: {ex}")
+            log_error(f"Response from remove_worker def: {ex}")
@@ -0,0 +1,213 @@
+import asyncio
+import random
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable
+
+from aiogram.utils.exceptions import BadRequest, RetryAfter, Unauthorized
+
+from python_modules.db_functions import acquire_connection, enqueue_notification, due_notifications
+from python_modules.db_functions import delete_notification, postpone_notification
+from python_modules.notifications import RateLimiter
+from logs.logger import log_debug, log_error
+
+
+class Outbox:
+    """
+    Доставка уведомлений через очередь в таблице notifications_outbox.
+    Уведомления сначала записываются в базу, затем пул обработчиков отправляет их в Telegram,
+    поэтому медленная доставка не задерживает опрос таблиц, а после перезапуска неотправленные уведомления не теряются.
+    Чаты обслуживаются по кругу по одному сообщению, поэтому пользователь с большим количеством изменений
+    не задерживает остальных. При RetryAfter и временных ошибках отправка в чат откладывается
+    с экспоненциально растущей задержкой
+
+    send: корутина отправки сообщения (chat_id, text)
+    limiter: ограничитель частоты отправки
+    workers: количество одновременно работающих обработчиков
+    max_attempts: количество попыток, после которого уведомление отбрасывается
+    base_delay, max_delay: начальная и максимальная задержка повторной отправки в секундах
+    poll_interval: период проверки очереди в базе в секундах
+    batch_size: максимальное количество уведомлений, загружаемых из базы за раз
+    chat_batch: максимальное количество уведомлений одного чата, загружаемых за раз
+    """
+    def __init__(self, send: Callable[[int, str], Awaitable], limiter: RateLimiter, workers: int = 4,
+                 max_attempts: int = 8, base_delay: float = 1, max_delay: float = 600,
+                 poll_interval: float = 5, batch_size: int = 500, chat_batch: int = 10):
+        self._send = send
+        self._limiter = limiter
+        self._workers = workers
+        self._max_attempts = max_attempts
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._poll_interval = poll_interval
+        self._batch_size = batch_size
+        self._chat_batch = chat_batch
+        self._queues: dict[int, deque] = {} # очереди загруженных уведомлений по чатам
+        self._ready: asyncio.Queue = asyncio.Queue() # чаты с уведомлениями, ожидающие обработчика
+        self._known: set[int] = set() # номера уведомлений, загруженных в память
+        self._undeleted: set[int] = set() # обработанные уведомления, которые не удалось удалить из базы
+        self._paused: dict[int, float] = {} # чаты, отправка в которые отложена, и время окончания паузы
+        self._wakeup = asyncio.Event()
+        self._tasks: list[asyncio.Task] = []
+
+    @property
+    def depth(self) -> int:
+        """
+        Количество уведомлений, загруженных в память и ожидающих отправки
+        """
+        return len(self._known)
+
+    async def put(self, chat_id: int, text: str) -> None:
+        """
+        Запись уведомления в очередь. Если база недоступна, уведомление отправляется сразу
+        """
+        notification_id = None
+        try:
+            async with acquire_connection() as conn:
+                notification_id = await enqueue_notification(conn, chat_id, text)
+        except Exception as ex:
+            log_error(f'Response from Outbox.put: {ex}')
+
+        if notification_id is None:
+            await self._limiter.acquire(chat_id)
+            await self._send(chat_id, text)
+            return
+        self._wakeup.set()
+
+    def start(self) -> None:
+        self._tasks = [asyncio.create_task(self._loader())]
+        self._tasks += [asyncio.create_task(self._worker()) for _ in range(self._workers)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _loader(self) -> None:
+        """
+        Загрузка из базы уведомлений, время отправки которых наступило
+        """
+        while True:
+            try:
+                await self._load()
+            except Exception as ex:
+                log_error(f'Response from Outbox loader: {ex}')
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self._poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _load(self) -> None:
+        async with acquire_connection() as conn:
+            for notification_id in list(self._undeleted):
+                if await delete_notification(conn, notification_id):
+                    self._undeleted.discard(notification_id)
+            now = time.monotonic()
+            self._paused = {chat_id: until for chat_id, until in self._paused.items() if until > now}
+            # следующие уведомления чата загружаются, когда отправлены уже загруженные
+            rows = await due_notifications(conn, self._batch_size, self._chat_batch,
+                                           set(self._queues) | set(self._paused)) or []
+
+        for notification_id, chat_id, text, attempts in rows:
+            if notification_id in self._known or notification_id in self._undeleted or chat_id in self._paused:
+                continue
+            self._known.add(notification_id)
+            queue = self._queues.get(chat_id)
+            if queue is None: # чат становится в конец очереди обслуживания
+                queue = self._queues[chat_id] = deque()
+                self._ready.put_nowait(chat_id)
+            queue.append((notification_id, text, attempts))
+
+    async def _worker(self) -> None:
+        """
+        Обработчик берет чат из очереди, отправляет одно его уведомление и возвращает чат в конец очереди
+        """
+        while True:
+            chat_id = await self._ready.get()
+            try:
+                await self._deliver(chat_id)
+            except Exception as ex: # например, ошибка базы: чат откладывается, чтобы не отправлять уведомления повторно без паузы
+                log_error(f'Response from Outbox worker, chat {chat_id}: {ex}')
+                queue = self._queues.get(chat_id)
+                attempts = queue[0][2] + 1 if queue else 1
+                await self._pause(chat_id, self._retry_delay(attempts), attempts)
+
+            queue = self._queues.get(chat_id)
+            if queue:
+                self._ready.put_nowait(chat_id)
+            elif queue is not None:
+                del self._queues[chat_id]
+
+    async def _deliver(self, chat_id: int) -> None:
+        queue = self._queues[chat_id]
+        notification_id, text, attempts = queue[0]
+        await self._limiter.acquire(chat_id)
+        try:
+            await self._send(chat_id, text)
+
+        except RetryAfter as ex: # превышен лимит Telegram, чат откладывается на указанное время
+            log_debug(f'Flood control for chat {chat_id}, retry in {ex.timeout} s')
+            await self._pause(chat_id, ex.timeout, attempts)
+
+        except (Unauthorized, BadRequest) as ex: # бот заблокирован, чат не найден или сообщение некорректно
+            log_error(f'Notification {notification_id} for chat {chat_id} has dropped: {ex}')
+            await self._complete(chat_id)
+
+        except Exception as ex:
+            attempts += 1
+            if attempts >= self._max_attempts:
+                log_error(f'Notification {notification_id} for chat {chat_id} has dropped after {attempts} attempts: {ex}')
+                await self._complete(chat_id)
+            else:
+                delay = self._retry_delay(attempts)
+                log_debug(f'Notification {notification_id} for chat {chat_id} will be retried in {delay:.1f} s: {ex}')
+                await self._pause(chat_id, delay, attempts)
+
+        else:
+            await self._complete(chat_id)
+
+    def _retry_delay(self, attempts: int) -> float:
+        return min(self._max_delay, self._base_delay * 2 ** attempts) * random.uniform(0.5, 1.5)
+
+    async def _complete(self, chat_id: int) -> None:
+        """
+        Удаление первого уведомления чата из базы и из памяти. Номер уведомления остается известным загрузчику,
+        пока оно не удалено из базы, иначе загрузчик может загрузить и отправить его повторно
+        """
+        notification_id = self._queues[chat_id].popleft()[0]
+        deleted = None
+        try:
+            async with acquire_connection() as conn:
+                deleted = await delete_notification(conn, notification_id)
+        except Exception as ex:
+            log_error(f'Response from Outbox._complete: {ex}')
+        if not deleted: # удаление повторяется при следующей загрузке
+            self._undeleted.add(notification_id)
+        self._known.discard(notification_id)
+
+    async def _pause(self, chat_id: int, delay: float, attempts: int) -> None:
+        """
+        Откладывание всех уведомлений чата на delay секунд с сохранением их порядка.
+        Уведомления выгружаются из памяти и будут загружены из базы повторно
+        """
+        queue = self._release(chat_id)
+        self._paused[chat_id] = time.monotonic() + delay
+        if not queue:
+            return
+        next_attempt = datetime.now() + timedelta(seconds=delay)
+        try: # если база недоступна, чат все равно отложен в памяти на delay секунд
+            async with acquire_connection() as conn:
+                await postpone_notification(conn, [queue[0][0]], attempts, next_attempt)
+                await postpone_notification(conn, [item[0] for item in list(queue)[1:]], 0, next_attempt)
+        except Exception as ex:
+            log_error(f'Response from Outbox._pause: {ex}')
+
+    def _release(self, chat_id: int) -> deque:
+        queue = self._queues.pop(chat_id, deque())
+        for item in queue:
+            self._known.discard(item[0])
+        return queue
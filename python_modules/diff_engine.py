@@ -0,0 +1,485 @@
+import itertools
+import json
+import sys
+import zlib
+from typing import Optional, Union
+
+import numpy as np
+
+from python_modules.a1 import cell_name, column_letter
+
+
+class SnapshotDiff:
+    """
+    Результат сравнения двух снимков значений ячеек
+
+    cells: список изменившихся ячеек (строка, столбец, старое значение, новое значение), индексы с нуля
+    rows_added, rows_removed: номера добавленных и удаленных строк (с нуля)
+    cols_added, cols_removed: номера добавленных и удаленных столбцов (с нуля)
+    """
+    def __init__(self, cells: list[tuple[int, int, str, str]], rows_added: range, rows_removed: range,
+                 cols_added: range, cols_removed: range):
+        self.cells = cells
+        self.rows_added = rows_added
+        self.rows_removed = rows_removed
+        self.cols_added = cols_added
+        self.cols_removed = cols_removed
+
+    @property
+    def resized(self) -> bool:
+        return bool(self.rows_added or self.rows_removed or self.cols_added or self.cols_removed)
+
+    def __bool__(self) -> bool:
+        return bool(self.cells) or self.resized
+
+
+def snapshot_shape(values: list) -> tuple[int, int]:
+    """
+    Размер снимка: количество строк и длина самой длинной строки
+    """
+    return len(values), max((len(row) for row in values), default=0)
+
+
+def row_fingerprints(values: list) -> np.ndarray:
+    """
+    Хэш каждой строки снимка. Строки с одинаковым хэшем считаются неизменившимися
+    """
+    return np.fromiter((hash(tuple(row)) for row in values), dtype=np.int64, count=len(values))
+
+
+class Snapshot:
+    """
+    Снимок значений ячеек вместе с хэшами строк. Новый снимок сравнивается со старым сначала по хэшам строк,
+    и поячеечно сравниваются только строки с отличающимися хэшами
+
+    values: значения ячеек (список списков строк)
+    """
+    def __init__(self, values: list):
+        self.values = values
+        self.shape = snapshot_shape(values)
+        self.row_hashes = row_fingerprints(values)
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Snapshot):
+            return NotImplemented
+        return self.shape == other.shape and np.array_equal(self.row_hashes, other.row_hashes)
+
+    __hash__ = None
+
+    def to_bytes(self) -> bytes:
+        """
+        Сжатое представление снимка для хранения в базе. Хэши строк не сохраняются,
+        так как hash() строк отличается между запусками процесса
+        """
+        return zlib.compress(json.dumps(self.values, ensure_ascii=False, separators=(',', ':')).encode())
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'Snapshot':
+        return cls(json.loads(zlib.decompress(data)))
+
+
+def as_snapshot(data: Union[Snapshot, list]) -> Snapshot:
+    return data if isinstance(data, Snapshot) else Snapshot(data)
+
+
+BLOCK_MAGIC = b'BLK1'
+
+
+def compress_rows(rows: list) -> bytes:
+    return zlib.compress(json.dumps(rows, ensure_ascii=False, separators=(',', ':')).encode())
+
+
+def decompress_rows(data: bytes) -> list:
+    return json.loads(zlib.decompress(data))
+
+
+class BlockSnapshot:
+    """
+    Снимок большого листа, хранящийся сжатыми блоками по block_rows строк.
+    В памяти несжатым бывает только один блок, для сравнения без распаковки хранятся хэши всех строк.
+    Строки хранятся без пустых ячеек в конце, как их возвращает API, каждый блок дополнен пустыми строками до block_rows
+
+    block_rows: количество строк в блоке
+    """
+    def __init__(self, block_rows: int):
+        self.block_rows = block_rows
+        self.blocks: list[bytes] = []
+        self.row_hashes = np.empty(0, dtype=np.int64)
+        self.shape = (0, 0)
+        self._hash_parts: list[np.ndarray] = []
+
+    def append_block(self, rows: list) -> None:
+        self.blocks.append(compress_rows(rows))
+        self._hash_parts.append(row_fingerprints(rows))
+        self.shape = (self.shape[0], max(self.shape[1], snapshot_shape(rows)[1]))
+
+    def finish(self, number_of_rows: int) -> None:
+        """
+        Завершение построения снимка, number_of_rows - номер последней непустой строки листа
+        """
+        if self._hash_parts:
+            self.row_hashes = np.concatenate(self._hash_parts)
+        self._hash_parts = []
+        self.shape = (number_of_rows, self.shape[1])
+
+    def block(self, index: int) -> list:
+        return decompress_rows(self.blocks[index]) if index < len(self.blocks) else []
+
+    def block_hashes(self, index: int) -> np.ndarray:
+        return self.row_hashes[index * self.block_rows:(index + 1) * self.block_rows]
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, BlockSnapshot):
+            return NotImplemented
+        return self.shape == other.shape and np.array_equal(self.row_hashes, other.row_hashes)
+
+    __hash__ = None
+
+    def to_bytes(self) -> bytes:
+        """
+        Сохранение уже сжатых блоков без повторного сжатия: заголовок с размерами блоков и сами блоки
+        """
+        header = json.dumps({'block_rows': self.block_rows, 'rows': self.shape[0],
+                             'sizes': [len(block) for block in self.blocks]}).encode()
+        return BLOCK_MAGIC + len(header).to_bytes(4, 'big') + header + b''.join(self.blocks)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'BlockSnapshot':
+        length = int.from_bytes(data[4:8], 'big')
+        header = json.loads(data[8:8 + length])
+        snapshot = cls(header['block_rows'])
+        position = 8 + length
+        for size in header['sizes']: # хэши строк пересчитываются, блоки распаковываются по одному
+            block = data[position:position + size]
+            position += size
+            rows = decompress_rows(block)
+            snapshot.blocks.append(block)
+            snapshot._hash_parts.append(row_fingerprints(rows))
+            snapshot.shape = (0, max(snapshot.shape[1], snapshot_shape(rows)[1]))
+        snapshot.finish(header['rows'])
+        return snapshot
+
+
+def snapshot_nbytes(snapshot: Union[Snapshot, BlockSnapshot]) -> int:
+    """
+    Приблизительный объем памяти снимка в байтах: значения ячеек и хэши строк для Snapshot,
+    сжатые блоки и хэши строк для BlockSnapshot. Снимки не меняются, поэтому объем вычисляется один раз
+    """
+    nbytes = getattr(snapshot, '_nbytes', None)
+    if nbytes is None:
+        if isinstance(snapshot, BlockSnapshot):
+            nbytes = sum(sys.getsizeof(block) for block in snapshot.blocks)
+        else:
+            nbytes = sys.getsizeof(snapshot.values) + sum(sys.getsizeof(row) + sum(sys.getsizeof(cell) for cell in row)
+                                                          for row in snapshot.values)
+        nbytes += snapshot.row_hashes.nbytes
+        snapshot._nbytes = nbytes
+    return nbytes
+
+
+def snapshot_from_bytes(data: bytes) -> Union[Snapshot, BlockSnapshot]:
+    """
+    Восстановление снимка любого формата из сохраненного в базе представления
+    """
+    if data.startswith(BLOCK_MAGIC):
+        return BlockSnapshot.from_bytes(data)
+    return Snapshot.from_bytes(data)
+
+
+class BlockDiffer:
+    """
+    Потоковое сравнение большого листа со старым снимком. Блоки строк передаются в feed по мере получения из API,
+    изменения каждого блока возвращаются сразу, а новый снимок собирается в сжатом виде.
+    Пиковая память ограничена размером блока и не зависит от размера листа
+
+    old: снимок предыдущего опроса или None, если сравнивать не с чем
+    block_rows: количество строк в блоке
+    """
+    def __init__(self, old: Optional[Union[Snapshot, BlockSnapshot]], block_rows: int):
+        if not isinstance(old, BlockSnapshot) or old.block_rows != block_rows:
+            old = None # обычный снимок или снимок с другим размером блока сравнить поблочно нельзя
+        self.old = old
+        self.new = BlockSnapshot(block_rows)
+        self._block_rows = block_rows
+        self._index = 0
+        self._pending_empty = 0
+        self._rows = 0
+        self._empty_hashes = row_fingerprints([[]] * block_rows)
+
+    def _diff_block(self, index: int, rows: list, hashes: np.ndarray) -> list[tuple[int, int, str, str]]:
+        if self.old is None:
+            return []
+        old_hashes = self.old.block_hashes(index)
+        if old_hashes.size < self._block_rows:
+            old_hashes = self._empty_hashes
+        changed = np.nonzero(old_hashes != hashes)[0]
+        if not changed.size:
+            return []
+        return diff_rows(self.old.block(index), rows, changed, index * self._block_rows)
+
+    def feed(self, values: list) -> list[tuple[int, int, str, str]]:
+        """
+        Сравнение очередного блока строк. values - строки блока без пустых строк в конце
+        """
+        index = self._index
+        self._index += 1
+        rows = values + [[] for _ in range(self._block_rows - len(values))]
+        hashes = row_fingerprints(rows)
+        cells = self._diff_block(index, rows, hashes)
+
+        if values: # пустые блоки добавляются в снимок, только если после них есть данные
+            for _ in range(self._pending_empty):
+                self.new.append_block([[]] * self._block_rows)
+            self._pending_empty = 0
+            self.new.append_block(rows)
+            self._rows = index * self._block_rows + len(values)
+        else:
+            self._pending_empty += 1
+        return cells
+
+    def finish(self) -> SnapshotDiff:
+        """
+        Завершение сравнения: ячейки блоков старого снимка, которых больше нет в листе,
+        и изменение размера листа
+        """
+        cells = []
+        if self.old is not None:
+            for index in range(self._index, len(self.old.blocks)):
+                cells.extend(self._diff_block(index, [[]] * self._block_rows, self._empty_hashes))
+        self.new.finish(self._rows)
+
+        if self.old is None:
+            return SnapshotDiff(cells, range(0), range(0), range(0), range(0))
+        old_rows, old_cols = self.old.shape
+        new_rows, new_cols = self.new.shape
+        return SnapshotDiff(cells,
+                            rows_added=range(old_rows, new_rows),
+                            rows_removed=range(new_rows, old_rows),
+                            cols_added=range(old_cols, new_cols),
+                            cols_removed=range(new_cols, old_cols))
+
+
+def trim_rows(rows: list) -> list:
+    """
+    Строки в том виде, в каком их возвращает API при запросе диапазона: без пустых ячеек в конце строк
+    и без пустых строк в конце
+    """
+    trimmed = []
+    for row in rows:
+        end = len(row)
+        while end and row[end - 1] == '':
+            end -= 1
+        trimmed.append(list(row[:end]))
+    while trimmed and not trimmed[-1]:
+        trimmed.pop()
+    return trimmed
+
+
+def to_block_snapshot(snapshot: Union[Snapshot, BlockSnapshot], block_rows: int) -> BlockSnapshot:
+    """
+    Перевод снимка в блочный формат с размером блока block_rows, когда динамическая подписка перешла
+    через порог потокового опроса или изменился размер блока. Строки обрезаются так же, как их возвращает API
+    при потоковом опросе, поэтому хэши неизменившихся строк совпадают
+    """
+    if isinstance(snapshot, BlockSnapshot) and snapshot.block_rows == block_rows:
+        return snapshot
+    rows = to_plain_snapshot(snapshot).values if isinstance(snapshot, BlockSnapshot) else snapshot.values
+    differ = BlockDiffer(None, block_rows)
+    for first_row in range(0, len(rows), block_rows):
+        differ.feed(trim_rows(rows[first_row:first_row + block_rows]))
+    differ.finish()
+    return differ.new
+
+
+def to_plain_snapshot(snapshot: Union[Snapshot, BlockSnapshot]) -> Snapshot:
+    """
+    Перевод блочного снимка в обычный, когда лист динамической подписки стал меньше порога потокового опроса.
+    Строки дополняются пустыми ячейками до ширины снимка, как их возвращает get_all_values
+    """
+    if isinstance(snapshot, Snapshot):
+        return snapshot
+    number_of_rows, width = snapshot.shape
+    rows = []
+    for index in range(len(snapshot.blocks)):
+        rows.extend(snapshot.block(index))
+    return Snapshot([row + [''] * (width - len(row)) for row in rows[:number_of_rows]])
+
+
+def to_array(values: list, shape: tuple[int, int]) -> np.ndarray:
+    """
+    Перевод снимка (список списков строк) в массив размера shape, недостающие ячейки заполняются пустой строкой
+    """
+    array = np.full(shape, '', dtype=object)
+    if not values:
+        return array
+
+    rows, cols = snapshot_shape(values)
+    if all(len(row) == cols for row in values): # прямоугольный снимок копируется одной операцией
+        block = np.empty((rows, cols), dtype=object)
+        block[:, :] = values
+        array[:rows, :cols] = block
+    else:
+        for row_index, row in enumerate(values):
+            array[row_index, :len(row)] = row
+    return array
+
+
+def changed_rows(old: Snapshot, new: Snapshot) -> np.ndarray:
+    """
+    Номера строк, которые нужно сравнить поячеечно: строки общей части с разными хэшами,
+    а также добавленные или удаленные строки
+    """
+    common = min(old.shape[0], new.shape[0])
+    rows = np.nonzero(old.row_hashes[:common] != new.row_hashes[:common])[0]
+    tail = np.arange(common, max(old.shape[0], new.shape[0]))
+    return np.concatenate((rows, tail))
+
+
+def diff_rows(old_values: list, new_values: list, rows: np.ndarray, first_row: int = 0) -> list[tuple[int, int, str, str]]:
+    """
+    Поячеечное сравнение строк rows двух массивов значений. Строки дополняются пустыми ячейками
+    до общей ширины, отсутствующие строки считаются пустыми.
+    Номера строк в результате сдвигаются на first_row
+    """
+    if not rows.size:
+        return []
+    old_part = [old_values[row] if row < len(old_values) else [] for row in rows.tolist()]
+    new_part = [new_values[row] if row < len(new_values) else [] for row in rows.tolist()]
+    width = max(snapshot_shape(old_part)[1], snapshot_shape(new_part)[1])
+    old_array = to_array(old_part, (rows.size, width))
+    new_array = to_array(new_part, (rows.size, width))
+
+    mask = old_array != new_array
+    row_indexes, col_indexes = np.nonzero(mask)
+    return list(zip((rows[row_indexes] + first_row).tolist(), col_indexes.tolist(),
+                    old_array[mask].tolist(), new_array[mask].tolist()))
+
+
+def diff_snapshots(old: Union[Snapshot, list], new: Union[Snapshot, list]) -> SnapshotDiff:
+    """
+    Сравнение двух снимков. Сначала сравниваются хэши строк, затем строки с отличающимися хэшами
+    дополняются пустыми ячейками до общей ширины, маска изменений вычисляется одним векторным сравнением,
+    координаты извлекаются через np.nonzero.
+    Ячейки добавленных и удаленных строк и столбцов тоже попадают в cells, если они не пустые
+    """
+    old = as_snapshot(old)
+    new = as_snapshot(new)
+    old_rows, old_cols = old.shape
+    new_rows, new_cols = new.shape
+
+    rows = changed_rows(old, new)
+    cells = diff_rows(old.values, new.values, rows)
+
+    return SnapshotDiff(cells,
+                        rows_added=range(old_rows, new_rows),
+                        rows_removed=range(new_rows, old_rows),
+                        cols_added=range(old_cols, new_cols),
+                        cols_removed=range(new_cols, old_cols))
+
+
+def resize_diff(old_shape: tuple[int, int], new_shape: tuple[int, int],
+                cells: list[tuple[int, int, str, str]] = ()) -> SnapshotDiff:
+    """
+    Результат сравнения снимков размеров old_shape и new_shape с изменившимися ячейками cells
+    """
+    old_rows, old_cols = old_shape
+    new_rows, new_cols = new_shape
+    return SnapshotDiff(list(cells),
+                        rows_added=range(old_rows, new_rows),
+                        rows_removed=range(new_rows, old_rows),
+                        cols_added=range(old_cols, new_cols),
+                        cols_removed=range(new_cols, old_cols))
+
+
+def changed_blocks(old: BlockSnapshot, new: BlockSnapshot) -> list[tuple[int, np.ndarray]]:
+    """
+    Номера блоков с отличающимися хэшами строк и номера отличающихся строк внутри каждого блока
+    """
+    empty = row_fingerprints([[]] * new.block_rows)
+    blocks = []
+    for index in range(max(len(old.blocks), len(new.blocks))):
+        old_hashes = old.block_hashes(index) if index < len(old.blocks) else empty
+        new_hashes = new.block_hashes(index) if index < len(new.blocks) else empty
+        changed = np.nonzero(old_hashes != new_hashes)[0]
+        if changed.size:
+            blocks.append((index, changed))
+    return blocks
+
+
+def diff_block_snapshots(old: BlockSnapshot, new: BlockSnapshot) -> SnapshotDiff:
+    """
+    Сравнение двух блочных снимков с одинаковым размером блока. Распаковываются только блоки,
+    хэши строк которых отличаются, поэтому в памяти одновременно находится не больше двух блоков
+    """
+    cells = []
+    for index, changed in changed_blocks(old, new):
+        cells.extend(diff_rows(old.block(index), new.block(index), changed, index * new.block_rows))
+    return resize_diff(old.shape, new.shape, cells)
+
+
+def format_diff(diff: SnapshotDiff, leftrow: int = 1, leftcol: int = 1) -> list[str]:
+    """
+    Текстовое описание изменений для пользователя. Координаты отсчитываются от левого верхнего угла
+    отслеживаемого диапазона (leftrow, leftcol)
+    """
+    lines = []
+    for name, rows in (('Rows added', diff.rows_added), ('Rows removed', diff.rows_removed)):
+        if rows:
+            lines.append(f'{name}: {rows[0] + leftrow}-{rows[-1] + leftrow}')
+    for name, cols in (('Columns added', diff.cols_added), ('Columns removed', diff.cols_removed)):
+        if cols:
+            lines.append(f'{name}: {column_letter(cols[0] + leftcol)}-{column_letter(cols[-1] + leftcol)}')
+
+    for row_index, col_index, cell1, cell2 in diff.cells:
+        lines.append(f'{cell_name(row_index + leftrow, col_index + leftcol)}: {cell1} -> {cell2}')
+    return lines
+
+
+
+def pack_rows(rows: list) -> tuple[str, np.ndarray, np.ndarray]:
+    """
+    Компактное представление строк для передачи в другой процесс: значения всех ячеек одной строкой,
+    длины значений и количество ячеек в каждой строке. pickle сериализует три объекта вместо объекта
+    на каждую ячейку, поэтому передача обходится дешевле самого сравнения
+    """
+    cells = list(itertools.chain.from_iterable(rows))
+    lengths = np.fromiter(map(len, cells), dtype=np.int64, count=len(cells))
+    widths = np.fromiter(map(len, rows), dtype=np.int64, count=len(rows))
+    return ''.join(cells), lengths, widths
+
+
+def unpack_rows(packed: tuple[str, np.ndarray, np.ndarray]) -> list:
+    """
+    Восстановление строк из представления pack_rows
+    """
+    text, lengths, widths = packed
+    ends = np.cumsum(lengths).tolist()
+    cells = [text[start:end] for start, end in zip([0] + ends[:-1], ends)]
+    bounds = np.cumsum(widths).tolist()
+    return [cells[start:end] for start, end in zip([0] + bounds[:-1], bounds)]
+
+
+def diff_packed_rows(old_packed: tuple, new_packed: tuple, rows: np.ndarray,
+                     leftrow: int = 1, leftcol: int = 1) -> tuple[str, np.ndarray, np.ndarray]:
+    """
+    Сравнение в процессе пула: old_packed и new_packed - упакованные строки rows старого и нового снимка.
+    Возвращает упакованное описание изменившихся ячеек (одна строка из строк format_diff)
+    """
+    positions = diff_rows(unpack_rows(old_packed), unpack_rows(new_packed), np.arange(rows.size))
+    numbers = rows.tolist()
+    cells = [(numbers[position], col, old_value, new_value) for position, col, old_value, new_value in positions]
+    return pack_rows([format_diff(resize_diff((0, 0), (0, 0), cells), leftrow, leftcol)])
+
+
+def diff_compressed_blocks(blocks: list[tuple[int, Optional[bytes], Optional[bytes], np.ndarray]],
+                           block_rows: int) -> tuple[str, np.ndarray, np.ndarray]:
+    """
+    Сравнение в процессе пула блоков BlockSnapshot, переданных в сжатом виде: (номер блока, старый блок,
+    новый блок, номера отличающихся строк). Возвращает упакованное описание изменившихся ячеек
+    """
+    cells = []
+    for index, old_block, new_block, changed in blocks:
+        old_rows = decompress_rows(old_block) if old_block is not None else []
+        new_rows = decompress_rows(new_block) if new_block is not None else []
+        cells.extend(diff_rows(old_rows, new_rows, changed, index * block_rows))
+    return pack_rows([format_diff(resize_diff((0, 0), (0, 0), cells))])
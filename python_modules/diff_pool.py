@@ -0,0 +1,91 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Optional
+
+from python_modules.diff_engine import Snapshot, BlockSnapshot, changed_rows, changed_blocks, diff_snapshots
+from python_modules.diff_engine import diff_block_snapshots, diff_packed_rows, diff_compressed_blocks
+from python_modules.diff_engine import format_diff, pack_rows, resize_diff, unpack_rows
+from python_modules.metrics import instrument
+from logs.logger import log_debug, log_error
+
+_pool: Optional[ProcessPoolExecutor] = None
+_threshold = 50000
+
+
+def configure_diff_pool(workers: int, threshold: int) -> None:
+    """
+    Включение сравнения больших снимков в пуле процессов, чтобы оно не занимало поток цикла событий бота
+    и выполнялось на нескольких ядрах. Процессы создаются через fork сразу при настройке, при импорте bot.py,
+    пока еще нет цикла событий и потоков обращений к API (поток записи лога уже есть, но процессы пула не пишут в лог).
+    spawn и forkserver не используются, так как они заново импортируют в каждом процессе модуль bot.py
+
+    :param workers: количество процессов, 0 - сравнение выполняется в процессе бота
+    :param threshold: количество сравниваемых ячеек, начиная с которого сравнение передается в пул
+    """
+    global _pool, _threshold
+    shutdown_diff_pool()
+    _threshold = threshold
+    if workers > 0:
+        _pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork'))
+        _pool.submit(int) # пул с fork запускает все процессы при первой задаче
+        log_debug(f'Diff process pool has started with {workers} workers')
+
+
+def shutdown_diff_pool() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+@instrument('diff.process_pool')
+async def run_in_pool(func: Callable, *args) -> Any:
+    """
+    Выполнение сравнения в пуле процессов. Если процесс пула аварийно завершился, пул не создается заново
+    (fork из работающего бота с циклом событий и потоками небезопасен): до перезапуска бота снимки
+    сравниваются в его процессе, а это сравнение выполняется в потоке
+    """
+    global _pool
+    pool = _pool
+    try:
+        return await asyncio.get_running_loop().run_in_executor(pool, func, *args)
+    except BrokenProcessPool as ex:
+        if _pool is pool: # пул отключает только первое из одновременных сравнений, получивших ошибку
+            log_error(f'Response from run_in_pool: {ex!r}, diffs run in the bot process until restart')
+            _pool = None
+            pool.shutdown(wait=False)
+        return await asyncio.to_thread(func, *args)
+
+
+async def snapshot_diff_lines(old: Snapshot, new: Snapshot, leftrow: int = 1, leftcol: int = 1) -> list[str]:
+    """
+    Описание изменений между снимками, то же, что format_diff(diff_snapshots(old, new), leftrow, leftcol).
+    Строки с отличающимися хэшами сравниваются в пуле процессов, если их ячеек не меньше порога,
+    и передаются туда упакованными через pack_rows
+    """
+    rows = changed_rows(old, new)
+    if _pool is None or rows.size * max(old.shape[1], new.shape[1]) < _threshold:
+        return format_diff(diff_snapshots(old, new), leftrow, leftcol)
+
+    row_numbers = rows.tolist()
+    old_packed = pack_rows([old.values[row] if row < old.shape[0] else [] for row in row_numbers])
+    new_packed = pack_rows([new.values[row] if row < new.shape[0] else [] for row in row_numbers])
+    lines = unpack_rows(await run_in_pool(diff_packed_rows, old_packed, new_packed, rows, leftrow, leftcol))[0]
+    return format_diff(resize_diff(old.shape, new.shape), leftrow, leftcol) + lines
+
+
+async def block_diff_lines(old: BlockSnapshot, new: BlockSnapshot) -> list[str]:
+    """
+    Описание изменений между блочными снимками. Отличающиеся блоки передаются в пул процессов в сжатом виде,
+    в каком они хранятся в снимках, и распаковываются только там
+    """
+    blocks = changed_blocks(old, new)
+    if _pool is None or sum(changed.size for _, changed in blocks) * max(old.shape[1], new.shape[1]) < _threshold:
+        return format_diff(await asyncio.to_thread(diff_block_snapshots, old, new))
+
+    compressed = [(index, old.blocks[index] if index < len(old.blocks) else None,
+                   new.blocks[index] if index < len(new.blocks) else None, changed) for index, changed in blocks]
+    lines = unpack_rows(await run_in_pool(diff_compressed_blocks, compressed, new.block_rows))[0]
+    return format_diff(resize_diff(old.shape, new.shape)) + lines
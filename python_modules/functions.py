@@ -1,36 +1,52 @@
-import re
+import asyncio
 from typing import Optional
 from typing import Union, Tuple
 
 import gspread
-from gspread.utils import column_letter_to_index
-from oauth2client.service_account import ServiceAccountCredentials
 from google.auth.exceptions import GoogleAuthError
 from googleapiclient.errors import HttpError
-import numpy as np
 
+from python_modules.a1 import column_letter, parse_range, range_shape
+from python_modules.diff_engine import as_snapshot, snapshot_shape, trim_rows
+from python_modules.diff_pool import snapshot_diff_lines
+from python_modules.sheets_client import get_client, get_file_version, handle_cache, is_stale_handle_error, run_blocking
+from python_modules.governor import governor, INTERACTIVE, BACKGROUND
+from python_modules.metrics import instrument
 from logs.logger import log_error
 
+@instrument('speardsheets_connection_check', failed=lambda result: result is None or not result[0])
 async def speardsheets_connection_check(account_file: str, scopes: list, spreadsheet_name: str,
-                                  sheet_number: int) -> Union[Tuple[
+                                  sheet_number: int, priority: int = INTERACTIVE) -> Union[Tuple[
                                       bool, gspread.worksheet.Worksheet], None]:
     """
-    Проверка соединения с Google таблицейн
+    Проверка соединения с Google таблицейн. Найденные таблица и лист сохраняются в handle_cache,
+    повторные вызовы не обращаются к API до истечения срока жизни записи
 
     :param account_file: файл с правами доступа 
     :param spreadsheet_name: название Google таблицы 
     :param scopes: настройки прав доступа 
+    :param priority: приоритет запросов к API: INTERACTIVE для обработчиков бота, BACKGROUND для опроса таблиц
     """
     try:
-        creds = ServiceAccountCredentials.from_json_keyfile_name(
-            account_file, scopes=scopes)
-        file = gspread.authorize(creds)
-
-        workbook = file.open(spreadsheet_name)
-        sheets = workbook.get_worksheet(sheet_number - 1)
+        sheets = handle_cache.get((spreadsheet_name, sheet_number))
+        if sheets is not None:
+            return True, sheets
+
+        workbook = handle_cache.get((spreadsheet_name, None))
+        if workbook is None:
+            file = await run_blocking(get_client, account_file, scopes)
+            workbook = await governor.call(file.open, spreadsheet_name, priority=priority)
+            handle_cache.set((spreadsheet_name, None), workbook)
+
+        sheets = await governor.call(workbook.get_worksheet, sheet_number - 1, priority=priority)
+        if sheets is None:
+            return False, None
+        handle_cache.set((spreadsheet_name, sheet_number), sheets)
         return True, sheets
 
     except (GoogleAuthError, HttpError, gspread.exceptions.GSpreadException, TimeoutError, ConnectionError, ValueError) as ex:
+        if is_stale_handle_error(ex):
+            handle_cache.invalidate(spreadsheet_name)
         log_error(f'Response from speardsheets_connection_check {ex.__class__.__name__}')
         return False, None
     except Exception as ex:
@@ -38,88 +54,178 @@ async def speardsheets_connection_check(account_file: str, scopes: list, spreads
         log_error(f'Response from speardsheets_connection_check {ex.__class__.__name__}')
         return False, None
 
-async def converting_of_number(column: int) -> Optional[str]:
+@instrument('spreadsheet_version', failed=lambda result: result is None)
+async def spreadsheet_version(account_file: str, scopes: list, spreadsheet: gspread.spreadsheet.Spreadsheet) -> Optional[str]:
     """
-    Функция принимает номер столбца в гугл таблице и возвращается его буквенное название
-    например колонка 27 будет конвертирована в АА
+    Проверка версии Google таблицы через Drive API. Если версия не изменилась с предыдущего опроса,
+    значения ячеек можно не запрашивать. При ошибке возвращает None, тогда значения запрашиваются как обычно
+
+    :param account_file: файл с правами доступа 
+    :param scopes: настройки прав доступа 
+    :param spreadsheet: Google таблица
     """
-    ALPHABET = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
     try:
-        if column // 26 == 0:
-            column = ALPHABET[column - 1]
-        else:
-            column = ALPHABET[column // 26 - 1] + ALPHABET[column % 26 - 1]
-        return column
-    
+        return await governor.call(get_file_version, account_file, scopes, spreadsheet.id, priority=BACKGROUND)
+
     except Exception as ex:
-        log_error(f'Response from converting_of_number: {ex}')
-        return None,
+        log_error(f'Response from spreadsheet_version {ex.__class__.__name__}: {ex}')
+        return None
+
+def fit_values(values: list, number_of_rows: int, number_of_columns: int) -> list:
+    """
+    Приведение значений, полученных из API, к размеру number_of_rows x number_of_columns.
+    API не возвращает пустые строки и ячейки в конце диапазона, они дополняются пустыми строками
+    """
+    all_values = [row + [''] * (number_of_columns - len(row)) for row in values[:number_of_rows]]
+    all_values += [[''] * number_of_columns for _ in range(number_of_rows - len(all_values))]
+    return all_values
 
-async def search_ranges(sheets: gspread.worksheet.Worksheet, start_coords: dict = None) -> Optional[tuple[dict, list]]:
+def dynamic_coordinates(values: list) -> dict:
+    """
+    Координаты заполненного диапазона листа по всем его значениям (случай 'dynamic')
+    """
+    number_of_rows, number_of_columns = snapshot_shape(values)
+    return {"leftcol": 'A', "leftrow": 1,
+            "rightcol": column_letter(max(number_of_columns, 1)), "rightrow": max(number_of_rows, 1)}
+
+@instrument('search_ranges', failed=lambda result: not result[0])
+async def search_ranges(sheets: gspread.worksheet.Worksheet, start_coords: dict = None,
+                        priority: int = INTERACTIVE) -> Optional[tuple[dict, list]]:
     """
     Функция обращается к заданной пользователем Google таблице двумя способами:
     1) в случае, если пользователю передал координаты в формате A1:B1, функция возвращает значения
-    ячеек в этом диапазоне посредством метода .range
+    ячеек в этом диапазоне двумерным массивом посредством метода .get
     2) Если пользователь не передал координаты, то метод .get_all_values() возвращает значения всех заполенных ячеек и коорднаты заполненнго диапазона
     """
-    user_coordinates = {"leftcol": 'A', "leftrow": 1,
-                        "rightcol": 'A', "rightrow":  1}
-    pattern = r"^[A-Z]+[0-9]+:[A-Z]+[0-9]+$"
-    all_values = []
     try:
         if start_coords is None or start_coords == 'dynamic': # случай №2
-            all_values = sheets.get_all_values() # возврат значений всех заполенных ячеек 
-            number_of_columns = len(all_values[0])
-
-            user_coordinates['rightrow'] = len(all_values)
-            user_coordinates['rightcol'] = await converting_of_number(
-                number_of_columns)
+            all_values = await governor.call(sheets.get_all_values, priority=priority) # возврат значений всех заполенных ячеек 
+            user_coordinates = dynamic_coordinates(all_values)
 
         else: # случай №1
-            match = re.match(pattern, start_coords) # проверка корректности передачи диапазона в start_coords
+            user_coordinates = parse_range(start_coords) # проверка корректности передачи диапазона в start_coords
 
-            if match is None:
+            if user_coordinates is None:
                 return False, False
-            values = sheets.range(start_coords) # возврат значений из заданного пользователем диапазона, если он корректно передан в аргумент start_coords
-
-            find_value = r"'([^']*)'"
-            letters = re.findall("[A-Z]+", start_coords)
-            numbers = re.findall(r"\d+", start_coords)
-
-            user_coordinates["leftcol"] = letters[0]
-            user_coordinates["rightcol"] = letters[1]
-            user_coordinates["leftrow"] = int(numbers[0])
-            user_coordinates["rightrow"] = int(numbers[1])
-
-            column_index = column_letter_to_index(user_coordinates["rightcol"])
-
-            cols = column_index
-            rows = len(values)/column_index
-            values = [re.findall(find_value, str(cell))[0] for cell in values]
-
-            all_values = np.reshape(values, (int(rows), int(cols))).tolist()
+            values = await governor.call(sheets.get, start_coords, priority=priority) # возврат значений из заданного пользователем диапазона, если он корректно передан в аргумент start_coords
+            all_values = fit_values(list(values), *range_shape(user_coordinates))
 
     except gspread.exceptions.APIError as ex:
+        if is_stale_handle_error(ex): # таблица удалена или доступ отозван, объект листа больше не годится
+            handle_cache.invalidate_worksheet(sheets)
         log_error(f'Response from search_ranges: gspread.exceptions.APIError: {ex}')
         return None, None
     
     except TypeError as ex:
         log_error(f'Response from search_ranges: TypeError: {ex}')
         return None, None
+
+    except asyncio.TimeoutError:
+        log_error('Response from search_ranges: request timed out')
+        return None, None
     
     return user_coordinates, all_values
 
 
+@instrument('batch_search_ranges')
+async def batch_search_ranges(spreadsheet: gspread.spreadsheet.Spreadsheet,
+                              requests: list[tuple[gspread.worksheet.Worksheet, str]]) -> list[Optional[tuple[dict, list]]]:
+    """
+    Пакетный вариант search_ranges: значения нескольких листов и диапазонов одной Google таблицы
+    запрашиваются одним вызовом values:batchGet.
+    Возвращает для каждого элемента requests пару (координаты диапазона, значения ячеек) в том же формате,
+    что и search_ranges, (False, False) для некорректно заданного диапазона или (None, None) при ошибке API.
+    Если API отклонил пакет с кодом 400 (например, один из листов переименован), диапазоны запрашиваются
+    по отдельности через search_ranges, чтобы ошибка одного диапазона не затрагивала остальные подписки
+
+    :param spreadsheet: Google таблица, которой принадлежат все листы из requests
+    :param requests: список пар (лист, диапазон в формате A1:B1 или 'dynamic')
+    """
+    results: list[Optional[tuple[dict, list]]] = [(None, None)] * len(requests)
+    ranges = []
+    positions = []
+
+    for index, (sheets, start_coords) in enumerate(requests):
+        sheet_title = "'" + sheets.title.replace("'", "''") + "'"
+        if start_coords is None or start_coords == 'dynamic':
+            ranges.append(sheet_title) # весь заполненный диапазон листа
+        elif parse_range(start_coords) is None:
+            results[index] = (False, False)
+            continue
+        else:
+            ranges.append(f"{sheet_title}!{start_coords}")
+        positions.append(index)
+
+    if not ranges:
+        return results
+
+    try:
+        response = await governor.call(spreadsheet.values_batch_get, ranges, priority=BACKGROUND)
+    except gspread.exceptions.APIError as ex:
+        if is_stale_handle_error(ex):
+            handle_cache.invalidate(spreadsheet.title)
+        log_error(f'Response from batch_search_ranges: gspread.exceptions.APIError: {ex}')
+        if ex.response.status_code == 400 and len(positions) > 1:
+            fetched = await asyncio.gather(*(search_ranges(*requests[index], priority=BACKGROUND)
+                                             for index in positions))
+            for index, result in zip(positions, fetched):
+                results[index] = result
+        return results
+    except asyncio.TimeoutError:
+        log_error('Response from batch_search_ranges: request timed out')
+        return results
+
+    for index, value_range in zip(positions, response.get('valueRanges', [])):
+        start_coords = requests[index][1]
+        values = value_range.get('values', [])
+
+        if start_coords is None or start_coords == 'dynamic':
+            # строки выравниваются по самой длинной, как в get_all_values
+            user_coordinates = dynamic_coordinates(values)
+            all_values = fit_values(values, *snapshot_shape(values))
+        else:
+            user_coordinates = parse_range(start_coords)
+            all_values = fit_values(values, *range_shape(user_coordinates))
+        results[index] = (user_coordinates, all_values)
+
+    return results
+
+
+@instrument('fetch_row_block', failed=lambda result: result is None)
+async def fetch_row_block(sheets: gspread.worksheet.Worksheet, first_row: int, last_row: int,
+                          priority: int = BACKGROUND) -> Optional[list]:
+    """
+    Запрос значений строк с first_row по last_row (с единицы) листа sheets. Используется для потокового
+    опроса больших листов, когда get_all_values загрузил бы весь лист в память целиком.
+    Пустые ячейки и строки в конце блока отбрасываются: для пустого диапазона API не возвращает values,
+    и gspread возвращает [[]], который иначе считался бы строкой данных. При ошибке API возвращает None
+    """
+    try:
+        values = await governor.call(sheets.get, f'{first_row}:{last_row}', priority=priority)
+        return trim_rows(list(values))
+
+    except gspread.exceptions.APIError as ex:
+        if is_stale_handle_error(ex):
+            handle_cache.invalidate_worksheet(sheets)
+        log_error(f'Response from fetch_row_block: gspread.exceptions.APIError: {ex}')
+        return None
+
+    except asyncio.TimeoutError:
+        log_error('Response from fetch_row_block: request timed out')
+        return None
+
+
+@instrument('compare_of_ranges', failed=lambda result: result is None)
 async def compare_of_ranges(range_data: list) -> Optional[bool]:
     """
     Функция проверяет размеры массивов (заполенных диапазонов в Google таблице). Относится к случаю №2 из функции search_ranges
-    :range_data: двумерный массив значений ячеек в таблице в два промежутка времени
+    :range_data: снимки (Snapshot или двумерный массив) значений ячеек в таблице в два промежутка времени
     """
     try:
-        range_data_1 = np.array(range_data[0])
-        range_data_2 = np.array(range_data[1])
+        range_data_1 = as_snapshot(range_data[0])
+        range_data_2 = as_snapshot(range_data[1])
         
-        if len(range_data_1) != len(range_data_2) or len(range_data_1[0]) != len(range_data_2[0]): # сравнением массивов длине и ширине
+        if range_data_1.shape != range_data_2.shape: # сравнением массивов длине и ширине
             return False
         
         return True
@@ -128,26 +234,22 @@ async def compare_of_ranges(range_data: list) -> Optional[bool]:
         log_error(f'Response from compare_of_ranges: {ex}')
         return None
 
-async def compare_of_values(data: list) -> Optional[tuple[bool, list[str]]]:
+@instrument('compare_of_values', failed=lambda result: result is None)
+async def compare_of_values(data: list, leftrow: int = 1, leftcol: int = 1) -> Optional[tuple[bool, list[str]]]:
     """
-    Функция сравнивает значения ячеек в два промежутка времени 
+    Функция сравнивает значения ячеек в два промежутка времени.
+    Снимки разного размера дополняются до общего размера, добавленные и удаленные строки и столбцы
+    перечисляются в начале списка изменений. Большие снимки сравниваются в пуле процессов, если он включен.
+    leftrow, leftcol: номера строки и столбца левого верхнего угла диапазона, от которых отсчитываются адреса ячеек
     """
     try:
-        flag = np.array_equal(data[0], data[1])
-        changes = []
-        if not flag:
-            for row_index, (row1, row2) in enumerate(zip(data[0], data[1])):
-                if row1 != row2:
-                    for col_index, (cell1, cell2) in enumerate(zip(row1, row2)):
-                        if cell1 != cell2:
-                            name_col = await converting_of_number(col_index+1)
-                            info = f'{name_col}{row_index+1}: {cell1} -> {cell2}'
-                            changes.append(info)
-            flag = False
-            return flag, changes
-        return flag, changes
+        old, new = as_snapshot(data[0]), as_snapshot(data[1])
+        if old == new: # совпадают размеры и хэши всех строк
+            return True, []
+
+        changes = await snapshot_diff_lines(old, new, leftrow, leftcol)
+        return not changes, changes
     
     except Exception as ex:
         log_error(f'Response from compare_of_values: {ex}')
         return None
-
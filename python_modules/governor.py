@@ -0,0 +1,123 @@
+import asyncio
+import heapq
+import itertools
+import random
+import time
+from typing import Any, Callable, Optional
+
+import gspread
+import requests
+
+from python_modules.notifications import TokenBucket
+from python_modules.sheets_client import run_blocking
+from logs.logger import log_debug
+
+INTERACTIVE = 0 # запросы из обработчиков бота, пользователь ждет ответа
+BACKGROUND = 1 # фоновые опросы таблиц
+
+
+def quota_error_delay(ex: Exception) -> Optional[float]:
+    """
+    Если ex - ошибка превышения квоты Google API (429 / RESOURCE_EXHAUSTED), возвращает задержку
+    из заголовка Retry-After (0, если его нет). Для остальных ошибок возвращает None
+    """
+    if isinstance(ex, gspread.exceptions.APIError):
+        response = ex.response
+    elif isinstance(ex, requests.HTTPError):
+        response = ex.response
+    else:
+        return None
+    if response is None:
+        return None
+
+    if response.status_code != 429 and 'RESOURCE_EXHAUSTED' not in str(ex):
+        return None
+    try:
+        return float(response.headers.get('Retry-After', 0))
+    except ValueError:
+        return 0.0
+
+
+class ApiGovernor:
+    """
+    Единая точка выполнения запросов к Google Sheets и Drive API.
+    Частота запросов ограничивается ведром токенов по квоте проекта, свободные токены выдаются
+    сначала интерактивным запросам, затем фоновым. При ошибке квоты все запросы приостанавливаются
+    с экспоненциально растущей задержкой со случайным разбросом, после чего запрос повторяется
+
+    rate_per_minute: допустимое количество запросов в минуту
+    burst: допустимый всплеск запросов
+    max_retries: количество повторов запроса после ошибки квоты
+    base_delay, max_delay: начальная и максимальная задержка после ошибки квоты в секундах
+    """
+    def __init__(self, rate_per_minute: float = 60, burst: float = 10, max_retries: int = 5,
+                 base_delay: float = 2, max_delay: float = 64):
+        self._bucket = TokenBucket(rate_per_minute / 60, burst)
+        self._max_retries = max_retries
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._backoff_until = 0.0
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._counter = itertools.count()
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+        self.stats = {'calls': 0, 'quota_errors': 0, 'waiting': 0}
+
+    def configure(self, rate_per_minute: float, burst: float) -> None:
+        self._bucket = TokenBucket(rate_per_minute / 60, burst)
+
+    async def call(self, func: Callable, *args, priority: int = BACKGROUND, **kwargs) -> Any:
+        """
+        Выполнение синхронного вызова gspread или Drive API с учетом квоты
+        """
+        for attempt in range(self._max_retries + 1):
+            await self._acquire(priority)
+            self.stats['calls'] += 1
+            try:
+                return await run_blocking(func, *args, **kwargs)
+            except Exception as ex:
+                retry_after = quota_error_delay(ex)
+                if retry_after is None or attempt == self._max_retries:
+                    raise
+                self.stats['quota_errors'] += 1
+                delay = max(retry_after, min(self._max_delay, self._base_delay * 2 ** attempt) * random.uniform(0.5, 1.5))
+                self._backoff(delay)
+                log_debug(f'Google API quota exceeded, backing off for {delay:.1f} s')
+
+    def _backoff(self, delay: float) -> None:
+        self._backoff_until = max(self._backoff_until, time.monotonic() + delay)
+        self._bucket.tokens = min(self._bucket.tokens, 0)
+
+    async def _acquire(self, priority: int) -> None:
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        self.stats['waiting'] += 1
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        self._wakeup.set()
+        try:
+            await future
+        finally:
+            self.stats['waiting'] -= 1
+
+    async def _dispatch(self) -> None:
+        """
+        Выдача токенов ожидающим запросам в порядке приоритета
+        """
+        while self._waiters:
+            wait = max(self._backoff_until - time.monotonic(), self._bucket.delay())
+            if wait > 0:
+                self._wakeup.clear()
+                try: # ожидание прерывается, если появился запрос с более высоким приоритетом или новая пауза
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done(): # запрос мог быть отменен по таймауту
+                self._bucket.consume()
+                future.set_result(None)
+
+
+governor = ApiGovernor()
@@ -0,0 +1,176 @@
+import functools
+import math
+import time
+from typing import Any, Callable, Optional
+
+from aiohttp import web
+
+from logs.logger import log_debug, log_error
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ''
+    escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    pairs = ','.join(f'{name}="{escape(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Metric:
+    """
+    Метрика в формате Prometheus с необязательными метками. Значения для разных значений меток
+    хранятся отдельно, значение без меток можно вычислять при каждом запросе через set_function
+    """
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: dict[tuple, Any] = {}
+        self._function: Optional[Callable[[], float]] = None
+        registry.register(self)
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        self._function = function
+
+    def _key(self, labels: tuple) -> tuple:
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {labels}')
+        return tuple(str(label) for label in labels)
+
+    def samples(self) -> list[tuple[str, tuple, tuple, float]]:
+        if self._function is not None:
+            return [(self.name, (), (), self._function())]
+        return [(self.name, self.labelnames, key, value) for key, value in self._values.items()]
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for name, labelnames, labels, value in self.samples():
+            lines.append(f'{name}{format_labels(labelnames, labels)} {format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, *labels) -> None:
+        self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    """
+    Гистограмма распределения значений (обычно длительностей в секундах) по корзинам buckets
+    """
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, *labels) -> None:
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[0][index] += 1
+        state[1] += value
+        state[2] += 1
+
+    def samples(self) -> list[tuple[str, tuple, tuple, float]]:
+        samples = []
+        for key, (counts, total, count) in self._values.items():
+            for bound, bucket_count in zip(self.buckets, counts):
+                samples.append((f'{self.name}_bucket', self.labelnames + ('le',), key + (format_value(bound),), bucket_count))
+            samples.append((f'{self.name}_sum', self.labelnames, key, total))
+            samples.append((f'{self.name}_count', self.labelnames, key, count))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: list[Metric] = []
+
+    def register(self, metric: Metric) -> None:
+        self._metrics.append(metric)
+
+    def render(self) -> str:
+        """
+        Все метрики в текстовом формате Prometheus 0.0.4
+        """
+        return '\n'.join(metric.render() for metric in self._metrics) + '\n'
+
+
+registry = Registry()
+
+operation_duration = Histogram('sheets_bot_operation_duration_seconds',
+                               'Duration of instrumented operations', ('operation',))
+operation_total = Counter('sheets_bot_operation_total',
+                          'Instrumented operations by outcome: ok, failed (error result) or error (exception)',
+                          ('operation', 'outcome'))
+
+
+def instrument(operation: str, failed: Optional[Callable[[Any], bool]] = None) -> Callable:
+    """
+    Декоратор корутины: длительность вызовов и количество вызовов по результату.
+    Функции бота обычно не пробрасывают исключения, а возвращают None или (None, None),
+    поэтому неуспешный результат определяется функцией failed
+    """
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            outcome = 'error'
+            try:
+                result = await func(*args, **kwargs)
+                outcome = 'failed' if failed is not None and failed(result) else 'ok'
+                return result
+            finally:
+                operation_duration.observe(time.perf_counter() - started, operation)
+                operation_total.inc(operation, outcome)
+        return wrapper
+    return decorator
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(body=registry.render().encode(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+async def start_metrics_server(host: str, port: int, span: int = 1) -> Optional[web.AppRunner]:
+    """
+    Запуск HTTP сервера с метриками по адресу http://host:port/metrics. Если порт занят, например другим
+    процессом опроса на том же хосте, пробуются следующие порты, всего span портов.
+    Если свободного порта нет, бот работает без метрик и возвращается None
+    """
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    for candidate in range(port, port + max(span, 1)):
+        try:
+            await web.TCPSite(runner, host, candidate).start()
+        except OSError:
+            continue
+        log_debug(f'Metrics endpoint has started on {host}:{candidate}')
+        return runner
+    log_error(f'Metrics endpoint has not started: ports {port}-{port + max(span, 1) - 1} on {host} are busy')
+    await runner.cleanup()
+    return None
@@ -1,6 +1,5 @@
 from typing import Optional
 
-import aiomysql
 import pymysql
 
 from logs.logger import log_debug, log_error
@@ -22,22 +21,6 @@ def server_connect_check(host: str, port: int, user: str, password: str) -> Opti
         log_error(f"Server connection error: {ex}")
         return None
 
-async def db_connection_check(host: str, port: int, user: str, password: str, user_id: int) -> Optional[aiomysql.Connection]:
-    """
-    Асинхронная функция проверки соединения с сервером mysql
-    """
-    try:
-        conn = await aiomysql.connect(host=host,
-                                        port=port,
-                                        user=user,
-                                        password=password)
-        log_debug(f'User {user_id} has seccessful connectioned to database')
-        return conn
-    
-    except Exception as ex:
-        log_error(f"Server connection error: {ex}")
-        return None
-
 def create_database(conn: pymysql.Connection, db_name: str) -> None:
     """
     Создание базы данных db_name, если она еще не создана
@@ -105,6 +88,58 @@ def create_tables(conn: pymysql.Connection, db_name: str) -> None:
                     """
                 )
                 log_debug('tables seccessful created')
+
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS spreadsheets_snapshots
+                (
+                    table_id int(11) NOT NULL,
+                    file_version varchar(64),
+                    snapshot_data LONGBLOB NOT NULL,
+                    updated_time DATETIME NOT NULL,
+                    PRIMARY KEY (table_id),
+                    FOREIGN KEY (table_id) REFERENCES spreadsheets_users_data (id) ON DELETE CASCADE
+                )
+                """
+            ) # таблица снимков создается и в уже развернутых базах
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS notifications_outbox
+                (
+                    id bigint NOT NULL AUTO_INCREMENT,
+                    chat_id bigint NOT NULL,
+                    message_text TEXT NOT NULL,
+                    attempts int(11) NOT NULL DEFAULT 0,
+                    next_attempt DATETIME NOT NULL,
+                    created_time DATETIME NOT NULL,
+                    PRIMARY KEY (id),
+                    KEY (next_attempt)
+                )
+                """
+            ) # очередь исходящих уведомлений
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS poller_workers
+                (
+                    worker_id varchar(64) NOT NULL,
+                    heartbeat_time DATETIME NOT NULL,
+                    PRIMARY KEY (worker_id),
+                    KEY (heartbeat_time)
+                )
+                """
+            ) # работающие процессы опроса таблиц
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS poller_leases
+                (
+                    shard_id int(11) NOT NULL,
+                    worker_id varchar(64),
+                    expires_time DATETIME NOT NULL,
+                    PRIMARY KEY (shard_id),
+                    KEY (worker_id)
+                )
+                """
+            ) # аренда шардов подписок процессами опроса
             return None
         
     except Exception as ex:
@@ -0,0 +1,156 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Optional
+
+from logs.logger import log_debug, log_error
+
+MESSAGE_LIMIT = 4096 # максимальная длина сообщения Telegram
+
+
+class TokenBucket:
+    """
+    Ведро токенов: не более rate событий в секунду в среднем, с допустимым всплеском до capacity событий
+    """
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """
+        Время в секундах до появления свободного токена
+        """
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def consume(self) -> None:
+        self.tokens -= 1
+
+    @property
+    def full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class RateLimiter:
+    """
+    Ограничение частоты отправки сообщений с учетом лимитов Telegram: общее ведро на весь бот
+    и отдельное ведро на каждый чат
+
+    global_rate: сообщений в секунду на весь бот
+    chat_rate: сообщений в секунду в один чат
+    chat_burst: допустимый всплеск сообщений в один чат
+    """
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, chat_burst: float = 3):
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._chats: dict[int, TokenBucket] = {}
+
+    async def acquire(self, chat_id: int) -> None:
+        """
+        Ожидание, пока отправка сообщения в чат chat_id не будет укладываться в оба лимита
+        """
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000: # удаление ведер давно неактивных чатов
+                self._chats = {key: value for key, value in self._chats.items() if not value.full}
+            bucket = self._chats[chat_id] = TokenBucket(self._chat_rate, self._chat_burst)
+
+        while True:
+            wait = max(self._global.delay(), bucket.delay())
+            if wait <= 0:
+                self._global.consume()
+                bucket.consume()
+                return
+            await asyncio.sleep(wait)
+
+
+def chunk_messages(header: str, lines: list[str], limit: int = MESSAGE_LIMIT) -> list[str]:
+    """
+    Разбиение списка строк на сообщения не длиннее limit символов, каждое сообщение начинается с header.
+    Слишком длинные строки обрезаются
+    """
+    messages = []
+    current = header
+    for line in lines:
+        if len(header) + 1 + len(line) > limit:
+            line = line[:limit - len(header) - 2] + '…'
+        if len(current) + 1 + len(line) > limit:
+            messages.append(current)
+            current = header
+        current += '\n' + line
+    messages.append(current)
+    return messages
+
+
+class Notifier:
+    """
+    Сборщик уведомлений об изменениях. Все изменения, поступившие в чат за debounce секунд,
+    объединяются в несколько сообщений не длиннее лимита Telegram и передаются в send
+
+    send: корутина отправки сообщения (chat_id, text)
+    limiter: ограничитель частоты отправки, не нужен, если send сам учитывает лимиты
+    debounce: окно накопления изменений в секундах
+    """
+    def __init__(self, send: Callable[[int, str], Awaitable], limiter: Optional[RateLimiter] = None, debounce: float = 0):
+        self._send = send
+        self._limiter = limiter
+        self._debounce = debounce
+        self._pending: dict[int, dict[str, list[str]]] = {}
+        self._flushers: dict[int, asyncio.Task] = {} # задачи, ожидающие окончания окна debounce
+        self._tasks: set[asyncio.Task] = set()
+        self._closing = asyncio.Event() # прерывает ожидание окна debounce, но не начатую отправку
+
+    @property
+    def pending(self) -> int:
+        """
+        Количество строк изменений, ожидающих окончания окна debounce
+        """
+        return sum(len(lines) for headers in self._pending.values() for lines in headers.values())
+
+    def notify(self, chat_id: int, header: str, lines: list[str]) -> None:
+        """
+        Постановка изменений в очередь отправки. Строки с одинаковым заголовком объединяются
+        """
+        if not lines:
+            return
+        self._pending.setdefault(chat_id, {}).setdefault(header, []).extend(lines)
+        if chat_id not in self._flushers:
+            task = asyncio.create_task(self._flush(chat_id))
+            self._flushers[chat_id] = task
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _flush(self, chat_id: int) -> None:
+        try: # при закрытии накопленные уведомления отправляются сразу
+            await asyncio.wait_for(self._closing.wait(), self._debounce)
+        except asyncio.TimeoutError:
+            pass
+        del self._flushers[chat_id]
+        pending = self._pending.pop(chat_id, {})
+
+        messages = [text for header, lines in pending.items() for text in chunk_messages(header, lines)]
+        for text in messages:
+            if self._limiter is not None:
+                await self._limiter.acquire(chat_id)
+            try:
+                await self._send(chat_id, text)
+            except Exception as ex:
+                log_error(f'Response from Notifier, chat {chat_id}: {ex}')
+        log_debug(f'{len(messages)} notifications have sent to chat {chat_id}')
+
+    async def close(self) -> None:
+        """
+        Отправка накопленных уведомлений без ожидания окна debounce. Задачи отправки не отменяются,
+        чтобы не потерять сообщения, которые уже передаются в send, и close ждет их завершения
+        """
+        self._closing.set()
+        while self._tasks: # во время отправки могли появиться новые изменения
+            await asyncio.gather(*self._tasks, return_exceptions=True)
@@ -0,0 +1,228 @@
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Awaitable, Callable, Optional
+
+from logs.logger import log_debug, log_error
+
+
+class TrackingJob:
+    """
+    Описание подписки пользователя на отслеживание изменений в Google таблице
+
+    job_id: номер таблицы в spreadsheets_users_data
+    user_id: телеграм ID пользователя
+    table_name: название таблицы
+    sheet_number: номер листа таблицы
+    user_range: диапазон отслеживания. Либо в формате A1:B1, либо 'dynamic'
+    interval_value: интервал проверки изменений в таблице в секундах, в адаптивном режиме - минимальный интервал
+    """
+    def __init__(self, job_id: int, user_id: int, table_name: str, sheet_number: int,
+                 user_range: str, interval_value: int):
+        self.job_id = job_id
+        self.user_id = user_id
+        self.table_name = table_name
+        self.sheet_number = sheet_number
+        self.user_range = user_range
+        self.interval_value = interval_value
+        self.current_interval = interval_value # текущий интервал опроса в адаптивном режиме
+        self.changed = False # нашел ли последний опрос изменения в таблице
+        self.snapshot = None # значения ячеек, полученные при предыдущем опросе таблицы
+        self.file_version = None # версия файла Google таблицы, к которой относится snapshot
+        self.snapshot_loaded = False # был ли снимок загружен из базы после запуска
+        self.next_run = 0.0
+        self.running = False
+        self.generation = 0 # увеличивается при каждой постановке в очередь, устаревшие записи кучи пропускаются
+
+
+class Scheduler:
+    """
+    Планировщик опроса отслеживаемых таблиц. Все подписки хранятся в куче по времени следующего опроса,
+    одновременно выполняется не более concurrency опросов.
+    Подписки на одну и ту же Google таблицу, срок опроса которых наступает в пределах batch_window секунд,
+    передаются в poll одной группой, чтобы получить их значения одним запросом.
+    Задания можно добавлять, переносить и удалять на лету из обработчиков бота.
+    В адаптивном режиме (adaptive_factor > 1) интервал опроса таблицы, в которой не нашлось изменений,
+    увеличивается в adaptive_factor раз, но не выше max_interval, а после найденного изменения
+    возвращается к интервалу, заданному пользователем
+    """
+    def __init__(self, poll: Callable[[list[TrackingJob]], Awaitable[None]], concurrency: int,
+                 min_interval: int = 1, batch_window: float = 0, adaptive_factor: float = 1,
+                 max_interval: int = 0):
+        self._poll = poll
+        self._min_interval = max(min_interval, 1)
+        self._batch_window = batch_window
+        self._adaptive_factor = adaptive_factor
+        self._max_interval = max_interval
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._wakeup = asyncio.Event()
+        self._jobs: dict[int, TrackingJob] = {}
+        self._groups: dict[str, set[int]] = {} # номера подписок, сгруппированные по названию таблицы
+        self._heap: list[tuple[float, int, int, int]] = []
+        self._counter = itertools.count()
+        self._tasks: set[asyncio.Task] = set()
+        self._runner: Optional[asyncio.Task] = None
+        self.stats = {'dispatched': 0, 'lag': 0.0} # lag - опоздание последнего запущенного опроса в секундах
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+    def __contains__(self, job_id: int) -> bool:
+        return job_id in self._jobs
+
+    def overdue(self) -> int:
+        """
+        Количество подписок, время опроса которых уже наступило, но опрос еще не начат.
+        Растет, если планировщик не успевает опрашивать таблицы с заданной периодичностью
+        """
+        now = time.monotonic()
+        return sum(1 for job in self._jobs.values() if not job.running and job.next_run <= now)
+
+    def jobs(self) -> list[TrackingJob]:
+        return list(self._jobs.values())
+
+    def get_job(self, job_id: int) -> Optional[TrackingJob]:
+        return self._jobs.get(job_id)
+
+    def add_job(self, job: TrackingJob, delay: float = 0) -> None:
+        """
+        Регистрация подписки. Первый опрос выполняется через delay секунд.
+        Если подписка с таким номером уже есть, она заменяется
+        """
+        self.remove_job(job.job_id)
+        self._jobs[job.job_id] = job
+        self._groups.setdefault(job.table_name, set()).add(job.job_id)
+        self._push(job, time.monotonic() + delay)
+        log_debug(f'Job {job.job_id} of user {job.user_id} has scheduled')
+
+    def remove_job(self, job_id: int) -> None:
+        """
+        Отмена подписки. Запись в куче удаляется лениво при ее извлечении
+        """
+        job = self._jobs.pop(job_id, None)
+        if job is not None:
+            group = self._groups.get(job.table_name)
+            group.discard(job_id)
+            if not group:
+                del self._groups[job.table_name]
+            self._wakeup.set()
+            log_debug(f'Job {job_id} has removed from scheduler')
+
+    def reschedule(self, job_id: int, interval_value: Optional[int] = None, delay: float = 0) -> None:
+        """
+        Перенос опроса подписки, при необходимости с новым интервалом
+        """
+        job = self._jobs.get(job_id)
+        if job is None:
+            return
+        if interval_value is not None:
+            job.interval_value = interval_value
+            job.current_interval = interval_value
+        self._push(job, time.monotonic() + delay)
+
+    def start(self) -> None:
+        """
+        Запуск планировщика в текущем цикле событий
+        """
+        if self._runner is None or self._runner.done():
+            self._runner = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            self._runner.cancel()
+            try:
+                await self._runner
+            except asyncio.CancelledError:
+                pass
+        for task in list(self._tasks):
+            task.cancel()
+
+    def _push(self, job: TrackingJob, due: float) -> None:
+        job.generation += 1
+        job.next_run = due
+        heapq.heappush(self._heap, (due, next(self._counter), job.job_id, job.generation))
+        self._wakeup.set()
+
+    def _pop_due(self, now: float) -> Optional[TrackingJob]:
+        """
+        Извлечение из кучи ближайшего подошедшего по времени задания, устаревшие записи отбрасываются
+        """
+        while self._heap and self._heap[0][0] <= now:
+            _, _, job_id, generation = heapq.heappop(self._heap)
+            job = self._jobs.get(job_id)
+            if job is not None and job.generation == generation:
+                return job
+        return None
+
+    def _pop_due_group(self, now: float) -> list[TrackingJob]:
+        """
+        Извлечение подошедшего задания вместе с остальными подписками на ту же таблицу,
+        срок опроса которых наступает в пределах batch_window
+        """
+        job = self._pop_due(now)
+        if job is None:
+            return []
+
+        group = [job]
+        for job_id in self._groups.get(job.table_name, ()):
+            other = self._jobs[job_id]
+            if other is not job and not other.running and other.next_run <= now + self._batch_window:
+                other.generation += 1 # запись в куче этой подписки становится устаревшей
+                group.append(other)
+        return group
+
+    async def run(self) -> None:
+        """
+        Основной цикл планировщика: спит до ближайшего времени опроса и отдает подошедшие задания на выполнение
+        """
+        while True:
+            now = time.monotonic()
+            group = self._pop_due_group(now)
+            if group:
+                self.stats['dispatched'] += 1
+                for job in group:
+                    job.running = True
+                    job.changed = False
+                await self._semaphore.acquire() # ограничение количества одновременных опросов
+                # опоздание учитывает и ожидание свободного места среди POLL_CONCURRENCY опросов
+                self.stats['lag'] = time.monotonic() - group[0].next_run
+                task = asyncio.create_task(self._execute(group))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+                continue
+
+            timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _execute(self, group: list[TrackingJob]) -> None:
+        started = time.monotonic()
+        generations = [job.generation for job in group]
+        try:
+            await self._poll(group)
+        except Exception as ex:
+            log_error(f'Response from scheduler jobs {[job.job_id for job in group]}: {ex}')
+        finally:
+            self._semaphore.release()
+
+        for job, generation in zip(group, generations):
+            job.running = False
+            # повторная постановка в очередь, если подписку не удалили и не перенесли во время опроса
+            if self._jobs.get(job.job_id) is job and job.generation == generation:
+                interval = max(self._next_interval(job), self._min_interval)
+                self._push(job, max(started + interval, time.monotonic()))
+
+    def _next_interval(self, job: TrackingJob) -> float:
+        """
+        Интервал до следующего опроса с учетом адаптивного режима
+        """
+        if self._adaptive_factor <= 1 or job.changed:
+            job.current_interval = job.interval_value
+        else:
+            upper = max(job.interval_value, self._max_interval)
+            job.current_interval = min(upper, job.current_interval * self._adaptive_factor)
+        return job.current_interval
@@ -0,0 +1,91 @@
+import asyncio
+import math
+import time
+from typing import Awaitable, Callable, Optional
+
+from python_modules.db_functions import acquire_connection, init_leases, renew_leases, alive_workers
+from python_modules.db_functions import claim_shards, release_shards, remove_worker
+from logs.logger import log_debug, log_error
+
+
+class LeaseManager:
+    """
+    Распределение шардов подписок между процессами опроса через строки аренды в таблице poller_leases.
+    Каждые renew_interval секунд процесс продлевает аренду своих шардов и отмечается в poller_workers,
+    затем выравнивает количество своих шардов до ceil(shard_count / количество работающих процессов):
+    лишние шарды освобождает для новых процессов, недостающие захватывает среди свободных и просроченных.
+    Если процесс остановился, аренда его шардов истекает через lease_ttl секунд и их забирают остальные.
+    После каждого цикла вызывается sync с текущим набором шардов процесса
+
+    worker_id: уникальный идентификатор процесса
+    shard_count: количество шардов, одинаковое для всех процессов
+    lease_ttl: срок аренды в секундах
+    renew_interval: период продления аренды в секундах, должен быть заметно меньше lease_ttl
+    sync: корутина, которая приводит опрашиваемые подписки к набору шардов
+    """
+    def __init__(self, worker_id: str, shard_count: int, lease_ttl: int, renew_interval: float,
+                 sync: Callable[[set[int]], Awaitable[None]]):
+        self.worker_id = worker_id
+        self.shard_count = shard_count
+        self.lease_ttl = lease_ttl
+        self.renew_interval = renew_interval
+        self.shards: set[int] = set()
+        self._sync = sync
+        self._renewed = time.monotonic()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Остановка с освобождением шардов, чтобы другие процессы забрали их сразу, не дожидаясь истечения аренды
+        """
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        try:
+            async with acquire_connection() as conn:
+                await release_shards(conn, self.worker_id, sorted(self.shards))
+                await remove_worker(conn, self.worker_id)
+        except Exception as ex:
+            log_error(f'Response from LeaseManager.stop: {ex}')
+        self.shards = set()
+
+    async def _run(self) -> None:
+        initialized = False
+        while True:
+            try:
+                if not initialized: # если база недоступна при запуске, строки аренды создаются в следующих циклах
+                    async with acquire_connection() as conn:
+                        initialized = await init_leases(conn, self.shard_count) is not None
+                await self._rebalance()
+                await self._sync(set(self.shards))
+            except Exception as ex:
+                log_error(f'Response from LeaseManager: {ex}')
+            await asyncio.sleep(self.renew_interval)
+
+    async def _rebalance(self) -> None:
+        async with acquire_connection() as conn:
+            owned = await renew_leases(conn, self.worker_id, self.lease_ttl)
+            if owned is None: # база недоступна: после истечения аренды шарды могут опрашивать другие процессы
+                if time.monotonic() - self._renewed > self.lease_ttl:
+                    self._update(set())
+                return
+
+            workers = await alive_workers(conn, self.lease_ttl) or 1
+            target = math.ceil(self.shard_count / workers)
+            if len(owned) > target: # появились новые процессы, часть шардов передается им
+                await release_shards(conn, self.worker_id, sorted(owned)[target:])
+                owned = sorted(owned)[:target]
+            elif len(owned) < target:
+                await claim_shards(conn, self.worker_id, target - len(owned), self.lease_ttl)
+                owned = await renew_leases(conn, self.worker_id, self.lease_ttl) or owned
+
+        self._renewed = time.monotonic()
+        self._update(set(owned))
+
+    def _update(self, shards: set[int]) -> None:
+        if shards != self.shards:
+            log_debug(f'Worker {self.worker_id} holds {len(shards)} of {self.shard_count} shards')
+        self.shards = shards
@@ -0,0 +1,57 @@
+import weakref
+from typing import Optional
+
+import gspread
+
+
+def subscription_key(sheets: gspread.worksheet.Worksheet, user_range: str) -> tuple[str, int, str]:
+    """
+    Канонический ключ подписки: идентификатор файла Google таблицы, идентификатор листа и диапазон.
+    Подписки разных пользователей с одинаковым ключом отслеживают одни и те же ячейки
+    """
+    return sheets.spreadsheet.id, sheets.id, user_range
+
+
+class SnapshotRegistry:
+    """
+    Последний полученный снимок для каждого ключа подписки вместе с версией файла, с которой он сделан.
+    Подписки с одинаковым ключом ссылаются на один и тот же объект снимка, а опрос подписки,
+    срок которой наступил после опроса соседней, берет уже полученный снимок той же версии файла без запроса к API.
+    Снимки хранятся по слабым ссылкам: запись исчезает, когда снимок не нужен ни одной подписке
+    """
+    def __init__(self):
+        self._entries: dict[tuple, tuple[str, weakref.ref]] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: tuple, file_version: Optional[str]):
+        """
+        Снимок для ключа key, сделанный с версии файла file_version, или None
+        """
+        entry = self._entries.get(key)
+        if entry is None or file_version is None or entry[0] != file_version:
+            return None
+        return entry[1]()
+
+    def set(self, key: tuple, file_version: Optional[str], snapshot) -> None:
+        if file_version is None: # без версии файла нельзя проверить, что снимок не устарел
+            self._entries.pop(key, None)
+            return
+        self._entries[key] = (file_version, weakref.ref(snapshot, lambda _, key=key: self._discard(key)))
+
+    def intern(self, key: tuple, file_version: Optional[str], snapshot):
+        """
+        Замена снимка, загруженного из базы, уже имеющимся в памяти объектом той же версии файла
+        """
+        shared = self.get(key, file_version)
+        if shared is None:
+            self.set(key, file_version, snapshot)
+        elif shared == snapshot:
+            return shared
+        return snapshot
+
+    def _discard(self, key: tuple) -> None:
+        entry = self._entries.get(key)
+        if entry is not None and entry[1]() is None:
+            del self._entries[key]
@@ -0,0 +1,186 @@
+import asyncio
+import functools
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Any, Callable, Hashable, Optional
+
+import gspread
+from google.auth.transport.requests import AuthorizedSession
+from google.oauth2.service_account import Credentials
+
+from logs.logger import log_debug
+
+DRIVE_FILES_URL = 'https://www.googleapis.com/drive/v3/files/{}'
+GOOGLE_API_HOSTS = ('https://sheets.googleapis.com', 'https://www.googleapis.com')
+
+_credentials: Optional[Credentials] = None
+_client: Optional[gspread.Client] = None
+_session: Optional[AuthorizedSession] = None
+_client_lock = Lock()
+
+_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='sheets')
+_timeout = 30.0
+
+
+def configure_executor(max_workers: int, timeout: float) -> None:
+    """
+    Настройка пула потоков для обращений к Google API
+
+    :param max_workers: максимальное количество одновременных обращений к API
+    :param timeout: ограничение времени одного обращения в секундах
+    """
+    global _executor, _timeout
+    old_executor = _executor
+    _executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='sheets')
+    _timeout = timeout
+    old_executor.shutdown(wait=False)
+
+
+async def run_blocking(func: Callable, *args, timeout: Optional[float] = None, **kwargs) -> Any:
+    """
+    Выполнение синхронного вызова gspread в пуле потоков, чтобы не блокировать цикл событий бота.
+    Если вызов не уложился в timeout, возбуждается asyncio.TimeoutError (сам поток завершится позже)
+    """
+    loop = asyncio.get_running_loop()
+    call = functools.partial(func, *args, **kwargs)
+    return await asyncio.wait_for(loop.run_in_executor(_executor, call), timeout or _timeout)
+
+
+def configure_api_base(base_url: str) -> None:
+    """
+    Перенаправление запросов gspread и Drive API на другой сервер, например на локальную замену Google API
+    при нагрузочном тестировании. Адреса gspread хранятся в константах модулей, поэтому они переписываются на месте
+
+    :param base_url: адрес сервера без завершающего слэша, например http://127.0.0.1:8081
+    """
+    global DRIVE_FILES_URL
+    for module in (gspread.urls, gspread.http_client, gspread.client, gspread.spreadsheet, gspread.worksheet):
+        for name, value in list(vars(module).items()):
+            if name.isupper() and isinstance(value, str) and value.startswith(GOOGLE_API_HOSTS):
+                for host in GOOGLE_API_HOSTS:
+                    value = value.replace(host, base_url)
+                setattr(module, name, value)
+    DRIVE_FILES_URL = DRIVE_FILES_URL.replace(GOOGLE_API_HOSTS[1], base_url)
+    log_debug(f'Google API requests are redirected to {base_url}')
+
+
+def get_client(account_file: str, scopes: list) -> gspread.Client:
+    """
+    Возвращает авторизованный клиент gspread. Авторизация выполняется один раз на процесс,
+    токен доступа обновляется автоматически сессией google.auth по истечении срока действия
+
+    :param account_file: файл с правами доступа
+    :param scopes: настройки прав доступа
+    """
+    global _credentials, _client
+    with _client_lock:
+        if _client is None:
+            _credentials = Credentials.from_service_account_file(account_file, scopes=scopes)
+            _client = gspread.authorize(_credentials)
+            log_debug('Google service account has authorized')
+        return _client
+
+
+def get_session(account_file: str, scopes: list) -> AuthorizedSession:
+    """
+    Возвращает авторизованную HTTP сессию для запросов к Drive API с теми же учетными данными, что и у клиента gspread
+    """
+    global _session
+    get_client(account_file, scopes)
+    with _client_lock:
+        if _session is None:
+            _session = AuthorizedSession(_credentials)
+        return _session
+
+
+def get_file_version(account_file: str, scopes: list, file_id: str) -> str:
+    """
+    Запрос к Drive API версии файла. Ответ содержит только поля version и modifiedTime,
+    поэтому он намного дешевле получения значений ячеек.
+    Возвращает строку, которая меняется при любом изменении файла
+    """
+    session = get_session(account_file, scopes)
+    response = session.get(DRIVE_FILES_URL.format(file_id),
+                           params={'fields': 'version,modifiedTime', 'supportsAllDrives': 'true'},
+                           timeout=_timeout)
+    response.raise_for_status()
+    data = response.json()
+    return f"{data['version']}:{data['modifiedTime']}"
+
+
+class HandleCache:
+    """
+    LRU кэш с ограничением времени жизни записей для объектов Spreadsheet и Worksheet,
+    чтобы не искать таблицу по названию через Drive при каждом опросе
+
+    max_size: максимальное количество записей
+    ttl: время жизни записи в секундах
+    """
+    def __init__(self, max_size: int, ttl: int):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._lock = Lock()
+
+    def configure(self, max_size: int, ttl: int) -> None:
+        with self._lock:
+            self._max_size = max_size
+            self._ttl = ttl
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + self._ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self._max_size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, spreadsheet_name: str) -> None:
+        """
+        Удаление из кэша таблицы и всех ее листов
+        """
+        with self._lock:
+            for key in [key for key in self._data if key[0] == spreadsheet_name]:
+                del self._data[key]
+        log_debug(f'Handles of spreadsheet {spreadsheet_name} have invalidated')
+
+    def invalidate_worksheet(self, sheets: gspread.worksheet.Worksheet) -> None:
+        """
+        Удаление из кэша таблицы, которой принадлежит лист sheets
+        """
+        with self._lock:
+            names = {key[0] for key, (_, value) in self._data.items() if value is sheets}
+        for name in names:
+            self.invalidate(name)
+
+
+handle_cache = HandleCache(max_size=512, ttl=900)
+
+
+def is_stale_handle_error(ex: Exception) -> bool:
+    """
+    Ошибки, после которых сохраненный объект таблицы больше не годится:
+    таблица удалена, переименована или у сервисного аккаунта отозван доступ.
+    Диапазон с названием переименованного или удаленного листа API отклоняет с кодом 400 и сообщением
+    Unable to parse range
+    """
+    if isinstance(ex, (gspread.exceptions.SpreadsheetNotFound, gspread.exceptions.WorksheetNotFound)):
+        return True
+    if isinstance(ex, gspread.exceptions.APIError):
+        if ex.response.status_code == 400:
+            return 'Unable to parse range' in str(ex.error.get('message', ''))
+        return ex.response.status_code in (403, 404)
+    return False
@@ -0,0 +1,103 @@
+import asyncio
+import hmac
+import time
+from typing import Awaitable, Callable, Optional
+
+from aiogram import types
+from aiogram.dispatcher.webhook import WebhookRequestHandler, RESPONSE_TIMEOUT
+from aiohttp import web
+
+from logs.logger import log_debug, log_error
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class UpdateLimiter:
+    """
+    Ограничение количества одновременно обрабатываемых обновлений в режиме вебхука.
+    Обновления сверх лимита ждут свободного места, не занимая обработчики бота и соединения с базой,
+    а Telegram не присылает новые обновления, пока заняты все его max_connections соединения.
+    Место освобождается по окончании обработки обновления, даже если Telegram уже получил ответ по таймауту
+
+    limit: максимальное количество одновременно обрабатываемых обновлений
+    """
+    def __init__(self, limit: int = 64):
+        self._semaphore = asyncio.Semaphore(limit)
+        self._tasks: set[asyncio.Task] = set()
+        self.secret: Optional[str] = None
+        self.draining = False
+
+    def configure(self, limit: int, secret: Optional[str] = None) -> None:
+        self._semaphore = asyncio.Semaphore(limit)
+        self.secret = secret
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._tasks)
+
+    async def start(self, func: Callable[..., Awaitable], *args) -> asyncio.Task:
+        """
+        Запуск обработки обновления после получения свободного места
+        """
+        semaphore = self._semaphore
+        await semaphore.acquire()
+        if self.draining: # обновление ждало свободного места, пока бот начал останавливаться
+            semaphore.release()
+            raise web.HTTPServiceUnavailable()
+        task = asyncio.create_task(func(*args))
+        self._tasks.add(task)
+
+        def release(task: asyncio.Task) -> None:
+            self._tasks.discard(task)
+            semaphore.release()
+        task.add_done_callback(release)
+        return task
+
+    async def drain(self, timeout: float) -> None:
+        """
+        Ожидание окончания обработки уже принятых обновлений при остановке бота.
+        Открытые соединения Telegram после закрытия сокета сервера продолжают присылать обновления,
+        поэтому новые обновления отклоняются (Telegram отправит их повторно), а ожидание продолжается,
+        пока не завершатся все обновления, в том числе принятые во время ожидания
+        """
+        self.draining = True
+        if self._tasks:
+            log_debug(f'Waiting for {len(self._tasks)} webhook updates to finish')
+        deadline = time.monotonic() + timeout
+        while self._tasks:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                log_error(f'{len(self._tasks)} webhook updates are still running after {timeout} s')
+                return
+            await asyncio.wait(set(self._tasks), timeout=remaining)
+
+
+update_limiter = UpdateLimiter()
+
+
+class BoundedWebhookHandler(WebhookRequestHandler):
+    """
+    Обработчик вебхука aiogram, который проверяет секретный токен запроса и обрабатывает обновления
+    через update_limiter. Как и в WebhookRequestHandler, если обработка не уложилась в RESPONSE_TIMEOUT,
+    Telegram получает ответ 'ok', а результат обработчика отправляется отдельным запросом
+    """
+    async def post(self) -> web.Response:
+        secret = update_limiter.secret
+        if secret and not hmac.compare_digest(self.request.headers.get(SECRET_HEADER, ''), secret):
+            raise web.HTTPUnauthorized()
+        if update_limiter.draining: # бот останавливается, Telegram доставит обновление следующему процессу
+            raise web.HTTPServiceUnavailable()
+        return await super().post()
+
+    async def process_update(self, update: types.Update):
+        dispatcher = self.get_dispatcher()
+        task = await update_limiter.start(dispatcher.updates_handler.notify, update)
+        try:
+            done, _ = await asyncio.wait({task}, timeout=RESPONSE_TIMEOUT)
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+
+        if done:
+            return task.result()
+        task.add_done_callback(self.respond_via_request)
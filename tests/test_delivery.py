@@ -0,0 +1,74 @@
+import asyncio
+import contextlib
+import time
+
+from python_modules import delivery
+from python_modules.delivery import Outbox
+from python_modules.notifications import RateLimiter
+
+
+class FakeOutboxTable:
+    """
+    Таблица notifications_outbox в памяти с той же выборкой, что и due_notifications
+    """
+    def __init__(self):
+        self.rows = {}
+        self.next_id = 1
+
+    def add(self, chat_id: int, text: str) -> int:
+        notification_id = self.next_id
+        self.next_id += 1
+        self.rows[notification_id] = [chat_id, text, 0, 0.0]
+        return notification_id
+
+    async def due_notifications(self, conn, limit, per_chat, exclude_chats=()):
+        exclude_chats = set(exclude_chats)
+        positions, due = {}, []
+        for notification_id, (chat_id, text, attempts, next_attempt) in sorted(self.rows.items()):
+            if next_attempt > time.monotonic() or chat_id in exclude_chats:
+                continue
+            positions[chat_id] = positions.get(chat_id, 0) + 1
+            if positions[chat_id] <= per_chat:
+                due.append((positions[chat_id], notification_id, chat_id, text, attempts))
+        return [row[1:] for row in sorted(due)[:limit]]
+
+    async def enqueue_notification(self, conn, chat_id, text):
+        return self.add(chat_id, text)
+
+    async def delete_notification(self, conn, notification_id):
+        self.rows.pop(notification_id, None)
+        return True
+
+    async def postpone_notification(self, conn, notification_ids, attempts, next_attempt):
+        for notification_id in notification_ids:
+            self.rows[notification_id][3] = time.monotonic() + 1
+
+
+@contextlib.asynccontextmanager
+async def fake_connection():
+    yield None
+
+
+def test_backlogged_chat_does_not_starve_other_chats(monkeypatch):
+    table = FakeOutboxTable()
+    for name in ('due_notifications', 'enqueue_notification', 'delete_notification', 'postpone_notification'):
+        monkeypatch.setattr(delivery, name, getattr(table, name))
+    monkeypatch.setattr(delivery, 'acquire_connection', fake_connection)
+
+    for index in range(40):
+        table.add(1, f'backlog {index}')
+    table.add(2, 'single')
+    sent = []
+
+    async def send(chat_id: int, text: str) -> None:
+        sent.append((chat_id, text))
+
+    async def scenario():
+        outbox = Outbox(send, RateLimiter(1000, 5, 1), workers=2, poll_interval=0.05, batch_size=20)
+        outbox.start()
+        await asyncio.sleep(1)
+        await outbox.stop()
+
+    asyncio.run(scenario())
+    assert (2, 'single') in sent
+    assert len([chat_id for chat_id, _ in sent if chat_id == 1]) < 40 # первый чат все еще разбирает свою очередь
@@ -0,0 +1,64 @@
+import asyncio
+import json
+
+import gspread
+import requests
+
+from benchmarks.fake_sheets import FakeSpreadsheet, generate_values
+from python_modules.functions import batch_search_ranges
+from python_modules.governor import governor
+from python_modules.sheets_client import is_stale_handle_error
+
+
+def api_error(status: int, message: str) -> gspread.exceptions.APIError:
+    response = requests.Response()
+    response.status_code = status
+    response._content = json.dumps({'error': {'code': status, 'message': message}}).encode()
+    return gspread.exceptions.APIError(response)
+
+
+class RenamedSheetSpreadsheet(FakeSpreadsheet):
+    """
+    Таблица, в которой лист переименован после получения объекта листа: API отклоняет весь пакет
+    и одиночные запросы к диапазонам со старым названием
+    """
+    def __init__(self):
+        super().__init__()
+        self.renamed = set()
+
+    def read_range(self, text: str) -> list:
+        title = text.partition('!')[0].strip("'")
+        if title in self.renamed:
+            raise api_error(400, f'Unable to parse range: {text}')
+        return super().read_range(text)
+
+    def values_batch_get(self, ranges: list[str]) -> dict:
+        for text in ranges:
+            self.read_range(text)
+        return super().values_batch_get(ranges)
+
+
+def test_stale_handle_errors():
+    assert is_stale_handle_error(api_error(404, 'Requested entity was not found.'))
+    assert is_stale_handle_error(api_error(400, "Unable to parse range: 'Sheet1'!A1:B2"))
+    assert not is_stale_handle_error(api_error(400, 'Invalid requests'))
+    assert not is_stale_handle_error(api_error(429, 'Quota exceeded'))
+
+
+def test_bad_range_does_not_fail_the_batch(monkeypatch):
+    governor.configure(rate_per_minute=10 ** 9, burst=10 ** 9)
+    spreadsheet = RenamedSheetSpreadsheet()
+    values = generate_values(5, 3)
+    good = spreadsheet.add_worksheet(values, 'Good')
+    renamed = spreadsheet.add_worksheet(values, 'Renamed')
+    spreadsheet.renamed.add('Renamed')
+    monkeypatch.setattr(renamed, 'get', lambda cells: spreadsheet.read_range(f"'Renamed'!{cells}"))
+    monkeypatch.setattr(renamed, 'get_all_values', lambda: spreadsheet.read_range("'Renamed'"))
+
+    results = asyncio.run(batch_search_ranges(spreadsheet, [(good, 'dynamic'), (renamed, 'A1:B2'),
+                                                            (good, 'A1:B2'), (good, 'A1:')]))
+
+    assert results[0][1] == good.get_all_values()
+    assert results[1] == (None, None)
+    assert results[2][1] == [row[:2] for row in values[:2]]
+    assert results[3] == (False, False)
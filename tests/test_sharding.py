@@ -0,0 +1,51 @@
+import asyncio
+import contextlib
+
+from python_modules import sharding
+from python_modules.sharding import LeaseManager
+
+
+def test_leases_are_initialized_after_database_comes_back(monkeypatch):
+    calls = {'connections': 0, 'init': 0}
+    synced = []
+
+    @contextlib.asynccontextmanager
+    async def flaky_connection():
+        calls['connections'] += 1
+        if calls['connections'] == 1: # база недоступна при запуске
+            raise ConnectionError('database is down')
+        yield None
+
+    async def init_leases(conn, shard_count):
+        calls['init'] += 1
+        return True
+
+    async def renew_leases(conn, worker_id, lease_ttl):
+        return [0, 1]
+
+    async def alive_workers(conn, lease_ttl):
+        return 1
+
+    async def claim_shards(conn, worker_id, count, lease_ttl):
+        return None
+
+    async def sync(shards):
+        synced.append(shards)
+
+    for name, func in (('acquire_connection', flaky_connection), ('init_leases', init_leases),
+                       ('renew_leases', renew_leases), ('alive_workers', alive_workers),
+                       ('claim_shards', claim_shards)):
+        monkeypatch.setattr(sharding, name, func)
+
+    async def main():
+        manager = LeaseManager('worker', 2, lease_ttl=30, renew_interval=0.01, sync=sync)
+        task = asyncio.create_task(manager._run())
+        await asyncio.sleep(0.1)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return manager
+
+    manager = asyncio.run(main())
+    assert calls['init'] == 1
+    assert manager.shards == {0, 1}
+    assert synced and synced[-1] == {0, 1}